@@ -1,12 +1,17 @@
+import os
 import gradio as gr
 
-from src.agents.workflow import BlockAgentFlow
-from src.memory.memory_utils import MessagesMemory
+from src.serving.workers import InProcessBackend, WorkerPool
+from src.monitoring.tracing import get_logger, start_metrics_server
 
 
+logger = get_logger("app")
 
-workflow = BlockAgentFlow()
-memory = MessagesMemory()
+# 0 runs BlockAgentFlow in this process, N > 0 dispatches turns to N worker processes
+WORKERS = int(os.getenv("BLOCKAGENT_WORKERS", "0"))
+
+# created under __main__ only, worker processes import this module again when they spawn
+backend = None
 
 
 def add_user_message(query, history):
@@ -14,20 +19,24 @@ def add_user_message(query, history):
     history = history + [[query, None]]  
     return "", history  
 
-def add_bot_response(history):
+def add_bot_response(history, request: gr.Request):
     """Add the bot reply on the chat window"""
     last_user_message = history[-1][0]
     
     try:
-        print("here insie the bot query, making to graph ")        
-        result = workflow.process(last_user_message, memory)
+        result = backend.process(request.session_hash, last_user_message)
         bot_response = result["agent_response"]
     except Exception as e:
+        logger.exception("turn failed")
         bot_response = f"Error: {str(e)}"
     
     history[-1][1] = bot_response
     return history
 
+def reset_memory(request: gr.Request):
+    """ Forget this browser session's conversation"""
+    backend.reset(request.session_hash)
+
 with gr.Blocks(theme="JohnSmith9982/small_and_pretty",) as demo:
     gr.Markdown("# BlockAgent")
     gr.Markdown("""
@@ -49,11 +58,18 @@ with gr.Blocks(theme="JohnSmith9982/small_and_pretty",) as demo:
 
     clear_button = gr.Button("Wipe Memory")
    
-    message.submit(add_user_message, inputs=[message, chatbot], outputs=[message, chatbot]) \
-           .then(add_bot_response, inputs=[chatbot], outputs=[chatbot])
+    # gradio would run one turn at a time, which leaves every worker but one idle. The worker pool and
+    # the admission control in BlockAgentFlow cap the turns instead
+    message.submit(add_user_message, inputs=[message, chatbot], outputs=[message, chatbot], concurrency_limit=None) \
+           .then(add_bot_response, inputs=[chatbot], outputs=[chatbot], concurrency_limit=None)
     
     clear_button.click(lambda: ([], []), outputs=[message, chatbot]).then(
-            lambda: memory.reset(), outputs=[])
+            reset_memory, outputs=[])
     
 if __name__ == "__main__":
+    backend = WorkerPool(WORKERS) if WORKERS else InProcessBackend()
+    backend.start()
+    # Prometheus metrics for the turns, nodes and outbound calls
+    if os.getenv("METRICS_PORT"):
+        start_metrics_server(int(os.getenv("METRICS_PORT")))
     demo.launch(share = True)
\ No newline at end of file
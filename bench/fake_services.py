@@ -0,0 +1,570 @@
+""" Local stand-ins for OpenAI, The Graph and the Ethereum node, so BlockAgentFlow can run offline.
+
+    FakeOpenAI      - /v1/chat/completions, canned json for the classifier and extraction prompts
+    FakeSubgraph    - a real graphql schema (introspection works for gql) serving bench/fixtures.py
+    FakeEthereumRPC - json-rpc answering the calls Web3UHelperClass makes (eth_call, eth_getBalance, ...)
+"""
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from web3 import Web3
+from graphql import build_schema, graphql_sync
+
+from bench.fixtures import TOKENS, START_TIMESTAMP, build_fixtures
+
+
+SYMBOLS = sorted(TOKENS, key=len, reverse=True) + ["ETH"]
+SYMBOL_PATTERN = re.compile(r"\b(" + "|".join(SYMBOLS) + r")\b", re.IGNORECASE)
+AMOUNT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*(?:" + "|".join(SYMBOLS) + r")\b", re.IGNORECASE)
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    # the benchmark and the tests open dozens of connections at once, the default listen backlog of 5 resets some
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class FakeServer:
+    """ ThreadingHTTPServer on an ephemeral port with a fixed artificial latency """
+
+    handler_class = None
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, host: str = "127.0.0.1"):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(self.handler_class):
+            fake = server
+
+        self.httpd = FakeHTTPServer((host, 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def wait(self) -> None:
+        with self.lock:
+            self.requests += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def send_json(self, payload: Any, status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def last_user_query(messages: List[Dict[str, Any]]) -> str:
+    """ The user's query as the workflow phrases it, 'User query: ...' when it is there"""
+
+    content = ""
+    for message in messages:
+        if message.get("role") == "user":
+            content = message.get("content") or ""
+    matches = re.findall(r"User query:\s*(.*)", content)
+    return matches[-1].strip() if matches else content.strip()
+
+
+def route_for(query: str) -> str:
+    lowered = query.lower()
+    if re.search(r"\b(swap|balances?|portfolio|buy|sell|send)\b", lowered) and "recent swaps" not in lowered:
+        return "transaction"
+    if re.search(r"\b(liquidity|swaps|price|pool|volume|tvl)\b", lowered):
+        return "data_retrieval"
+    return "conversation"
+
+
+def symbols_in(query: str) -> List[str]:
+    return [match.upper() for match in SYMBOL_PATTERN.findall(query)]
+
+
+def canned_reply(messages: List[Dict[str, Any]]) -> str:
+    """ The json the real prompts ask for, worked out with keyword rules"""
+
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    query = last_user_query(messages)
+    symbols = symbols_in(query)
+
+    if "coordinator agent" in system:
+        if "classifications" in system:
+            content = next((m.get("content") or "" for m in messages if m.get("role") == "user"), "")
+            return json.dumps({"classifications": [{"item": number, "query_type": route_for(item.strip()), "confidence": 0.92}
+                                                   for number, item in enumerate(re.findall(r"User query:\s*(.*)", content), 1)]})
+        return json.dumps({"query_type": route_for(query), "confidence": 0.92})
+
+    if "blockchain data retrieval" in system:
+        if "swap" in query.lower():
+            return json.dumps({"query_type": "recent_swaps",
+                               "parameters": {"token": symbols[0] if symbols else "WETH", "limit": 5}})
+        token0, token1 = (symbols + ["WETH", "USDC"])[:2]
+        return json.dumps({"query_type": "pool_liquidity", "parameters": {"token0": token0, "token1": token1}})
+
+    if "transaction parameters" in system:
+        if re.search(r"\b(balances|portfolio)\b", query.lower()):
+            return json.dumps({"transaction_type": "portfolio", "parameters": {}, "missing_parameters": []})
+        if "balance" in query.lower():
+            return json.dumps({"transaction_type": "token_balance",
+                               "parameters": {"token_symbol": symbols[0] if symbols else "ETH"},
+                               "missing_parameters": []})
+        amount = AMOUNT_PATTERN.search(query)
+        token_in, token_out = (symbols + ["WETH", "USDC"])[:2]
+        parameters = {"token_in": token_in, "token_out": token_out}
+        missing = []
+        if amount:
+            parameters["amount_in"] = float(amount.group(1))
+        else:
+            missing.append("amount_in")
+        return json.dumps({"transaction_type": "token_swap", "parameters": parameters, "missing_parameters": missing})
+
+    return ("Here is what I found: the numbers above come from the Uniswap v3 subgraph and are simulated "
+            "where a transaction is involved. Let me know if you want to dig into anything else.")
+
+
+class OpenAIHandler(JsonHandler):
+    def do_POST(self):
+        request = self.read_json()
+        if not self.path.endswith("/chat/completions"):
+            self.send_json({"error": {"message": f"unknown path {self.path}"}}, status=404)
+            return
+
+        self.fake.wait()
+        messages = request.get("messages", [])
+        content = canned_reply(messages)
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+        completion_tokens = len(content) // 4
+        cached_tokens = self.fake.cached_tokens(messages)
+
+        self.send_json({
+            "id": f"chatcmpl-bench-{self.fake.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        }, headers={
+            "x-ratelimit-limit-requests": "10000",
+            "x-ratelimit-remaining-requests": "9999",
+            "x-ratelimit-reset-requests": "6ms",
+            "x-ratelimit-limit-tokens": "2000000",
+            "x-ratelimit-remaining-tokens": str(2000000 - prompt_tokens),
+            "x-ratelimit-reset-tokens": "1ms",
+        })
+
+
+class FakeOpenAI(FakeServer):
+    handler_class = OpenAIHandler
+    # OpenAI caches prompt prefixes from 1024 tokens on, in steps of 128
+    cache_min_tokens = 1024
+    cache_step_tokens = 128
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, host: str = "127.0.0.1"):
+        super().__init__(latency, jitter, host)
+        self.recent_prompts = deque(maxlen=256)
+
+    def cached_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """ The longest prefix this prompt shares with a recent one, the way OpenAI's prompt cache counts it"""
+
+        prompt = "".join(f"<{m.get('role')}>{m.get('content') or ''}" for m in messages)
+        with self.lock:
+            shared = max((len(os.path.commonprefix([prompt, recent])) for recent in self.recent_prompts), default=0)
+            self.recent_prompts.append(prompt)
+        tokens = shared // 4
+        if tokens < self.cache_min_tokens:
+            return 0
+        return tokens - tokens % self.cache_step_tokens
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1"
+
+
+SUBGRAPH_SCHEMA = """
+scalar BigInt
+scalar BigDecimal
+
+enum OrderDirection { asc desc }
+enum Pool_orderBy { id totalValueLockedUSD volumeUSD feeTier }
+enum Swap_orderBy { id timestamp amountUSD }
+enum Token_orderBy { symbol }
+
+type Token {
+  id: ID!
+  symbol: String!
+  name: String!
+  decimals: BigInt!
+}
+
+type Pool {
+  id: ID!
+  token0: Token!
+  token1: Token!
+  feeTier: BigInt!
+  liquidity: BigInt!
+  token0Price: BigDecimal!
+  token1Price: BigDecimal!
+  totalValueLockedToken0: BigDecimal!
+  totalValueLockedToken1: BigDecimal!
+  totalValueLockedUSD: BigDecimal!
+  volumeUSD: BigDecimal!
+}
+
+type Swap {
+  id: ID!
+  timestamp: BigInt!
+  pool: Pool!
+  token0: Token!
+  token1: Token!
+  sender: String!
+  origin: String!
+  amount0: BigDecimal!
+  amount1: BigDecimal!
+  amountUSD: BigDecimal!
+}
+
+input Token_filter {
+  id: ID
+  id_in: [ID!]
+  symbol: String
+  symbol_in: [String!]
+  symbol_contains_nocase: String
+}
+
+input Pool_filter {
+  id: ID
+  id_in: [ID!]
+  id_gt: ID
+  totalValueLockedUSD_gt: BigDecimal
+  token0_: Token_filter
+  token1_: Token_filter
+  or: [Pool_filter]
+}
+
+input Swap_filter {
+  id_gt: ID
+  pool: String
+  pool_in: [String!]
+  timestamp: BigInt
+  timestamp_gt: BigInt
+  timestamp_gte: BigInt
+  token0_: Token_filter
+  token1_: Token_filter
+  or: [Swap_filter]
+}
+
+type Query {
+  tokens(where: Token_filter, orderBy: Token_orderBy, orderDirection: OrderDirection, first: Int = 100, skip: Int = 0): [Token!]!
+  pools(where: Pool_filter, orderBy: Pool_orderBy, orderDirection: OrderDirection, first: Int = 100, skip: Int = 0): [Pool!]!
+  swaps(where: Swap_filter, orderBy: Swap_orderBy, orderDirection: OrderDirection, first: Int = 100, skip: Int = 0): [Swap!]!
+}
+"""
+
+
+def as_number(value: Any) -> Any:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def matches(record: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """ The subset of The Graph's filter language the tools use"""
+
+    for key, value in (where or {}).items():
+        if key == "or":
+            if not any(matches(record, clause) for clause in value):
+                return False
+        elif key.endswith("_"):
+            if not matches(record.get(key[:-1]) or {}, value):
+                return False
+        elif key.endswith("_contains_nocase"):
+            if str(value).lower() not in str(record.get(key[:-len("_contains_nocase")], "")).lower():
+                return False
+        elif key.endswith("_in"):
+            field = record.get(key[:-3])
+            field = field.get("id") if isinstance(field, dict) else field
+            if field not in value:
+                return False
+        elif key.endswith("_gte"):
+            if as_number(record.get(key[:-4])) < as_number(value):
+                return False
+        elif key.endswith("_gt"):
+            if as_number(record.get(key[:-3])) <= as_number(value):
+                return False
+        else:
+            field = record.get(key)
+            field = field.get("id") if isinstance(field, dict) else field
+            if field != value:
+                return False
+    return True
+
+
+def collection_resolver(records: List[Dict[str, Any]]):
+    def resolve(root, info, where=None, orderBy=None, orderDirection="asc", first=100, skip=0):
+        rows = [record for record in records if matches(record, where)]
+        if orderBy:
+            # graph-node breaks ties on id
+            rows.sort(key=lambda record: (as_number(record.get(orderBy)), record["id"]), reverse=orderDirection == "desc")
+        return rows[skip:skip + first]
+    return resolve
+
+
+class SubgraphHandler(JsonHandler):
+    def do_POST(self):
+        request = self.read_json()
+        self.fake.wait()
+        result = graphql_sync(self.fake.schema, request.get("query", ""),
+                              variable_values=request.get("variables"),
+                              operation_name=request.get("operationName"))
+        self.send_json(result.formatted)
+
+
+class FakeSubgraph(FakeServer):
+    handler_class = SubgraphHandler
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, fixtures: Optional[Dict[str, Any]] = None):
+        super().__init__(latency, jitter)
+        self.fixtures = fixtures or build_fixtures()
+        self.schema = build_schema(SUBGRAPH_SCHEMA)
+        for collection in ("tokens", "pools", "swaps"):
+            self.schema.query_type.fields[collection].resolve = collection_resolver(self.fixtures[collection])
+
+
+def selector(signature: str) -> str:
+    return Web3.keccak(text=signature)[:4].hex().removeprefix("0x")
+
+
+DECIMALS = selector("decimals()")
+BALANCE_OF = selector("balanceOf(address)")
+QUOTE_EXACT_INPUT_SINGLE = selector("quoteExactInputSingle(address,address,uint24,uint256,uint160)")
+GET_POOL = selector("getPool(address,address,uint24)")
+SWAP_TOPIC = Web3.keccak(text="Swap(address,address,int256,int256,uint160,uint128,int24)").hex()
+# about one swap every other block in each pool
+SWAP_EVERY_BLOCKS = 2
+
+TOKENS_BY_ADDRESS = {token["id"].lower(): symbol for symbol, token in TOKENS.items()}
+
+
+def words(calldata: str) -> List[str]:
+    data = calldata.removeprefix("0x")[8:]
+    return [data[i:i + 64] for i in range(0, len(data), 64)]
+
+
+def quantity(value: Any) -> int:
+    """ json-rpc quantities arrive as hex strings, some clients send plain ints"""
+
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+def uint256(value: int) -> str:
+    return "0x" + format(value, "064x")
+
+
+def int256(value: int) -> str:
+    return format(value % (1 << 256), "064x")
+
+
+class RPCHandler(JsonHandler):
+    def do_POST(self):
+        request = self.read_json()
+        self.fake.wait()
+        if isinstance(request, list):
+            self.send_json([self.fake.answer(item) for item in request])
+        else:
+            self.send_json(self.fake.answer(request))
+
+
+class FakeEthereumRPC(FakeServer):
+    handler_class = RPCHandler
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, fixtures: Optional[Dict[str, Any]] = None):
+        super().__init__(latency, jitter)
+        self.started_at = time.time()
+        # the subgraph's pools, so getPool and the Swap logs agree with it
+        self.pools = {pool["id"].lower(): pool for pool in (fixtures or build_fixtures())["pools"]}
+
+    def block_number(self) -> int:
+        # a new block every 12 seconds, like mainnet
+        return 19_500_000 + int((time.time() - self.started_at) / 12)
+
+    def eth_call(self, call: Dict[str, Any]) -> str:
+        to = (call.get("to") or "").lower()
+        data = call.get("input") or call.get("data") or "0x"
+        function = data.removeprefix("0x")[:8]
+
+        if function == DECIMALS:
+            return uint256(TOKENS[TOKENS_BY_ADDRESS[to]]["decimals"] if to in TOKENS_BY_ADDRESS else 18)
+
+        if function == BALANCE_OF:
+            symbol = TOKENS_BY_ADDRESS.get(to, "WETH")
+            return uint256(int(2.5 * 10 ** TOKENS[symbol]["decimals"]))
+
+        if function == GET_POOL:
+            args = words(data)
+            pair = {"0x" + args[0][-40:], "0x" + args[1][-40:]}
+            for pool in self.pools.values():
+                if {pool["token0"]["id"], pool["token1"]["id"]} == pair and int(pool["feeTier"]) == int(args[2], 16):
+                    return uint256(int(pool["id"], 16))
+            return uint256(0)
+
+        if function == QUOTE_EXACT_INPUT_SINGLE:
+            args = words(data)
+            token_in = TOKENS[TOKENS_BY_ADDRESS.get("0x" + args[0][-40:], "WETH")]
+            token_out = TOKENS[TOKENS_BY_ADDRESS.get("0x" + args[1][-40:], "WETH")]
+            amount_in = int(args[3], 16) / 10 ** token_in["decimals"]
+            amount_out = amount_in * token_in["usd"] / token_out["usd"] * 0.997
+            return uint256(int(amount_out * 10 ** token_out["decimals"]))
+
+        return "0x"
+
+    def swap_logs(self, log_filter: Dict[str, Any], head: int) -> List[Dict[str, Any]]:
+        """ Swap events for the filter's pools, the same ones for a block every time it is asked for"""
+
+        addresses = log_filter.get("address") or []
+        addresses = [addresses] if isinstance(addresses, str) else addresses
+        from_block = quantity(log_filter.get("fromBlock", head)) if log_filter.get("fromBlock") != "latest" else head
+        to_block = quantity(log_filter.get("toBlock", head)) if log_filter.get("toBlock") != "latest" else head
+
+        logs = []
+        for block in range(from_block, min(to_block, head) + 1):
+            for log_index, address in enumerate(sorted(address.lower() for address in addresses)):
+                pool = self.pools.get(address)
+                rng = random.Random(f"{address}:{block}")
+                if pool is None or rng.randrange(SWAP_EVERY_BLOCKS):
+                    continue
+                # on chain token0 is the lower address, the fixtures keep the order of the example queries
+                token0, token1 = sorted((pool["token0"], pool["token1"]), key=lambda token: token["id"])
+                price0, price1 = TOKENS[token0["symbol"]]["usd"], TOKENS[token1["symbol"]]["usd"]
+                amount_usd = rng.lognormvariate(8, 1.5)
+                direction = 1 if rng.random() < 0.5 else -1
+                amount0 = int(direction * amount_usd / price0 * 10 ** TOKENS[token0["symbol"]]["decimals"])
+                amount1 = int(-direction * amount_usd / price1 * 10 ** TOKENS[token1["symbol"]]["decimals"])
+                logs.append({
+                    "address": Web3.to_checksum_address(address),
+                    "topics": [SWAP_TOPIC, uint256(rng.getrandbits(160)), uint256(rng.getrandbits(160))],
+                    "data": "0x" + int256(amount0) + int256(amount1) + int256(rng.getrandbits(96)) + int256(rng.getrandbits(64)) + int256(0),
+                    "blockNumber": hex(block),
+                    "blockHash": uint256(block),
+                    "transactionHash": uint256(rng.getrandbits(256)),
+                    "transactionIndex": hex(log_index),
+                    "logIndex": hex(log_index),
+                    "removed": False,
+                })
+        return logs
+
+    def fee_history(self, block_count: int, block: int, percentiles: List[float]) -> Dict[str, Any]:
+        # one reward per requested percentile, 0.5 gwei at the bottom up to 2.5 gwei at the top
+        return {
+            "oldestBlock": hex(block - block_count + 1),
+            "baseFeePerGas": [hex(18 * 10 ** 9)] * (block_count + 1),
+            "gasUsedRatio": [0.5] * block_count,
+            "reward": [[hex(int((0.5 + p / 50) * 10 ** 9)) for p in percentiles or [50]]] * block_count,
+        }
+
+    def answer(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        method = request.get("method")
+        params = request.get("params") or []
+        block = self.block_number()
+        results = {
+            "web3_clientVersion": lambda: "fake-ethereum/1.0",
+            "net_version": lambda: "1",
+            "eth_chainId": lambda: "0x1",
+            "eth_blockNumber": lambda: hex(block),
+            "eth_gasPrice": lambda: hex(20 * 10 ** 9),
+            "eth_maxPriorityFeePerGas": lambda: hex(10 ** 9),
+            "eth_getBalance": lambda: hex(int(1.5 * 10 ** 18)),
+            "eth_getTransactionCount": lambda: "0x5",
+            "eth_estimateGas": lambda: hex(184_523),
+            "eth_call": lambda: self.eth_call(params[0] if params else {}),
+            "eth_getLogs": lambda: self.swap_logs(params[0] if params else {}, block),
+            "eth_feeHistory": lambda: self.fee_history(quantity(params[0]) if params else 1, block,
+                                                       params[2] if len(params) > 2 else []),
+            "eth_getBlockByNumber": lambda: {
+                "number": hex(block),
+                "hash": uint256(block),
+                "parentHash": uint256(block - 1),
+                "timestamp": hex(START_TIMESTAMP + 12 * (block - 19_500_000)),
+                "baseFeePerGas": hex(18 * 10 ** 9),
+                "gasLimit": hex(30_000_000),
+                "gasUsed": hex(15_000_000),
+                "transactions": [],
+            },
+        }
+
+        if method not in results:
+            return {"jsonrpc": "2.0", "id": request.get("id"),
+                    "error": {"code": -32601, "message": f"method {method} not supported by the fake node"}}
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": results[method]()}
+
+
+class FakeServices:
+    """ All three fakes, started together and torn down together """
+
+    def __init__(self, llm_latency: float = 0.3, graph_latency: float = 0.08, rpc_latency: float = 0.03, jitter: float = 0.2):
+        self.openai = FakeOpenAI(llm_latency, llm_latency * jitter)
+        self.subgraph = FakeSubgraph(graph_latency, graph_latency * jitter)
+        self.rpc = FakeEthereumRPC(rpc_latency, rpc_latency * jitter, self.subgraph.fixtures)
+
+    def __enter__(self) -> "FakeServices":
+        for server in (self.openai, self.subgraph, self.rpc):
+            server.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for server in (self.openai, self.subgraph, self.rpc):
+            server.stop()
+
+    def environment(self) -> Dict[str, str]:
+        """ The env vars that point BlockAgent at the fakes, has to be applied before src is imported"""
+
+        return {
+            "OPENAI_KEY": "sk-bench",
+            "OPENAI_API_KEY": "sk-bench",
+            "OPENAI_API_BASE": self.openai.base_url,
+            "OPENAI_BASE_URL": self.openai.base_url,
+            "GRAPH_URL": self.subgraph.url,
+            "INFURA_KEY": self.rpc.url,
+            # first hardhat dev account, only ever used to sign simulations against the fake node
+            "PRIVATE_KEY": "0xac0974bec39a17e36ba4a6b4d238ff944bacb478cbed5efcae784d7bf4f2ff80",
+        }
@@ -0,0 +1,84 @@
+import random
+from typing import Dict, Any, List
+
+
+# addresses match symbol_addr_mapping in src/blockchain/transaction.py, so the quoter stub can map them back
+TOKENS = {
+    "WETH": {"id": "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2", "name": "Wrapped Ether", "decimals": 18, "usd": 3000.0},
+    "USDC": {"id": "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48", "name": "USD Coin", "decimals": 6, "usd": 1.0},
+    "WBTC": {"id": "0x2260fac5e5542a773aa44fbcfedf7c193bc2c599", "name": "Wrapped BTC", "decimals": 8, "usd": 60000.0},
+    "USDT": {"id": "0xdac17f958d2ee523a2206206994597c13d831ec7", "name": "Tether USD", "decimals": 6, "usd": 1.0},
+    "DAI":  {"id": "0x6b175474e89094c44da98b954eedeac495271d0f", "name": "Dai Stablecoin", "decimals": 18, "usd": 1.0},
+    "UNI":  {"id": "0x1f9840a85d5af5bf1d1762f925bdaddc4201f984", "name": "Uniswap", "decimals": 18, "usd": 8.0},
+    "UST":  {"id": "0xa693b19d2931d498c5b318df961919bb4aee87a5", "name": "UST (Wormhole)", "decimals": 6, "usd": 0.02},
+}
+
+# (token0, token1, fee tier), in the order the example queries ask for them
+PAIRS = [
+    ("WETH", "USDC", 500),
+    ("WETH", "USDC", 3000),
+    ("WBTC", "WETH", 3000),
+    ("WETH", "USDT", 3000),
+    ("DAI", "USDC", 100),
+    ("UNI", "WETH", 3000),
+    ("WBTC", "USDC", 3000),
+    ("USDC", "USDT", 100),
+]
+
+START_TIMESTAMP = 1742800000
+
+
+def token_entity(symbol: str) -> Dict[str, Any]:
+    token = TOKENS[symbol]
+    return {"id": token["id"], "symbol": symbol, "name": token["name"], "decimals": str(token["decimals"])}
+
+
+def build_fixtures(seed: int = 7, swaps_per_pool: int = 200) -> Dict[str, List[Dict[str, Any]]]:
+    """ Uniswap v3 shaped tokens, pools and swaps, deterministic for a given seed"""
+
+    rng = random.Random(seed)
+    pools = []
+    swaps = []
+
+    for index, (symbol0, symbol1, fee_tier) in enumerate(PAIRS):
+        price0 = TOKENS[symbol0]["usd"]
+        price1 = TOKENS[symbol1]["usd"]
+        tvl_usd = rng.uniform(5e6, 4e8)
+        pool_id = "0x" + format(rng.getrandbits(160), "040x")
+
+        pool = {
+            "id": pool_id,
+            "token0": token_entity(symbol0),
+            "token1": token_entity(symbol1),
+            "feeTier": str(fee_tier),
+            "totalValueLockedToken0": f"{tvl_usd / 2 / price0:.18f}",
+            "totalValueLockedToken1": f"{tvl_usd / 2 / price1:.18f}",
+            "totalValueLockedUSD": f"{tvl_usd:.18f}",
+            "volumeUSD": f"{tvl_usd * rng.uniform(20, 400):.18f}",
+            # token0Price is token0 per token1, the subgraph's naming
+            "token0Price": f"{price1 / price0:.18f}",
+            "token1Price": f"{price0 / price1:.18f}",
+            "liquidity": str(rng.getrandbits(96)),
+        }
+        pools.append(pool)
+
+        timestamp = START_TIMESTAMP + index
+        for swap_index in range(swaps_per_pool):
+            timestamp += rng.randint(5, 120)
+            amount_usd = rng.lognormvariate(8, 1.5)
+            direction = 1 if rng.random() < 0.5 else -1
+            swaps.append({
+                "id": f"0x{rng.getrandbits(256):064x}#{swap_index}",
+                "timestamp": str(timestamp),
+                "pool": {k: pool[k] for k in ("id", "feeTier", "token0", "token1")},
+                "token0": pool["token0"],
+                "token1": pool["token1"],
+                "amount0": f"{direction * amount_usd / price0:.18f}",
+                "amount1": f"{-direction * amount_usd / price1:.18f}",
+                "amountUSD": f"{amount_usd:.18f}",
+                "sender": "0x" + format(rng.getrandbits(160), "040x"),
+                "origin": "0x" + format(rng.getrandbits(160), "040x"),
+            })
+
+    tokens = [token_entity(symbol) for symbol in TOKENS]
+    return {"tokens": tokens, "pools": pools, "swaps": swaps}
@@ -0,0 +1,195 @@
+""" Offline throughput / latency benchmark for BlockAgentFlow.
+
+    python -m bench.run_benchmark --sessions 8 --turns 25 --llm-latency 0.3
+
+Starts the fakes from bench/fake_services.py, points BlockAgent at them and drives
+BlockAgentFlow.process from N concurrent sessions through a scripted query mix.
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from bench.fake_services import FakeServices
+
+
+# the example queries from app.py plus a few follow ups, cycled through by every session
+QUERY_MIX = [
+    "Get me the liquidity for WETH/USDC pool",
+    "I want to see the recent swaps for WETH",
+    "I want to swap 1 WETH for USDC",
+    "Check my WETH balance",
+    "Hello, what can you do?",
+    "Get me the liquidity for WBTC/WETH pool",
+    "I want to swap 250 USDC for DAI",
+    "Show me recent swaps for UNI",
+    "Check my USDC balance",
+    "What is a liquidity pool?",
+    "What are all my balances worth in USDC?",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """ Nearest rank percentile"""
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def turn_error(result: Dict[str, Any], memory) -> Optional[str]:
+    """ A turn that came back without raising can still have failed: the agents catch their own exceptions
+        and the tools hand back {"error": ...}"""
+
+    if result.get("status") == "error":
+        return result.get("agent_response") or "status error"
+    response = result.get("agent_response") or ""
+    if not response and memory.messages and memory.messages[-1].role == "assistant":
+        # the agents put their "Error processing ..." in memory and hand back no response
+        response = memory.messages[-1].content
+    if response.startswith("Error processing"):
+        return response
+    results = result.get("results")
+    if isinstance(results, dict) and results.get("error"):
+        return str(results["error"])
+    return None
+
+
+def run_session(workflow, session_index: int, turns: int, results: List[Dict[str, Any]], lock: threading.Lock) -> None:
+    """ One user, turns queries in a row on the same memory"""
+
+    from src.memory.memory_utils import MessagesMemory
+
+    memory = MessagesMemory()
+    for turn in range(turns):
+        query = QUERY_MIX[(session_index + turn) % len(QUERY_MIX)]
+        start = time.perf_counter()
+        try:
+            result = workflow.process(query, memory)
+            route = result.get("query_type") or "unknown"
+            if result.get("status") in ("busy", "cached"):
+                # turned away by admission control, kept apart from the turns that ran
+                route = result["status"]
+            error = turn_error(result, memory)
+        except Exception as e:
+            route = "error"
+            error = f"{type(e).__name__}: {e}"
+        latency = time.perf_counter() - start
+
+        with lock:
+            results.append({"session": session_index, "turn": turn, "query": query,
+                            "route": route, "latency": latency, "error": error})
+
+
+def summarize(results: List[Dict[str, Any]], wall_time: float, sessions: int) -> Dict[str, Any]:
+    by_route = defaultdict(list)
+    errors = defaultdict(int)
+    for result in results:
+        by_route[result["route"]].append(result["latency"])
+        if result["error"]:
+            errors[result["route"]] += 1
+            errors["all"] += 1
+    by_route["all"] = [result["latency"] for result in results]
+
+    return {
+        "sessions": sessions,
+        "turns": len(results),
+        "errors": sum(1 for result in results if result["error"]),
+        "wall_time": wall_time,
+        "turns_per_second": len(results) / wall_time if wall_time else 0.0,
+        "routes": {route: {"count": len(latencies),
+                           "errors": errors[route],
+                           "p50": percentile(latencies, 50),
+                           "p95": percentile(latencies, 95),
+                           "p99": percentile(latencies, 99)}
+                   for route, latencies in sorted(by_route.items())}
+    }
+
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    print(f"\n{summary['turns']} turns from {summary['sessions']} sessions in {summary['wall_time']:.2f}s "
+          f"-> {summary['turns_per_second']:.2f} turns/s, {summary['errors']} errors\n")
+    print(f"{'route':<18}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in summary["routes"].items():
+        print(f"{route:<18}{stats['count']:>7}{stats['errors']:>8}{stats['p50'] * 1000:>10.1f}"
+              f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+    for name, stats in summary.get("classify_tiers", {}).items():
+        print(f"\nclassifier tier {name}: {stats['calls']} calls, hit rate {stats['hit_rate']:.2f}, "
+              f"{stats['escalated']} escalated, {stats['malformed']} malformed, avg {stats['avg_latency'] * 1000:.1f} ms")
+    for name, stats in summary.get("classify_batches", {}).items():
+        print(f"\n{name}: {stats['calls']} classifications in {stats['batches']} requests, "
+              f"avg batch {stats['avg_batch_size']:.2f}, largest {stats['largest_batch']}, "
+              f"avg wait {stats['avg_wait'] * 1000:.1f} ms")
+    local = summary.get("local_classifier")
+    if local and local["loaded"]:
+        agreement = f"{local['agreement']:.3f}" if local["agreement"] is not None else "-"
+        print(f"\nlocal intent model: {local['accepted']} of {local['calls']} queries routed locally, "
+              f"avg {local['avg_latency'] * 1e6:.0f} us, agreement with the llm on {local['audited']} audited: {agreement}")
+
+
+def main(argv: List[str] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Offline BlockAgent benchmark")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions")
+    parser.add_argument("--turns", type=int, default=20, help="turns per session")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per fake OpenAI call")
+    parser.add_argument("--graph-latency", type=float, default=0.08, help="seconds per fake subgraph call")
+    parser.add_argument("--rpc-latency", type=float, default=0.03, help="seconds per fake json-rpc call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="extra random latency as a fraction of the base")
+    parser.add_argument("--llm-cache", action="store_true", help="keep the LLM cache on (off by default, it hides the LLM latency)")
+    parser.add_argument("--prefetch", action="store_true", help="run the hot pair prefetcher")
+    parser.add_argument("--speculative", action="store_true", help="speculative extraction alongside classification")
+    parser.add_argument("--classify-window-ms", type=float, default=None,
+                        help="classification micro-batch window, 0 sends every classification on its own")
+    parser.add_argument("--routing-log", default="", help="append the llm routing decisions here, to train the local intent model on")
+    parser.add_argument("--intent-model", default="", help="route with this local intent model first")
+    parser.add_argument("--output", help="write the summary and every turn as json to this file")
+    args = parser.parse_args(argv)
+
+    with FakeServices(args.llm_latency, args.graph_latency, args.rpc_latency, args.jitter) as services:
+        # the src modules read their configuration at import time, so the env has to be in place first
+        os.environ.update(services.environment())
+        os.environ["LLM_CACHE_PATH"] = os.environ.get("LLM_CACHE_PATH", ".cache/bench_llm_cache.sqlite") if args.llm_cache else ""
+        os.environ["BLOCKAGENT_PREFETCH"] = "1" if args.prefetch else "0"
+        os.environ["BLOCKAGENT_SPECULATIVE"] = "1" if args.speculative else "0"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        os.environ["ROUTING_LOG_PATH"] = args.routing_log
+        os.environ["INTENT_MODEL_PATH"] = args.intent_model
+        if args.classify_window_ms is not None:
+            os.environ["CLASSIFY_BATCH_WINDOW_MS"] = str(args.classify_window_ms)
+
+        from src.agents.workflow import BlockAgentFlow
+
+        workflow = BlockAgentFlow()
+        results = []
+        lock = threading.Lock()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            for session_index in range(args.sessions):
+                executor.submit(run_session, workflow, session_index, args.turns, results, lock)
+        wall_time = time.perf_counter() - start
+
+    summary = summarize(results, wall_time, args.sessions)
+    summary["classify_tiers"] = workflow.classifier.get_stats()
+    summary["classify_batches"] = workflow.classifier.get_batch_stats()
+    summary["local_classifier"] = workflow.local_classifier.get_stats()
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "summary": summary, "turns": results}, f, indent=2)
+
+    return summary
+
+
+if __name__ == "__main__":
+    summary = main()
+    sys.exit(1 if summary["errors"] else 0)
@@ -1,14 +1,8 @@
 import os
-import langchain
 from openai import OpenAI
 from dotenv import load_dotenv
 from typing import Dict, Any, List, Optional
-from langchain_core.caches import InMemoryCache
-from langchain_core.globals import set_llm_cache
-
-langchain.llm_cache = InMemoryCache()
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
 
 
 load_dotenv()
@@ -17,21 +11,15 @@ MODEL_NAME = "gpt-4o-mini"
 OPENAI_KEY  = os.getenv('OPENAI_KEY')
 
 from src.memory.memory_utils import MessagesMemory
+from src.llm.llm_cache import get_llm_cache
+from src.llm.rate_limiter import get_llm_http_client
+from src.llm.prompts import PromptTemplate
+from src.monitoring.tracing import get_logger, span
+from src.monitoring.cassette import invoke_chat_model
 
-class ConversationAgent:
-    def __init__(self):
-        self.client = OpenAI(api_key=OPENAI_KEY)
-        self.conversational_llm = ChatOpenAI(
-            model_name = MODEL_NAME,
-            openai_api_key  = OPENAI_KEY, 
-            temperature=0, 
-        )
+logger = get_logger("conversation_agent")
 
-    def make_conversation(self, query: str, memory: MessagesMemory, state) -> Dict[str, Any]:
-
-        print("here to conversational agent")
-       
-        system_prompt = """
+CONVERSATION_PROMPT = PromptTemplate("conversation", """
                 You are BlockAgent, a specialized AI assistant designed to help users with cryptocurrency and DeFi queries.
                 Your role is to assist with:
                 1. Data retrieval from the uniswap subgraph (e.g., token prices, liquidity pools, trading volumes, protocol info).
@@ -42,15 +30,28 @@ class ConversationAgent:
                 Focus entirely on your identity as BlockAgent and your crypto/DeFi expertise. 
                 If the user asks about any othet topic, you will not engage, strictly limit the conversation to 
                 DeFi queries and your capabilites as BlockAgent
-                Respond in a friendly, conversational tone, and always tie your answers back to your capabilities when relevant, and always be concise."""
+                Respond in a friendly, conversational tone, and always tie your answers back to your capabilities when relevant, and always be concise.""")
 
-        print("lead to the conversational agent")
-        conversation_history = memory.get_message_history()
+class ConversationAgent:
+    def __init__(self):
+        self.client = OpenAI(api_key=OPENAI_KEY, http_client=get_llm_http_client())
+        self.conversational_llm = ChatOpenAI(
+            model_name = MODEL_NAME,
+            openai_api_key  = OPENAI_KEY, 
+            temperature=0, 
+            cache=get_llm_cache(),
+            http_client=get_llm_http_client()
+        )
 
-        messages = [SystemMessage(content=system_prompt),
-                    HumanMessage(content=conversation_history + "\n" + query)]
+    def make_conversation(self, query: str, memory: MessagesMemory, state) -> Dict[str, Any]:
+
+        logger.debug("here to conversational agent")
+       
+        messages = CONVERSATION_PROMPT.chat_messages(query=query, history=memory.get_message_history())
         
-        response = self.conversational_llm.invoke(messages)
+        with span("conversation", kind="llm", model=MODEL_NAME, prompt=CONVERSATION_PROMPT.name) as llm_span:
+            response = invoke_chat_model(self.conversational_llm, messages)
+            llm_span.record_usage(response)
         conversation_response = response.content
        
         memory.add_message("assistant", conversation_response)
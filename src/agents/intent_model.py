@@ -0,0 +1,471 @@
+""" A small local intent classifier, distilled from the llm cascade's own routing decisions.
+
+    python -m src.agents.intent_model train .cache/routing_log.jsonl .cache/intent_model.npz
+    python -m src.agents.intent_model eval .cache/routing_log.jsonl .cache/intent_model.npz
+
+With ROUTING_LOG_PATH set, every query the llm routes is appended to it with the end of its history,
+its query type and confidence.
+`train` fits a linear softmax model on hashed word / bigram / character n-grams of those queries, then
+calibrates its confidence with a temperature on a held out part of the log. `eval` scores a model
+against the llm labels of a second held out part, per confidence threshold. Once INTENT_MODEL_PATH
+exists the workflow routes every query the model is sure enough about in-process, only the rest go to the llm.
+"""
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+import numpy as np
+
+from src.agents.query_classifier import QUERY_TYPES
+from src.monitoring.tracing import get_logger, metrics, span
+
+
+load_dotenv()
+
+logger = get_logger("intent_model")
+
+# every llm routing decision is appended here as training data for the local model, off unless set.
+# The queries are the users' own words, so only turn it on where that is fine
+ROUTING_LOG_PATH = os.getenv("ROUTING_LOG_PATH", "")
+# past this size the log moves to <path>.1 (replacing the one before) and a new one starts
+ROUTING_LOG_MAX_MB = float(os.getenv("ROUTING_LOG_MAX_MB", "50"))
+DEFAULT_ROUTING_LOG = ".cache/routing_log.jsonl"
+# the trained model, the workflow only uses it when the file exists
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH", ".cache/intent_model.npz")
+# calibrated confidence the local model needs to route a query on its own, below it the llm cascade decides
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.9"))
+# share of the queries the local model is sure about that still go to the llm, so we keep measuring agreement
+INTENT_AUDIT_RATE = float(os.getenv("INTENT_AUDIT_RATE", "0.05"))
+# share of the query's words the model has to have seen in training, a confident answer about words it never
+# saw ("explain impermanent loss") is just the bias talking
+INTENT_MIN_COVERAGE = float(os.getenv("INTENT_MIN_COVERAGE", "1.0"))
+
+FEATURE_BITS = 18
+# only the end of the conversation says anything about the next query, e.g. "how much?" before "0.5"
+HISTORY_CHARS = 300
+# llm answers below this were clarification requests, not routing decisions
+MIN_LABEL_CONFIDENCE = 0.7
+# percent of the distinct queries held out for the temperature and for eval, picked by hash so retraining keeps the split
+CALIBRATION_PERCENT = 10
+TEST_PERCENT = 10
+# fewer calibration examples than this and the temperature is noise, train refuses
+MIN_CALIBRATION_EXAMPLES = 50
+# temperatures only ever soften the model, a fit that wants to sharpen it is overfitting the calibration split
+TEMPERATURES = np.geomspace(1, 100, 81)
+EVAL_THRESHOLDS = (0.5, 0.7, 0.8, 0.9, 0.95, 0.98, 0.99)
+
+WORD = re.compile(r"\w+")
+
+metrics.describe("blockagent_intent_local_total", "counter", "Queries seen by the local intent model, by outcome")
+metrics.describe("blockagent_intent_local_agreement_total", "counter", "Local predictions checked against the llm")
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(WORD.findall(query.casefold()))
+
+
+def feature_index(name: str, bits: int) -> int:
+    return zlib.crc32(name.encode()) & ((1 << bits) - 1)
+
+
+def featurize(query: str, history: str = "", bits: int = FEATURE_BITS) -> Tuple[np.ndarray, np.ndarray]:
+    """ Hashed feature indices and their l2 normalised counts: words, word bigrams and character trigrams
+        of the query, plus the words at the end of the history"""
+
+    words = WORD.findall(query.casefold())
+    names = ["w:" + word for word in words]
+    names += [f"b:{first} {second}" for first, second in zip(words, words[1:])]
+    padded = f" {' '.join(words)} "
+    names += ["c:" + padded[i:i + 3] for i in range(len(padded) - 2)]
+    history_words = WORD.findall(history[-HISTORY_CHARS:].casefold()) if history else []
+    names += ["h:" + word for word in history_words] or ["h:"]
+
+    indices = np.fromiter((feature_index(name, bits) for name in names), dtype=np.int64, count=len(names))
+    indices, counts = np.unique(indices, return_counts=True)
+    values = counts.astype(np.float32)
+    return indices, values / np.linalg.norm(values)
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class IntentModel:
+    """ Linear softmax over hashed n-grams, with a temperature that calibrates its confidence """
+
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, labels: List[str], temperature: float = 1.0,
+                 bits: int = FEATURE_BITS, info: Optional[Dict[str, Any]] = None):
+        self.weights = weights
+        self.bias = bias
+        self.labels = list(labels)
+        self.temperature = temperature
+        self.bits = bits
+        self.info = info or {}
+        # the features training saw, every other row of weights is still zero
+        self.known = np.any(weights != 0, axis=1)
+
+    def coverage(self, query: str) -> float:
+        """ Share of the query's words the model was trained on, 0.0 for a query without any"""
+
+        words = WORD.findall(query.casefold())
+        if not words:
+            return 0.0
+        return sum(bool(self.known[feature_index("w:" + word, self.bits)]) for word in words) / len(words)
+
+    def probabilities(self, query: str, history: str = "") -> np.ndarray:
+        indices, values = featurize(query, history, self.bits)
+        return softmax((values @ self.weights[indices] + self.bias) / self.temperature)
+
+    def predict(self, query: str, history: str = "") -> Tuple[str, float]:
+        """ (query_type, calibrated confidence)"""
+
+        probabilities = self.probabilities(query, history)
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # np.savez adds .npz to any other name, write to a name that already has it and move it into place
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, weights=self.weights, bias=self.bias, labels=np.array(self.labels),
+                            temperature=self.temperature, bits=self.bits, info=json.dumps(self.info))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IntentModel":
+        with np.load(path) as data:
+            return cls(data["weights"], data["bias"], [str(label) for label in data["labels"]],
+                       float(data["temperature"]), int(data["bits"]), json.loads(str(data["info"])))
+
+
+class RoutingLog:
+    """ Appends the llm's routing decisions to a JSONL file, the training data of the local model """
+
+    def __init__(self, path: str = ROUTING_LOG_PATH, max_mb: float = ROUTING_LOG_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def append(self, query: str, history: str, classification: Dict[str, Any],
+               local: Optional[Tuple[str, float]] = None) -> None:
+        if not self.path or classification.get("query_type") not in QUERY_TYPES:
+            return
+        # the model only ever looks at the end of the history, there is no reason to keep the rest
+        row = {"ts": time.time(), "query": query, "history": history[-HISTORY_CHARS:] if history else "",
+               "query_type": classification["query_type"], "confidence": classification.get("confidence", 0.0),
+               "tier": classification.get("tier")}
+        if local is not None:
+            row["local"] = {"query_type": local[0], "confidence": local[1]}
+        line = json.dumps(row) + "\n"
+        try:
+            # one write per line in append mode, worker processes can share the file
+            with self.lock:
+                if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, "a") as f:
+                    f.write(line)
+        except OSError as e:
+            logger.warning(f"could not append to the routing log {self.path}: {e}")
+
+
+class LocalIntentClassifier:
+    """ The trained model in front of the llm cascade.
+
+        A query the model is at least min_confidence sure about is routed right away, every other query
+        (and a sample of the sure ones, for the agreement metric) goes to the llm, whose answer is logged.
+        So does every query with words the model was never trained on, however sure it is.
+    """
+
+    def __init__(self, model: Optional[IntentModel] = None, min_confidence: float = INTENT_MIN_CONFIDENCE,
+                 audit_rate: float = INTENT_AUDIT_RATE, log: Optional[RoutingLog] = None,
+                 min_coverage: float = INTENT_MIN_COVERAGE):
+        self.model = model
+        self.min_confidence = min_confidence
+        self.min_coverage = min_coverage
+        self.audit_rate = audit_rate
+        self.log = log if log is not None else RoutingLog()
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.total_latency = 0.0
+
+    @classmethod
+    def from_path(cls, path: str = INTENT_MODEL_PATH, **kwargs: Any) -> "LocalIntentClassifier":
+        model = None
+        if path and os.path.exists(path):
+            try:
+                model = IntentModel.load(path)
+                logger.info(f"local intent model loaded from {path} ({model.info.get('examples', '?')} examples)")
+            except Exception as e:
+                logger.warning(f"could not load the local intent model {path}: {e}")
+        return cls(model, **kwargs)
+
+    def classify(self, query: str, history: str, fallback: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """ The local model's classification if it is sure enough, otherwise fallback()'s, which is logged"""
+
+        local = None
+        if self.model is not None:
+            start = time.perf_counter()
+            with span("classify_local", model="intent_model") as local_span:
+                local = self.model.predict(query, history)
+                coverage = self.model.coverage(query)
+                local_span.set(query_type=local[0], confidence=local[1], coverage=coverage)
+            latency = time.perf_counter() - start
+
+            if coverage < self.min_coverage:
+                outcome = "unfamiliar"
+                local = None
+            elif local[1] < self.min_confidence:
+                outcome = "unsure"
+            elif random.random() < self.audit_rate:
+                outcome = "audited"
+            else:
+                outcome = "accepted"
+            metrics.inc("blockagent_intent_local_total", outcome=outcome)
+            with self.lock:
+                self.stats[outcome] += 1
+                self.total_latency += latency
+            if outcome == "accepted":
+                return {"query_type": local[0], "confidence": local[1], "tier": "local"}
+
+        classification = fallback()
+        self.log.append(query, history, classification, local)
+        if local is not None and local[1] >= self.min_confidence:
+            agree = "yes" if local[0] == classification.get("query_type") else "no"
+            metrics.inc("blockagent_intent_local_agreement_total", agree=agree)
+            with self.lock:
+                self.stats[f"agree_{agree}"] += 1
+        return classification
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ How much traffic the local model answers, how fast, and how often the audited answers match the llm"""
+
+        with self.lock:
+            stats = dict(self.stats)
+            total_latency = self.total_latency
+        calls = sum(stats.get(outcome, 0) for outcome in ("accepted", "unsure", "audited", "unfamiliar"))
+        audited = stats.get("agree_yes", 0) + stats.get("agree_no", 0)
+        return {
+            "loaded": self.model is not None,
+            "calls": calls,
+            "accepted": stats.get("accepted", 0),
+            "unfamiliar": stats.get("unfamiliar", 0),
+            "hit_rate": stats.get("accepted", 0) / calls if calls else 0.0,
+            "avg_latency": total_latency / calls if calls else 0.0,
+            "audited": audited,
+            "agreement": stats.get("agree_yes", 0) / audited if audited else None
+        }
+
+
+def read_routing_log(path: str, min_label_confidence: float = MIN_LABEL_CONFIDENCE) -> List[Dict[str, Any]]:
+    """ The usable llm labels of a routing log and the one it rotated out, the latest one per (query, history)"""
+
+    lines = []
+    for part in (f"{path}.1", path):
+        if os.path.exists(part):
+            with open(part) as f:
+                lines.extend(f)
+
+    examples = {}
+    for line in lines:
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        if row.get("query_type") not in QUERY_TYPES or row.get("confidence", 0.0) < min_label_confidence:
+            continue
+        history = row.get("history") or ""
+        examples[(normalize_query(row["query"]), history[-HISTORY_CHARS:])] = row
+    return list(examples.values())
+
+
+def split(example: Dict[str, Any]) -> str:
+    """ "train", "calibration" or "test", by query so the same question never ends up in two of them"""
+
+    bucket = zlib.crc32(normalize_query(example["query"]).encode()) % 100
+    if bucket < TEST_PERCENT:
+        return "test"
+    if bucket < TEST_PERCENT + CALIBRATION_PERCENT:
+        return "calibration"
+    return "train"
+
+
+def design_matrix(examples: List[Dict[str, Any]], bits: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ (rows, columns, values) of the sparse feature matrix"""
+
+    rows, columns, values = [], [], []
+    for row, example in enumerate(examples):
+        indices, counts = featurize(example["query"], example.get("history") or "", bits)
+        rows.append(np.full(len(indices), row, dtype=np.int64))
+        columns.append(indices)
+        values.append(counts)
+    return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+
+def sparse_logits(rows, columns, values, weights, bias, n: int) -> np.ndarray:
+    return np.stack([np.bincount(rows, weights=values * weights[columns, k], minlength=n)
+                     for k in range(weights.shape[1])], axis=1) + bias
+
+
+def fit(examples: List[Dict[str, Any]], labels: Tuple[str, ...] = QUERY_TYPES, bits: int = FEATURE_BITS,
+        epochs: int = 200, learning_rate: float = 0.5, l2: float = 1e-4) -> IntentModel:
+    """ Full batch AdaGrad on the softmax cross entropy, only over the features the examples actually use"""
+
+    n = len(examples)
+    targets = np.array([labels.index(example["query_type"]) for example in examples])
+    rows, columns, values = design_matrix(examples, bits)
+    used, compact = np.unique(columns, return_inverse=True)
+
+    # rarer classes weigh more, conversation queries are a small part of the traffic
+    class_counts = np.bincount(targets, minlength=len(labels))
+    sample_weights = (n / (len(labels) * np.maximum(class_counts, 1)))[targets] / n
+
+    weights = np.zeros((len(used), len(labels)))
+    bias = np.zeros(len(labels))
+    weight_history = np.full_like(weights, 1e-8)
+    bias_history = np.full_like(bias, 1e-8)
+    for _ in range(epochs):
+        errors = softmax(sparse_logits(rows, compact, values, weights, bias, n))
+        errors[np.arange(n), targets] -= 1
+        errors *= sample_weights[:, None]
+
+        weight_gradient = np.stack([np.bincount(compact, weights=values * errors[rows, k], minlength=len(used))
+                                    for k in range(len(labels))], axis=1) + l2 * weights
+        bias_gradient = errors.sum(axis=0)
+        weight_history += weight_gradient ** 2
+        bias_history += bias_gradient ** 2
+        weights -= learning_rate * weight_gradient / np.sqrt(weight_history)
+        bias -= learning_rate * bias_gradient / np.sqrt(bias_history)
+
+    full_weights = np.zeros((1 << bits, len(labels)), dtype=np.float32)
+    full_weights[used] = weights
+    return IntentModel(full_weights, bias.astype(np.float32), list(labels), bits=bits)
+
+
+def calibrate(model: IntentModel, examples: List[Dict[str, Any]]) -> float:
+    """ The temperature >= 1 with the lowest negative log likelihood on examples, the model is not refitted"""
+
+    if len(examples) < MIN_CALIBRATION_EXAMPLES:
+        raise ValueError(f"{len(examples)} calibration examples, at least {MIN_CALIBRATION_EXAMPLES} are needed")
+    rows, columns, values = design_matrix(examples, model.bits)
+    logits = sparse_logits(rows, columns, values, model.weights, model.bias, len(examples))
+    targets = np.array([model.labels.index(example["query_type"]) for example in examples])
+
+    def nll(temperature: float) -> float:
+        probabilities = softmax(logits / temperature)[np.arange(len(examples)), targets]
+        return float(-np.log(np.maximum(probabilities, 1e-12)).mean())
+
+    return float(min(TEMPERATURES, key=nll))
+
+
+def evaluate(model: IntentModel, examples: List[Dict[str, Any]], thresholds: Tuple[float, ...] = EVAL_THRESHOLDS,
+             min_coverage: float = INTENT_MIN_COVERAGE) -> Dict[str, Any]:
+    """ Agreement with the llm labels overall and per threshold, the per label confusion and the calibration error.
+        Coverage per threshold only counts the queries the classifier would route, familiar enough and sure enough
+    """
+
+    if not examples:
+        return {"examples": 0}
+
+    start = time.perf_counter()
+    predictions = [model.predict(example["query"], example.get("history") or "") for example in examples]
+    latency = (time.perf_counter() - start) / len(examples)
+
+    correct = np.array([predicted == example["query_type"] for (predicted, _), example in zip(predictions, examples)])
+    confidences = np.array([confidence for _, confidence in predictions])
+    familiar = np.array([model.coverage(example["query"]) >= min_coverage for example in examples])
+
+    by_threshold = []
+    for threshold in thresholds:
+        covered = (confidences >= threshold) & familiar
+        by_threshold.append({"threshold": threshold,
+                             "coverage": float(covered.mean()),
+                             "accuracy": float(correct[covered].mean()) if covered.any() else None})
+
+    # expected calibration error over 10 equal width confidence bins
+    bins = np.minimum((confidences * 10).astype(int), 9)
+    ece = sum(abs(correct[bins == b].mean() - confidences[bins == b].mean()) * (bins == b).mean()
+              for b in range(10) if (bins == b).any())
+
+    confusion = {label: Counter() for label in model.labels}
+    for (predicted, _), example in zip(predictions, examples):
+        confusion[example["query_type"]][predicted] += 1
+
+    return {
+        "examples": len(examples),
+        "accuracy": float(correct.mean()),
+        "familiar": float(familiar.mean()),
+        "expected_calibration_error": float(ece),
+        "avg_latency_us": latency * 1e6,
+        "thresholds": by_threshold,
+        "confusion": {label: dict(counts) for label, counts in confusion.items()}
+    }
+
+
+def print_evaluation(evaluation: Dict[str, Any]) -> None:
+    if not evaluation["examples"]:
+        print("no held out examples")
+        return
+    print(f"{evaluation['examples']} held out examples, accuracy {evaluation['accuracy']:.3f}, "
+          f"calibration error {evaluation['expected_calibration_error']:.3f}, "
+          f"{evaluation['familiar']:.3f} familiar, "
+          f"{evaluation['avg_latency_us']:.0f} us per query\n")
+    print(f"{'threshold':>10}{'coverage':>10}{'accuracy':>10}")
+    for row in evaluation["thresholds"]:
+        accuracy = f"{row['accuracy']:.3f}" if row["accuracy"] is not None else "-"
+        print(f"{row['threshold']:>10.2f}{row['coverage']:>10.3f}{accuracy:>10}")
+    print("\nllm label -> local prediction")
+    for label, counts in evaluation["confusion"].items():
+        print(f"  {label:<16}{json.dumps(counts)}")
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Train or evaluate the local intent model on the routing log")
+    parser.add_argument("command", choices=("train", "eval"))
+    parser.add_argument("log", nargs="?", default=ROUTING_LOG_PATH or DEFAULT_ROUTING_LOG, help="routing log JSONL")
+    parser.add_argument("model", nargs="?", default=INTENT_MODEL_PATH, help="model file, written by train")
+    parser.add_argument("--min-label-confidence", type=float, default=MIN_LABEL_CONFIDENCE,
+                        help="ignore llm labels below this confidence")
+    parser.add_argument("--epochs", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    splits = {"train": [], "calibration": [], "test": []}
+    for example in read_routing_log(args.log, args.min_label_confidence):
+        splits[split(example)].append(example)
+    train_examples, test_examples = splits["train"], splits["test"]
+
+    if args.command == "train":
+        if len({example["query_type"] for example in train_examples}) < 2:
+            raise SystemExit(f"{args.log} needs labelled examples of at least two query types to train on")
+        start = time.time()
+        model = fit(train_examples, epochs=args.epochs)
+        try:
+            model.temperature = calibrate(model, splits["calibration"])
+        except ValueError as e:
+            raise SystemExit(f"{args.log} is too small to calibrate a model on: {e}")
+        model.info = {"examples": len(train_examples), "calibration": len(splits["calibration"]),
+                      "trained_at": time.time(), "log": args.log}
+        model.save(args.model)
+        print(f"trained on {len(train_examples)} examples in {time.time() - start:.1f}s, "
+              f"temperature {model.temperature:.2f}, saved to {args.model}\n")
+    else:
+        model = IntentModel.load(args.model)
+
+    evaluation = evaluate(model, test_examples)
+    print_evaluation(evaluation)
+    return evaluation
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
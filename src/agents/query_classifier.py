@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import threading
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field, ValidationError
+from typing import Dict, Any, List, Optional
+
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from src.llm.llm_cache import get_llm_cache
+from src.llm.rate_limiter import get_llm_http_client
+from src.llm.micro_batcher import MicroBatcher
+from src.llm.prompts import static_prompt
+from src.monitoring.tracing import get_logger, metrics, span
+from src.monitoring.cassette import invoke_chat_model
+
+logger = get_logger("classifier")
+
+
+load_dotenv()
+
+OPENAI_KEY  = os.getenv('OPENAI_KEY')
+
+QUERY_TYPES = ("data_retrieval", "transaction", "conversation")
+
+# classifications arriving within this many ms of each other go to OpenAI as one request, 0 sends each on its own
+CLASSIFY_BATCH_WINDOW_MS = float(os.getenv("CLASSIFY_BATCH_WINDOW_MS", "10"))
+CLASSIFY_BATCH_MAX = int(os.getenv("CLASSIFY_BATCH_MAX", "16"))
+
+BATCH_INSTRUCTIONS = static_prompt("""
+        The user message now holds several numbered items, each with its own conversation history and user query.
+        Classify every item on its own, as if it were the only one. Instead of the single object above,
+        respond with a JSON object in the following format and nothing else, one entry per item:
+        {
+            "classifications": [
+                {"item": 1, "query_type": "data_retrieval" | "transaction" | "conversation", "confidence": 0.0 to 1.0}
+            ]
+        }
+        """)
+
+
+metrics.describe("blockagent_classifier_tier_total", "counter", "Classifications per cascade tier, by outcome")
+metrics.describe("blockagent_classifier_tier_seconds", "histogram", "Time one cascade tier took to classify")
+metrics.describe("blockagent_classifier_escalations_total", "counter", "Queries a cascade tier passed on to the next one")
+
+
+class QueryClassification(BaseModel):
+    query_type: str = Field(description="Type of query: 'subgraph query', 'transaction', or 'conversation'")
+    confidence: float = Field(description="Confidence score between 0.0 and 1.0")
+
+
+class CascadeTier(BaseModel):
+    """ One model in the classification cascade """
+
+    model_name: str = Field(description="OpenAI model used for this tier")
+    min_confidence: float = Field(description="Below this confidence the query is escalated to the next tier")
+
+
+class TierStats:
+    """ Running counters for one tier of the cascade """
+
+    def __init__(self):
+        self.calls = 0
+        self.accepted = 0
+        self.escalated = 0
+        self.malformed = 0
+        self.total_latency = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "accepted": self.accepted,
+            "escalated": self.escalated,
+            "malformed": self.malformed,
+            "hit_rate": self.accepted / self.calls if self.calls else 0.0,
+            "avg_latency": self.total_latency / self.calls if self.calls else 0.0
+        }
+
+
+class CascadeClassifier:
+    """ Classify with the cheapest model first and only escalate when it is unsure.
+
+        Every tier but the last one has to return valid json with a known query type and a confidence
+        at or above its threshold, otherwise the query goes to the next tier. The last tier's answer is
+        always used, the workflow then applies its own clarification threshold on top.
+    """
+
+    def __init__(self, tiers: List[CascadeTier]):
+        if not tiers:
+            raise ValueError("The cascade needs at least one tier")
+
+        self.tiers = tiers
+        self.llms = [ChatOpenAI(
+            model_name=tier.model_name,
+            openai_api_key=OPENAI_KEY,
+            temperature=0,
+            model_kwargs={"response_format": {"type": "json_object"}},
+            cache=get_llm_cache(),
+            http_client=get_llm_http_client()
+        ) for tier in tiers]
+
+        self.stats = [TierStats() for _ in tiers]
+        self.lock = threading.Lock()
+        # one micro-batcher per tier and system prompt, only calls with the same prompt can share a request
+        self.batchers: Dict[tuple, MicroBatcher] = {}
+
+    def parse(self, content: str) -> Optional[QueryClassification]:
+        """ Parse the tier's reply, None if it is not something we can route on"""
+
+        try:
+            classification = QueryClassification(**json.loads(content))
+        except (json.JSONDecodeError, TypeError, ValidationError):
+            return None
+
+        if classification.query_type not in QUERY_TYPES:
+            return None
+        return classification
+
+    def batcher(self, index: int, messages: List[Any]) -> Optional[MicroBatcher]:
+        if CLASSIFY_BATCH_WINDOW_MS <= 0 or not isinstance(messages[0], SystemMessage):
+            return None
+        key = (index, messages[0].content)
+        with self.lock:
+            if key not in self.batchers:
+                self.batchers[key] = MicroBatcher(
+                    f"classify_{self.tiers[index].model_name}",
+                    lambda batch: self.send_batch(index, batch),
+                    CLASSIFY_BATCH_WINDOW_MS / 1000, CLASSIFY_BATCH_MAX)
+            return self.batchers[key]
+
+    def send_batch(self, index: int, batch: List[List[Any]]) -> List[str]:
+        """ One request for all the message lists in batch (same system prompt), returns the reply json per item.
+
+            A batch of one goes out exactly as before, so the llm cache keeps working when traffic is low.
+            Items the batched reply leaves out or garbles are asked again on their own.
+        """
+
+        tier, llm = self.tiers[index], self.llms[index]
+        if len(batch) == 1:
+            with span("classify", kind="llm", model=tier.model_name, prompt="classify") as llm_span:
+                response = invoke_chat_model(llm, batch[0])
+                llm_span.record_usage(response)
+            return [response.content]
+
+        # the batch instructions go after the usual ones, so both kinds of request share the same prefix
+        system_prompt = batch[0][0].content + "\n\n" + BATCH_INSTRUCTIONS
+        user_message = "\n\n".join(f"Item {number}:\n" + "\n\n".join(message.content for message in messages[1:])
+                                   for number, messages in enumerate(batch, 1))
+        with span("classify_batch", kind="llm", model=tier.model_name, prompt="classify_batch",
+                  batch_size=len(batch)) as llm_span:
+            response = invoke_chat_model(llm, [SystemMessage(content=system_prompt), HumanMessage(content=user_message)])
+            llm_span.record_usage(response)
+
+        by_item = {}
+        try:
+            for entry in json.loads(response.content).get("classifications", []):
+                if isinstance(entry, dict) and isinstance(entry.get("item"), int):
+                    number = entry.pop("item")
+                    by_item[number] = json.dumps(entry)
+        except (json.JSONDecodeError, AttributeError):
+            logger.warning(f"batched classification reply was not valid json, asking the {len(batch)} items one by one")
+
+        results = []
+        for number, messages in enumerate(batch, 1):
+            if number not in by_item:
+                with span("classify", kind="llm", model=tier.model_name, prompt="classify") as llm_span:
+                    response = invoke_chat_model(llm, messages)
+                    llm_span.record_usage(response)
+                by_item[number] = response.content
+            results.append(by_item[number])
+        return results
+
+    def classify(self, messages: List[Any]) -> Dict[str, Any]:
+        """ Run the messages through the cascade, returns the classification json plus the tier that answered"""
+
+        last_tier = len(self.tiers) - 1
+        for index, (tier, llm) in enumerate(zip(self.tiers, self.llms)):
+            start = time.time()
+            batcher = self.batcher(index, messages)
+            if batcher is not None:
+                # the llm span is the batch's, recorded by whichever caller sent it
+                content = batcher.submit(messages)
+            else:
+                with span("classify", kind="llm", model=tier.model_name, prompt="classify") as llm_span:
+                    response = invoke_chat_model(llm, messages)
+                    llm_span.record_usage(response)
+                content = response.content
+            latency = time.time() - start
+
+            classification = self.parse(content)
+            stats = self.stats[index]
+
+            if classification is None:
+                outcome = "malformed"
+            elif classification.confidence >= tier.min_confidence or index == last_tier:
+                outcome = "accepted"
+            else:
+                outcome = "unsure"
+            metrics.inc("blockagent_classifier_tier_total", tier=tier.model_name, outcome=outcome)
+            metrics.observe("blockagent_classifier_tier_seconds", latency, tier=tier.model_name)
+
+            with self.lock:
+                stats.calls += 1
+                stats.total_latency += latency
+
+                if outcome == "malformed":
+                    stats.malformed += 1
+                elif outcome == "accepted":
+                    stats.accepted += 1
+                    return {**classification.model_dump(), "tier": tier.model_name}
+
+                if index < last_tier:
+                    stats.escalated += 1
+
+            if index < last_tier:
+                metrics.inc("blockagent_classifier_escalations_total", tier=tier.model_name)
+                logger.info(f"{tier.model_name} was not sure about the query, escalating")
+
+        # the last tier could not produce a valid classification either, the workflow asks the user to clarify
+        logger.warning(f"{self.tiers[-1].model_name} did not return a valid classification, treating the query as unknown")
+        return {"query_type": "unknown", "confidence": 0.0, "tier": self.tiers[-1].model_name}
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """ Hit rate and latency per tier"""
+
+        with self.lock:
+            return {tier.model_name: stats.as_dict() for tier, stats in zip(self.tiers, self.stats)}
+
+    def get_batch_stats(self) -> Dict[str, Dict[str, Any]]:
+        """ Batch sizes and added wait per micro-batcher"""
+
+        with self.lock:
+            batchers = list(self.batchers.values())
+        return {batcher.name: batcher.get_stats() for batcher in batchers}
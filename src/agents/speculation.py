@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Optional, Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from src.memory.memory_utils import Message, MessagesMemory
+from src.llm.rate_limiter import llm_priority, PRIORITY_SPECULATIVE
+from src.monitoring.tracing import get_logger
+
+logger = get_logger("speculation")
+
+
+# The extraction system prompts are ~300 tokens each, the history and query come on top of that.
+# This is only used to charge the speculation budget, so a rough estimate is fine.
+EXTRACTION_PROMPT_TOKENS = 300
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token count, ~4 characters per token for english text"""
+
+    return len(text) // 4
+
+
+class SpeculationPolicy(BaseModel):
+    """ Knobs for starting the agents' parameter extraction at the same time as classification """
+
+    enabled: bool = Field(default_factory=lambda: os.getenv("BLOCKAGENT_SPECULATIVE", "0") == "1",
+                          description="Run extraction alongside classification instead of after it")
+    routes: List[str] = Field(default_factory=lambda: ["data_retrieval", "transaction"],
+                              description="Routes whose extraction is started speculatively")
+    prefetch_subgraph_data: bool = Field(default=True,
+                                         description="Also run the subgraph query once the speculative extraction is back")
+    max_wasted_tokens_per_minute: int = Field(default=20000,
+                                              description="Stop speculating once the losing branches burnt this many tokens in the last minute")
+
+
+class SpeculativeTurn:
+    """ The speculative branches started for a single turn """
+
+    def __init__(self, branches: Dict[str, Future], token_estimates: Dict[str, int], cancelled: Dict[str, threading.Event]):
+        self.branches = branches
+        self.token_estimates = token_estimates
+        # set for the losing branches, so they can skip their follow up work
+        self.cancelled = cancelled
+
+
+class Speculator:
+    """ Starts the extraction for every candidate route while the coordinator is still classifying.
+        Once the route is known, the winning branch is kept and the others are cancelled.
+    """
+
+    def __init__(self, branch_functions: Dict[str, Callable[[str, str, threading.Event], Dict[str, Any]]],
+                 policy: Optional[SpeculationPolicy] = None):
+        self.policy = policy or SpeculationPolicy()
+        self.branch_functions = branch_functions
+        self.executor = ThreadPoolExecutor(max_workers=max(len(branch_functions), 1) * 4,
+                                           thread_name_prefix="speculation")
+
+        # (timestamp, tokens) of branches we threw away, used for the spend cap
+        self.wasted = deque()
+        self.lock = threading.Lock()
+
+    def wasted_tokens_last_minute(self) -> int:
+        """ Tokens spent on losing branches within the last 60 seconds"""
+
+        cutoff = time.time() - 60
+        with self.lock:
+            while self.wasted and self.wasted[0][0] < cutoff:
+                self.wasted.popleft()
+            return sum(tokens for _, tokens in self.wasted)
+
+    def launch(self, query: str, memory: MessagesMemory) -> Optional[SpeculativeTurn]:
+        """ Start the extraction branches for this turn, returns None if we are not speculating"""
+
+        if not self.policy.enabled:
+            return None
+
+        if self.wasted_tokens_last_minute() >= self.policy.max_wasted_tokens_per_minute:
+            logger.info("speculation budget used up, running sequentially")
+            return None
+
+        # classify_query and then the agent both add the user message before the agent reads the history,
+        # so the speculative prompt is built from the history as it will look at that point
+        pending = [Message(role="user", content=query), Message(role="user", content=query)]
+        conversation_history = memory.preview_message_history(pending)
+
+        branches = {}
+        token_estimates = {}
+        cancelled = {}
+        for route in self.policy.routes:
+            branch_function = self.branch_functions.get(route)
+            if branch_function is None:
+                continue
+            cancelled[route] = threading.Event()
+            # each branch gets its own copy of the context so its spans land in this turn's trace
+            context = contextvars.copy_context()
+            branches[route] = self.executor.submit(context.run, self.run_branch, branch_function, query,
+                                                   conversation_history, cancelled[route])
+            token_estimates[route] = EXTRACTION_PROMPT_TOKENS + estimate_tokens(conversation_history + query)
+
+        return SpeculativeTurn(branches, token_estimates, cancelled)
+
+    @staticmethod
+    def run_branch(branch_function, query: str, conversation_history: str, cancelled: threading.Event) -> Dict[str, Any]:
+        # the route is not known yet, so the llm calls queue behind everything a user is waiting on
+        with llm_priority(PRIORITY_SPECULATIVE):
+            return branch_function(query, conversation_history, cancelled)
+
+    def resolve(self, turn: Optional[SpeculativeTurn], route: Optional[str]) -> None:
+        """ Keep the branch for the winning route and cancel the others"""
+
+        if turn is None:
+            return
+
+        now = time.time()
+        for branch_route, future in turn.branches.items():
+            if branch_route == route:
+                continue
+            turn.cancelled[branch_route].set()
+            # a branch that already started still sends its request, we only save the follow up work
+            if not future.cancel():
+                with self.lock:
+                    self.wasted.append((now, turn.token_estimates[branch_route]))
+
+    def claim(self, turn: Optional[SpeculativeTurn], route: str) -> Optional[Dict[str, Any]]:
+        """ Wait for the winning branch, None means the agent has to run the extraction itself"""
+
+        if turn is None or route not in turn.branches:
+            return None
+
+        try:
+            return turn.branches[route].result()
+        except Exception as e:
+            logger.warning(f"speculative branch for {route} failed, running it again: {e}")
+            return None
+
+
+def subgraph_branch(subgraph_agent, policy: SpeculationPolicy):
+    """ Speculative branch for data retrieval: extraction, then optionally the subgraph query itself"""
+
+    def run(query: str, conversation_history: str, cancelled: threading.Event) -> Dict[str, Any]:
+        speculation = {"extraction": subgraph_agent.extract_parameters(query, conversation_history)}
+
+        if policy.prefetch_subgraph_data and not cancelled.is_set():
+            try:
+                extracted_data = json.loads(speculation["extraction"])
+            except json.JSONDecodeError:
+                return speculation
+            speculation["result"] = subgraph_agent.execute_query(extracted_data.get("query_type", "unknown"),
+                                                                 extracted_data.get("parameters", {}))
+        return speculation
+
+    return run
+
+
+def transaction_branch(transaction_agent):
+    """ Speculative branch for transactions, only the extraction, nothing is simulated before we know the route"""
+
+    def run(query: str, conversation_history: str, cancelled: threading.Event) -> Dict[str, Any]:
+        return {"extraction": transaction_agent.extract_parameters(query, conversation_history)}
+
+    return run
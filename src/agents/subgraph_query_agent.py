@@ -2,9 +2,8 @@ import os
 import json
 from openai import OpenAI
 from dotenv import load_dotenv
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
 
 load_dotenv()
 
@@ -13,26 +12,16 @@ OPENAI_KEY  = os.getenv('OPENAI_KEY')
 
 from src.blockchain.graph_utils import GraphTools
 from src.memory.memory_utils import MessagesMemory
+from src.llm.llm_cache import get_llm_cache
+from src.llm.rate_limiter import get_llm_http_client, llm_priority, PRIORITY_EXTRACTION
+from src.llm.result_compactor import result_compactor
+from src.llm.prompts import PromptTemplate
+from src.monitoring.tracing import get_logger, span
+from src.monitoring.cassette import invoke_chat_model, create_chat_completion
 
-class SubGraphAgent:
-    def __init__(self):
-        self.client = OpenAI(api_key=OPENAI_KEY)
-        self.graph_tools = GraphTools()
-        self.subgraph_llm = ChatOpenAI(
-            model_name = MODEL_NAME, 
-            openai_api_key = OPENAI_KEY,
-            temperature=0,
-            model_kwargs={"response_format": {"type": "json_object"}}
-        )
-    
-    def process_query(self, query: str, memory: MessagesMemory) -> Dict[str, Any]:
-        """Process a data retrieval query using The Graph"""
-
+logger = get_logger("subgraph_agent")
 
-        print("inside subgraph query agent")
-        memory.add_message("user", query)
-        
-        system_prompt = """
+EXTRACTION_PROMPT = PromptTemplate("subgraph_extraction", """
         You are a specialized agent that extarcts parameters from user queries for blockchain data retrieval.
         Your task is to identify what data the user is looking for and extract relevant parameters.
         
@@ -53,50 +42,79 @@ class SubGraphAgent:
             "query_type": "unknown",
             "parameters": {}
         }
+
+        Based on the conversation history and the user's query that follow, extract the necessary parameters.
+        """)
+
+RESPONSE_PROMPT = PromptTemplate("subgraph_response", """
+        You are a helpful assistant that explains blockchain data in a clear way.
+
+        You get the data retrieved for the user's query, followed by the query. Based on the data,
+        generate a natural language response explaining the results.
+        If the data has an "as_of" time, mention how current it is. If it has a "degraded" note, tell the
+        user the live source is not responding and this is the last data we have.
+        Format the response in a conversational, helpful manner.
+        """)
+
+class SubGraphAgent:
+    def __init__(self):
+        self.client = OpenAI(api_key=OPENAI_KEY, http_client=get_llm_http_client())
+        self.graph_tools = GraphTools()
+        # set by the workflow when the hot pair prefetcher runs, same methods as graph_tools
+        self.hot_data = None
+        self.subgraph_llm = ChatOpenAI(
+            model_name = MODEL_NAME, 
+            openai_api_key = OPENAI_KEY,
+            temperature=0,
+            model_kwargs={"response_format": {"type": "json_object"}},
+            cache=get_llm_cache(),
+            http_client=get_llm_http_client()
+        )
+    
+    def extract_parameters(self, query: str, conversation_history: str) -> str:
+        """ Ask the llm for the query type and parameters, returns the raw json string"""
+
+        messages = EXTRACTION_PROMPT.chat_messages(query=query, history=conversation_history)
+        with llm_priority(PRIORITY_EXTRACTION), span("subgraph_extraction", kind="llm", model=MODEL_NAME,
+                                                           prompt=EXTRACTION_PROMPT.name) as llm_span:
+            response = invoke_chat_model(self.subgraph_llm, messages)
+            llm_span.record_usage(response)
+        return response.content
+
+    def process_query(self, query: str, memory: MessagesMemory, speculation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Process a data retrieval query using The Graph
+
+        speculation holds the extraction (and optionally the subgraph result) that was
+        started alongside classification, see src/agents/speculation.py
         """
-        
-        conversation_history = memory.get_message_history()
-        user_message = f"""
-        Based on the conversation history and the user's query, extract the necessary parameters:
-        
-        Conversation history:
-        {conversation_history}
-        
-        User query: {query}
-        """
-        
 
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=user_message)
-        ]
-        response = self.subgraph_llm.invoke(messages)
 
+        logger.debug("inside subgraph query agent")
+        memory.add_message("user", query)
+
+        if speculation and "extraction" in speculation:
+            extraction = speculation["extraction"]
+        else:
+            extraction = self.extract_parameters(query, memory.get_message_history())
       
         try:
-            extracted_data = json.loads(response.content)
+            extracted_data = json.loads(extraction)
             query_type = extracted_data.get("query_type", "unknown")
             parameters = extracted_data.get("parameters", {})
 
-            result = self.execute_query(query_type, parameters)
-            
-            response_prompt = f"""
-            The user asked: "{query}"
-            
-            Based on the data retrieved, generate a natural language response explaining the results:
-            
-            {json.dumps(result, indent=2)}
-            
-            Format the response in a conversational, helpful manner.
-            """
+            if speculation and "result" in speculation:
+                result = speculation["result"]
+            else:
+                result = self.execute_query(query_type, parameters)
             
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that explains blockchain data in a clear way."},
-                    {"role": "user", "content": response_prompt}
-                ]
-            )
+            with span("subgraph_response", kind="llm", model=MODEL_NAME, prompt=RESPONSE_PROMPT.name) as llm_span:
+                response = create_chat_completion(
+                    self.client,
+                    model=MODEL_NAME,
+                    messages=RESPONSE_PROMPT.openai_messages(query=query,
+                                                             context=result_compactor.compact(result, query_type))
+                )
+                llm_span.record_usage(response)
             
             agent_response = response.choices[0].message.content
             
@@ -123,14 +141,14 @@ class SubGraphAgent:
 
                 token0 = parameters.get("token0", "")
                 token1 = parameters.get("token1", "")
-                print("getting liquidity for {} and {}".format(token0, token1))
-                result_subgraph_query  =  self.graph_tools.get_pool_liquidity(token0, token1)
+                logger.info("getting liquidity for {} and {}".format(token0, token1))
+                result_subgraph_query  =  (self.hot_data or self.graph_tools).get_pool_liquidity(token0, token1)
                 return result_subgraph_query
             
             elif query_type == "recent_swaps":
                 token = parameters.get("token", "")
                 limit = parameters.get("limit", 5)
-                return self.graph_tools.get_recent_swaps(token, limit)
+                return (self.hot_data or self.graph_tools).get_recent_swaps(token, limit)
             
             else:
                 return {"error": "Unknown query type"}
@@ -1,10 +1,9 @@
 import os
 import json
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from openai import OpenAI
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
 
 
 load_dotenv()
@@ -14,26 +13,19 @@ OPENAI_KEY  = os.getenv('OPENAI_KEY')
 
 
 from src.blockchain.transaction import Web3UHelperClass
+from src.blockchain.graph_utils import GraphTools
+from src.blockchain.portfolio import get_portfolio
 from src.memory.memory_utils import MessagesMemory
+from src.llm.llm_cache import get_llm_cache
+from src.llm.rate_limiter import get_llm_http_client, llm_priority, PRIORITY_EXTRACTION
+from src.llm.result_compactor import result_compactor
+from src.llm.prompts import PromptTemplate
+from src.monitoring.tracing import get_logger, span
+from src.monitoring.cassette import invoke_chat_model, create_chat_completion
 
-class TransactionAgent:
-    def __init__(self):
-        self.web3_tools = Web3UHelperClass()
-        # to inteact with the user after transaction
-        self.client = OpenAI(api_key=OPENAI_KEY)
-        self.transaction_llm = ChatOpenAI(
-        model_name=MODEL_NAME,
-        openai_api_key=OPENAI_KEY,
-        temperature=0,
-        model_kwargs={"response_format": {"type": "json_object"}}
-        )
-    
-    def process_transaction(self, query: str, memory: MessagesMemory) -> Dict[str, Any]:
-        """Process a transaction request"""
+logger = get_logger("transaction_agent")
 
-        memory.add_message("user", query)
-        
-        system_prompt = """
+EXTRACTION_PROMPT = PromptTemplate("transaction_extraction", """
         You are a specialized agent that extracts transaction parameters from user queries for blockchain transactions.
         Your task is to identify what transaction the user wants to perform and extract relevant parameters.
         You will also make sure the transaction should be feasible in reality, even though we are doing a simulation.
@@ -42,10 +34,12 @@ class TransactionAgent:
         Supported transaction types:
         1. Token swap - requires token_in, token_out, amount_in
         2. Token balance check - requires token symbol
+        3. Portfolio - all balances and what they are worth together, no parameters. Use this whenever the user
+           asks about more than one balance or the value of their holdings
         
         Return a JSON object with the following structure:
         {
-            "transaction_type": "token_swap" | "token_balance",
+            "transaction_type": "token_swap" | "token_balance" | "portfolio",
             "parameters": {
                 
             },
@@ -60,25 +54,74 @@ class TransactionAgent:
             "parameters": {},
             "missing_parameters": []
         }
-        """
-        
-        conversation_history = memory.get_message_history()
 
-        user_message = f"""
-        Based on the conversation history and the user's query, extract the necessary parameters:
-        
-        Conversation history:
-        {conversation_history}
-        
-        User query: {query}
+        Based on the conversation history and the user's query that follow, extract the necessary parameters.
+        """)
+
+MISSING_PARAMETERS_PROMPT = PromptTemplate("transaction_missing_parameters", """
+        You are a helpful assistant that guides users through blockchain transactions.
+
+        The user wants to perform a transaction, but some parameters are missing. You get the conversation
+        history, the transaction and its missing parameters, and the current query. Generate a natural
+        language response asking for the missing parameters.
+        Keep your response conversational and helpful.
+        """)
+
+RESPONSE_PROMPT = PromptTemplate("transaction_response", """
+        You are a helpful assistant that explains blockchain transactions in a clear way.
+
+        You get the result of the user's transaction, followed by their query. Generate a natural language
+        response explaining the transaction result. Make sure to not reveal any sensitive or private data,
+        like private keys. Also display the hash if the transaction was successful.
+        If the result has an "as_of" time, mention how current it is. If it has a "degraded" note, tell the
+        user the live source is not responding and this is the last data we have.
+        Format the response in a conversational, helpful manner.
+        """)
+
+class TransactionAgent:
+    def __init__(self):
+        self.web3_tools = Web3UHelperClass()
+        # pool data for the portfolio prices
+        self.graph_tools = GraphTools()
+        # set by the workflow when the hot pair prefetcher runs, serves warm quotes for simulate_swap and pools for portfolio
+        self.hot_data = None
+        # to inteact with the user after transaction
+        self.client = OpenAI(api_key=OPENAI_KEY, http_client=get_llm_http_client())
+        self.transaction_llm = ChatOpenAI(
+        model_name=MODEL_NAME,
+        openai_api_key=OPENAI_KEY,
+        temperature=0,
+        model_kwargs={"response_format": {"type": "json_object"}},
+        cache=get_llm_cache(),
+        http_client=get_llm_http_client()
+        )
+    
+    def extract_parameters(self, query: str, conversation_history: str) -> str:
+        """ Ask the llm for the transaction type and parameters, returns the raw json string"""
+
+        messages = EXTRACTION_PROMPT.chat_messages(query=query, history=conversation_history)
+
+        with llm_priority(PRIORITY_EXTRACTION), span("transaction_extraction", kind="llm", model=MODEL_NAME,
+                                                           prompt=EXTRACTION_PROMPT.name) as llm_span:
+            response = invoke_chat_model(self.transaction_llm, messages)
+            llm_span.record_usage(response)
+        return response.content
+
+    def process_transaction(self, query: str, memory: MessagesMemory, speculation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Process a transaction request
+
+        speculation holds the extraction that was started alongside classification, see src/agents/speculation.py
         """
-        messages = [SystemMessage(content=system_prompt),
-                    HumanMessage(content=user_message)]
-        
-        response = self.transaction_llm.invoke(messages)
+
+        memory.add_message("user", query)
+
+        if speculation and "extraction" in speculation:
+            extraction = speculation["extraction"]
+        else:
+            extraction = self.extract_parameters(query, memory.get_message_history())
 
         try:
-            extracted_data = json.loads(response.content)
+            extracted_data = json.loads(extraction)
 
             transaction_type = extracted_data.get("transaction_type", "unknown")
             parameters = extracted_data.get("parameters", {})
@@ -92,22 +135,17 @@ class TransactionAgent:
             if missing_parameters:
 
                 # Generate a response asking for missing parameters
-                response_prompt = f"""
-                The user wants to perform a {transaction_type} transaction, but some parameters are missing.
-                Missing parameters: {', '.join(missing_parameters)}
-                
-                Based on the conversation history and the current query, generate a natural language response asking for the missing parameters.
-                Keep your response conversational and helpful.
-                """
-                print("We had a missing param")
-                print(missing_parameters)
-                response = self.client.chat.completions.create(
-                    model=MODEL_NAME,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant that guides users through blockchain transactions."},
-                        {"role": "user", "content": response_prompt}
-                    ]
-                )
+                logger.info(f"We had a missing param: {missing_parameters}")
+                with span("transaction_missing_parameters", kind="llm", model=MODEL_NAME,
+                          prompt=MISSING_PARAMETERS_PROMPT.name) as llm_span:
+                    response = create_chat_completion(
+                        self.client,
+                        model=MODEL_NAME,
+                        messages=MISSING_PARAMETERS_PROMPT.openai_messages(
+                            query=query, history=memory.get_message_history(),
+                            context=f"Transaction: {transaction_type}\nMissing parameters: {', '.join(missing_parameters)}")
+                    )
+                    llm_span.record_usage(response)
                 
                 agent_response = response.choices[0].message.content
                 memory.add_message("assistant", agent_response)
@@ -122,27 +160,14 @@ class TransactionAgent:
             
             result = self.execute_transaction(transaction_type, parameters)
             
-            response_prompt = f"""
-            The user asked: "{query}"
-            
-            Generate a natural language response explaining the transaction result. Make sure to not reveal any
-            sensitive or private data, like private keys. 
-            Also display the hash if the transaction was successful 
-            {json.dumps(result, indent=2)}
-            
-            Format the response in a conversational, helpful manner.
-            """
-
-            # messages = [SystemMessage(content="You are a helpful assistant that explains blockchain transactions in a clear and concise way."),
-            #             HumanMessage(content=response_prompt)]
-            
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that explains blockchain transactions in a clear way."},
-                    {"role": "user", "content": response_prompt}
-                ]
-            )
+            with span("transaction_response", kind="llm", model=MODEL_NAME, prompt=RESPONSE_PROMPT.name) as llm_span:
+                response = create_chat_completion(
+                    self.client,
+                    model=MODEL_NAME,
+                    messages=RESPONSE_PROMPT.openai_messages(query=query,
+                                                             context=result_compactor.compact(result, transaction_type))
+                )
+                llm_span.record_usage(response)
             agent_response = response.choices[0].message.content
             memory.add_message("assistant", agent_response)
             
@@ -156,7 +181,7 @@ class TransactionAgent:
             
         except Exception as e:
             error_message = f"Error processing transaction: {str(e)}"
-            print(error_message)
+            logger.error(error_message)
 
             memory.add_message("assistant", error_message)
             return {
@@ -173,11 +198,15 @@ class TransactionAgent:
 
                 # I am not doing an actual transaction here, the gas is estimated, 
                 # and most of the exchange values are hardcode
-                return self.web3_tools.simulate_swap(token_in, token_out, amount_in)
+                return (self.hot_data or self.web3_tools).simulate_swap(token_in, token_out, amount_in)
             
             elif transaction_type == "token_balance":
                 token_symbol = parameters.get("token_symbol", "")
                 return self.web3_tools.get_token_balance(token_symbol)
+
+            elif transaction_type == "portfolio":
+                # every balance and price in one turn, fetched concurrently
+                return get_portfolio(self.web3_tools, self.hot_data or self.graph_tools)
             
             else:
                 return {"error": "Unknown transaction type"}
@@ -1,29 +1,60 @@
 import os
-import json
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
 from langgraph.graph import StateGraph, END
 from typing import Dict, Any, List, Optional, TypedDict
 
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
 
 
 load_dotenv()
 
 MODEL_NAME = "gpt-4-turbo"
+SMALL_MODEL_NAME = "gpt-4o-mini"
 OPENAI_KEY  = os.getenv('OPENAI_KEY')
 
+# I realised most queries where classification was correct were > 0.8
+CONFIDENCE_THRESHOLD = 0.7
+
 
 from src.agents.subgraph_query_agent import SubGraphAgent
 from src.memory.memory_utils import MessagesMemory
 from src.agents.transaction_agent import TransactionAgent
 from src.agents.conversation_agent import ConversationAgent
+from src.agents.speculation import Speculator, SpeculationPolicy, subgraph_branch, transaction_branch
+from src.agents.query_classifier import CascadeClassifier, CascadeTier
+from src.agents.intent_model import LocalIntentClassifier
+from src.blockchain.prefetcher import HotDataPrefetcher, PREFETCH_ENABLED
+from src.blockchain.local_store import SubgraphSync, LOCAL_STORE_SYNC
+from src.blockchain.swap_logs import SwapLogWatcher, SWAP_LOGS_ENABLED
+from src.llm.prompts import PromptTemplate
+from src.serving.admission import AdmissionController, Overloaded
+from src.monitoring.tracing import get_logger, trace, traced_node
+
+logger = get_logger("workflow")
+
+CLASSIFY_PROMPT = PromptTemplate("classify", """
+        You are a coordinator agent that routes user queries to specialized agents.
+        Your task is to determine whether a query is related to data retrieval, 
+        transaction execution or or general conversation. Do not just use keywords like "swap", "liquidity", etc 
+        to decide the type of query, but actually understand the menaing of the user query, are they specifcally asking 
+        to do a data_retrieval/transaction or just inquiring about it 
+        
+        Respond with a JSON object in the following format and nothing else:
+        {
+            "query_type": "data_retrieval" | "transaction" | "conversation",
+            "confidence": 0.0 to 1.0
+        }
+        
+        Examples:
+        - "Get me the liquidity for ETH/USDC pool" -> data_retrieval
+        - "Show me the current price of ETH" -> data_retrieval
+        - "I want to swap 1 ETH for USDC" -> transaction
+        - "Check my ETH balance" -> transaction
+        - "Hello, how are you?" -> conversation
+        - "Good morning" -> conversation
+        - "Can you help me with something?" -> conversation
 
-
-class QueryClassification(BaseModel):
-    query_type: str = Field(description="Type of query: 'subgraph query', 'transaction', or 'conversation'")
-    confidence: float = Field(description="Confidence score between 0.0 and 1.0")
+        Based on the conversation history and the user query that follow, determine the query type.
+        """)
 
 class GraphState(TypedDict):
     """ The state class """
@@ -35,19 +66,53 @@ class GraphState(TypedDict):
     missing_parameters: List[str]
     results: Dict[str, Any]
     status: str
+    # the speculative extraction branches for this turn, if any
+    speculation: Optional[Any]
 
 class BlockAgentFlow:
-    def __init__(self):
+    def __init__(self, speculation_policy: Optional[SpeculationPolicy] = None,
+                 classifier_tiers: Optional[List[CascadeTier]] = None):
         self.subgraph_agent = SubGraphAgent()
         self.transaction_agent = TransactionAgent()
         self.conversation_agent = ConversationAgent()
 
-        self.llm = ChatOpenAI(
-        model_name=MODEL_NAME,
-        openai_api_key=OPENAI_KEY,
-        temperature=0,
-        model_kwargs={"response_format": {"type": "json_object"}}
-        )
+        # keeps the local tokens / pools / swaps copy current, when LOCAL_STORE_PATH is set
+        self.store_sync = None
+        graph_tools = self.subgraph_agent.graph_tools
+        if graph_tools.local_store is not None and LOCAL_STORE_SYNC:
+            self.store_sync = SubgraphSync(graph_tools.local_store, graph_tools.client).start()
+
+        # recent swaps from the chain's Swap events, ahead of the subgraph's indexing
+        self.swap_logs = None
+        if SWAP_LOGS_ENABLED:
+            self.swap_logs = SwapLogWatcher(self.transaction_agent.web3_tools).start()
+            graph_tools.swap_logs = self.swap_logs
+
+        # keeps the popular pairs' pool data, swaps and quotes warm for both agents
+        self.hot_data = None
+        if PREFETCH_ENABLED:
+            self.hot_data = HotDataPrefetcher(self.subgraph_agent.graph_tools, self.transaction_agent.web3_tools)
+            self.subgraph_agent.hot_data = self.hot_data
+            self.transaction_agent.hot_data = self.hot_data
+            self.hot_data.start()
+
+        # with speculation on, the agents' extraction runs at the same time as the classifier
+        speculation_policy = speculation_policy or SpeculationPolicy()
+        self.speculator = Speculator({
+            "data_retrieval": subgraph_branch(self.subgraph_agent, speculation_policy),
+            "transaction": transaction_branch(self.transaction_agent)
+        }, speculation_policy)
+
+        # the small model answers most queries, gpt-4-turbo only sees the ones it is unsure about
+        if classifier_tiers is None:
+            classifier_tiers = [CascadeTier(model_name=SMALL_MODEL_NAME, min_confidence=CONFIDENCE_THRESHOLD),
+                                CascadeTier(model_name=MODEL_NAME, min_confidence=0.0)]
+        self.classifier = CascadeClassifier(classifier_tiers)
+        # a model trained on the cascade's past decisions routes the queries it is sure about without any llm call
+        self.local_classifier = LocalIntentClassifier.from_path()
+
+        # concurrency caps for classification and each route, turns over the cap wait or are turned away
+        self.admission = AdmissionController()
       
         # define the graph
         self.workflow = self.create_workflow()
@@ -55,7 +120,10 @@ class BlockAgentFlow:
 
     def classify_condition_function(self, state: GraphState) -> str:
         """Return next step based on query classification."""
-        if self.is_subgraph_query(state):
+        if state["status"] == "clarification_needed":
+            # classify_query already wrote the clarifying question
+            return "clarification"
+        elif self.is_subgraph_query(state):
             return "subgraph_query"
         elif self.is_transaction_query(state):
             return "transaction_query"
@@ -75,11 +143,17 @@ class BlockAgentFlow:
 
 
         # define the nodes
-        workflow.add_node("classify_query", self.classify_query)
-        workflow.add_node("process_subgraph_query", self.process_subgraph_query)
-        workflow.add_node("process_transaction", self.process_transaction)
-        workflow.add_node("process_conversation_query", self.process_conversation_query)
-        workflow.add_node("send_response", self.send_response)
+        # every node run is a span of the turn's trace
+        # and runs inside a slot of its stage, see src/serving/admission.py
+        admitted = self.admission.admitted
+        workflow.add_node("classify_query", traced_node("classify_query", admitted("classify", self.classify_query)))
+        workflow.add_node("process_subgraph_query", traced_node("process_subgraph_query",
+                                                                admitted("data_retrieval", self.process_subgraph_query)))
+        workflow.add_node("process_transaction", traced_node("process_transaction",
+                                                             admitted("transaction", self.process_transaction)))
+        workflow.add_node("process_conversation_query", traced_node("process_conversation_query",
+                                                                    admitted("conversation", self.process_conversation_query)))
+        workflow.add_node("send_response", traced_node("send_response", self.send_response))
         
         # define edges
 
@@ -90,7 +164,8 @@ class BlockAgentFlow:
         {
             "subgraph_query": "process_subgraph_query",
             "transaction_query": "process_transaction",
-            "conversation_query": "process_conversation_query"
+            "conversation_query": "process_conversation_query",
+            "clarification": END
         }
         )
 
@@ -113,48 +188,21 @@ class BlockAgentFlow:
         query = state["query"]
         memory = state["conversation_memory"]
         
-        system_prompt = """
-        You are a coordinator agent that routes user queries to specialized agents.
-        Your task is to determine whether a query is related to data retrieval, 
-        transaction execution or or general conversation. Do not just use keywords like "swap", "liquidity", etc 
-        to decide the type of query, but actually understand the menaing of the user query, are they specifcally asking 
-        to do a data_retrieval/transaction or just inquiring about it 
-        
-        Respond with a JSON object in the following format and nothing else:
-        {
-            "query_type": "data_retrieval" | "transaction" | "conversation",
-            "confidence": 0.0 to 1.0
-        }
-        
-        Examples:
-        - "Get me the liquidity for ETH/USDC pool" -> data_retrieval
-        - "Show me the current price of ETH" -> data_retrieval
-        - "I want to swap 1 ETH for USDC" -> transaction
-        - "Check my ETH balance" -> transaction
-        - "Hello, how are you?" -> conversation
-        - "Good morning" -> conversation
-        - "Can you help me with something?" -> conversation
-        """
-        
-        conversation_history = memory.get_message_history()
+        logger.debug("classifying the user query")
+        history = memory.get_message_history()
+        messages = CLASSIFY_PROMPT.chat_messages(query=query, history=history)
 
-        user_message = f"""
-        Based on this conversation history and the user query, determine the query type:
-        
-        Conversation history:
-        {conversation_history}
-        
-        User query: {query}
-        """
-        print("classifying the user query")    
-        messages = [SystemMessage(content=system_prompt),
-                    HumanMessage(content=user_message)]
-        
-        response = self.llm.invoke(messages)
+        # start the extraction for the candidate routes before we know which one wins
+        speculation = self.speculator.launch(query, memory)
 
-        classification_result = json.loads(response.content)
+        try:
+            classification_result = self.local_classifier.classify(
+                query, history, lambda: self.classifier.classify(messages))
+        except Exception:
+            self.speculator.resolve(speculation, None)
+            raise
 
-        print(classification_result)
+        logger.info(f"query classified as {classification_result}")
         
         query_type = classification_result.get("query_type", "unknown")
         confidence = classification_result.get("confidence", 0.0)
@@ -162,8 +210,8 @@ class BlockAgentFlow:
         # I am managing memory as a list        
         memory.add_message("user", query)
         
-        # I realised most queries where classification was correct were > 0.8
-        if confidence < 0.7:
+        if confidence < CONFIDENCE_THRESHOLD:
+            self.speculator.resolve(speculation, None)
             requery_prompt = f"""
             I didn't quiet understand. Could you please clarify what do you wna to do? I can :
 
@@ -184,9 +232,11 @@ class BlockAgentFlow:
         
 
         # if the thershold is met
+        self.speculator.resolve(speculation, query_type)
         return {
             **state,
             "query_type": query_type,
+            "speculation": speculation,
             "status": "query_classified"
         }
     
@@ -219,7 +269,8 @@ class BlockAgentFlow:
         memory = state["conversation_memory"]
         
         # Process the query using the subgraph agent
-        result = self.subgraph_agent.process_query(query, memory)
+        speculation = self.speculator.claim(state.get("speculation"), "data_retrieval")
+        result = self.subgraph_agent.process_query(query, memory, speculation)
         
         return {
             **state,
@@ -236,7 +287,8 @@ class BlockAgentFlow:
         memory = state["conversation_memory"]
         
         # Process the query using the transaction agent
-        result = self.transaction_agent.process_transaction(query, memory)
+        speculation = self.speculator.claim(state.get("speculation"), "transaction")
+        result = self.transaction_agent.process_transaction(query, memory, speculation)
         
         return {
             **state,
@@ -257,6 +309,25 @@ class BlockAgentFlow:
             "status": "response_generated"
         }
     
+    def turned_away(self, query: str, memory: MessagesMemory, error: Overloaded, first_turn: bool,
+                    turn_span) -> Dict[str, Any]:
+        """ The quick answer for a turn that did not get a slot: a recent answer to the same query, or busy"""
+
+        response, status = self.admission.fallback(query, error, first_turn)
+        route = None if error.route == "classify" else error.route
+        # past classification the query is already in memory, keep the conversation in turns
+        if route is not None:
+            memory.add_message("assistant", response)
+        turn_span.set(route=route, status=status)
+        logger.warning(f"turn turned away at {error.route} ({error.reason}), answered with {status}")
+        return {
+            "agent_response": response,
+            "query_type": route,
+            "status": status,
+            "results": {},
+            "memory": memory
+        }
+
     def process(self, query: str, memory) -> Dict[str, Any]:
         """ Process a user query through the workflow. """
         if memory is None:
@@ -271,14 +342,28 @@ class BlockAgentFlow:
             "parameters": {},
             "missing_parameters": [],
             "results": {},
-            "status": "initialized"
+            "status": "initialized",
+            "speculation": None
         }
         
+        # only answers given without any history are shared between sessions
+        first_turn = not memory.messages
+
         # Run the workflow and return the response to frontend
-        result = self.workflow.invoke(state)
+        with trace("turn") as turn_span:
+            try:
+                result = self.workflow.invoke(state)
+            except Overloaded as e:
+                return self.turned_away(query, memory, e, first_turn, turn_span)
+            turn_span.set(route=result["query_type"], status=result["status"])
+
+        if result["status"] == "response_generated":
+            self.admission.remember(query, result["query_type"], result["agent_response"], first_turn)
         
         return {
             "agent_response": result["agent_response"],
+            "query_type": result["query_type"],
             "status": result["status"],
+            "results": result["results"],
             "memory": memory
         }
\ No newline at end of file
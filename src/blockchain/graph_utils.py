@@ -1,33 +1,105 @@
 import os
+import threading
 from gql import gql, Client
 from dotenv import load_dotenv
 from gql.transport.requests import RequestsHTTPTransport
 from typing import Dict, Any, List, Optional
 
+from src.blockchain.local_store import get_local_store
+from src.blockchain.resilience import resilient, GRAPH
+from src.monitoring.tracing import get_logger, span, graphql_operation_name, record_cache
+from src.monitoring.cassette import get_cassette
+
 load_dotenv()
 
+logger = get_logger("graph_utils")
+
 GRAPH_API_KEY  = os.getenv('GRAPH_KEY')
-UNISWAP_V3_URL = f"https://gateway.thegraph.com/api/{GRAPH_API_KEY}/subgraphs/id/5zvR82QoaXYFyDEKLZ9t6v9adgnptxYpKpSbxtgVENFV"
+# GRAPH_URL points the tools at another endpoint, e.g. the local fake subgraph in bench/
+UNISWAP_V3_URL = os.getenv('GRAPH_URL') or f"https://gateway.thegraph.com/api/{GRAPH_API_KEY}/subgraphs/id/5zvR82QoaXYFyDEKLZ9t6v9adgnptxYpKpSbxtgVENFV"
 
 class GraphQLClient:
     def __init__(self, url: str):
-        transport = RequestsHTTPTransport(url=url)
-        self.client = Client(transport=transport, fetch_schema_from_transport=True)
+        self.url = url
+        # gql's sync client holds one connection and refuses a second execute while one runs
+        # (TransportAlreadyConnected), and the prefetcher's refresher, the upstream executor and the
+        # turns all query at the same time, so every thread gets its own. The schema is fetched once and shared
+        self.local = threading.local()
+        self.schema = None
+        self.schema_lock = threading.Lock()
+
+    @property
+    def client(self) -> Client:
+        client = getattr(self.local, "client", None)
+        if client is None:
+            transport = RequestsHTTPTransport(url=self.url)
+            if self.schema is not None:
+                client = Client(transport=transport, schema=self.schema)
+            else:
+                client = Client(transport=transport, fetch_schema_from_transport=True)
+            self.local.client = client
+        return client
+
+    def run(self, query, variables: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        client = self.client
+        if self.schema is None:
+            # only the first query introspects, the threads that come in meanwhile wait for its schema
+            with self.schema_lock:
+                if self.schema is None:
+                    result = client.execute(query, variable_values=variables)
+                    self.schema = client.schema
+                    return result
+        if client.schema is None:
+            client = self.local.client = Client(transport=RequestsHTTPTransport(url=self.url), schema=self.schema)
+        return client.execute(query, variable_values=variables)
     
     def execute_query(self, query_string: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """ Execute a GraphQL query on the uniswap - V3 subgraph"""
 
         query = gql(query_string)
-        result = self.client.execute(query, variable_values=variables)
+        with span(graphql_operation_name(query_string), kind="graphql", variables=variables):
+            result = get_cassette().call("graphql", {"query": query_string, "variables": variables},
+                                         lambda: self.run(query, variables))
         return result
 
 class GraphTools:
-    def __init__(self):
+    def __init__(self, local_store=None):
         self.client = GraphQLClient(UNISWAP_V3_URL)
+        # answers from the local SQLite copy while it is fresh, see src/blockchain/local_store.py
+        self.local_store = local_store if local_store is not None else get_local_store()
+        # recent swaps straight from the chain's Swap events, set by the workflow, see src/blockchain/swap_logs.py
+        self.swap_logs = None
+
+    def read_local(self, method: str, *args) -> Optional[Dict[str, Any]]:
+        if self.local_store is None:
+            return None
+        try:
+            result = getattr(self.local_store, method)(*args)
+        except Exception:
+            logger.exception("local store read failed, asking The Graph")
+            result = None
+        record_cache("local_store", result is not None)
+        return result
+
+    def read_swap_logs(self, token_symbol: str, limit: int) -> Optional[Dict[str, Any]]:
+        if self.swap_logs is None:
+            return None
+        result = self.swap_logs.get_recent_swaps(token_symbol, limit)
+        record_cache("swap_logs", result is not None)
+        return result
     
     def get_pool_liquidity(self, token0: str, token1: str) -> Dict[str, Any]:
         """ Get liquidity information for a pool"""
-        
+
+        local = self.read_local("get_pool_liquidity", token0, token1)
+        if local is not None:
+            return local
+        return self.query_pool_liquidity(token0, token1)
+
+    @resilient(GRAPH)
+    def query_pool_liquidity(self, token0: str, token1: str) -> Dict[str, Any]:
+        """ The pool from The Graph, within the graph deadline or from the last answer"""
+
         query = """
         query GetPoolData($token0: String!, $token1: String!) {
           pools(
@@ -59,7 +131,7 @@ class GraphTools:
         }
         """
 
-        print(query)
+        logger.debug(query)
         params = {"token0": token0, "token1": token1}
         result = self.client.execute_query(query, params)
         return result
@@ -67,6 +139,20 @@ class GraphTools:
     def get_recent_swaps(self, token_symbol: str, limit: int = 5) -> Dict[str, Any]:
         """Get recent swaps for a token"""
 
+        # the chain is ahead of both the local store and the subgraph
+        recent = self.read_swap_logs(token_symbol, limit)
+        if recent is not None:
+            return recent
+
+        local = self.read_local("get_recent_swaps", token_symbol, limit)
+        if local is not None:
+            return local
+        return self.query_recent_swaps(token_symbol, limit)
+
+    @resilient(GRAPH)
+    def query_recent_swaps(self, token_symbol: str, limit: int = 5) -> Dict[str, Any]:
+        """ The swaps from The Graph, within the graph deadline or from the last answer"""
+
         query = """
         query GetRecentSwaps($symbol: String!, $limit: Int!) {
           swaps(
@@ -94,7 +180,7 @@ class GraphTools:
           }
         }
         """
-        print(query)
+        logger.debug(query)
 
         params = {"symbol": token_symbol, "limit": limit}
         result = self.client.execute_query(query, params)
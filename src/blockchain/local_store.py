@@ -0,0 +1,448 @@
+""" Local SQLite copy of the Uniswap v3 tokens, pools and swaps, kept up to date from the subgraph.
+
+    python -m src.blockchain.local_store            # sync every LOCAL_STORE_SYNC_INTERVAL seconds
+    python -m src.blockchain.local_store --once     # one pass, e.g. from cron
+
+GraphTools answers get_pool_liquidity / get_recent_swaps from here while the last sync is younger
+than LOCAL_STORE_MAX_LAG, and goes to The Graph otherwise. Only pools above LOCAL_STORE_MIN_TVL_USD
+and their swaps are kept, swaps are pulled incrementally from a (timestamp, id) cursor.
+"""
+import os
+import sys
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Tuple
+
+from src.blockchain.resilience import as_of
+from src.monitoring.tracing import get_logger, metrics, trace
+
+
+load_dotenv()
+
+logger = get_logger("local_store")
+
+# empty (the default) keeps every question going to The Graph
+LOCAL_STORE_PATH = os.getenv("LOCAL_STORE_PATH", "")
+# local answers are only used while the last successful sync is at most this many seconds old
+LOCAL_STORE_MAX_LAG = float(os.getenv("LOCAL_STORE_MAX_LAG", "120"))
+# "1" runs the sync inside the app, only one process holds the sync lease at a time
+LOCAL_STORE_SYNC = os.getenv("LOCAL_STORE_SYNC", "1") == "1"
+LOCAL_STORE_SYNC_INTERVAL = float(os.getenv("LOCAL_STORE_SYNC_INTERVAL", "30"))
+LOCAL_STORE_MIN_TVL_USD = os.getenv("LOCAL_STORE_MIN_TVL_USD", "100000")
+# how far back the first sync of an empty store goes
+LOCAL_STORE_BACKFILL = int(os.getenv("LOCAL_STORE_BACKFILL", "86400"))
+
+PAGE_SIZE = 1000
+
+metrics.describe("blockagent_local_store_synced_total", "counter", "Rows written by the subgraph sync")
+metrics.describe("blockagent_local_store_lag_seconds", "gauge", "Seconds since the last successful sync")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    id TEXT PRIMARY KEY,
+    symbol TEXT NOT NULL,
+    name TEXT,
+    decimals TEXT
+);
+CREATE TABLE IF NOT EXISTS pools (
+    id TEXT PRIMARY KEY,
+    token0 TEXT NOT NULL REFERENCES tokens(id),
+    token1 TEXT NOT NULL REFERENCES tokens(id),
+    fee_tier TEXT,
+    liquidity TEXT,
+    token0_price TEXT,
+    token1_price TEXT,
+    tvl_token0 TEXT,
+    tvl_token1 TEXT,
+    tvl_usd TEXT,
+    tvl_usd_value REAL,
+    volume_usd TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS swaps (
+    id TEXT PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    pool TEXT NOT NULL REFERENCES pools(id),
+    token0 TEXT NOT NULL,
+    token1 TEXT NOT NULL,
+    amount0 TEXT,
+    amount1 TEXT,
+    amount_usd TEXT,
+    sender TEXT,
+    origin TEXT
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS tokens_symbol ON tokens(symbol COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS pools_token0 ON pools(token0, tvl_usd_value);
+CREATE INDEX IF NOT EXISTS pools_token1 ON pools(token1, tvl_usd_value);
+CREATE INDEX IF NOT EXISTS swaps_pool_time ON swaps(pool, timestamp);
+CREATE INDEX IF NOT EXISTS swaps_token0_time ON swaps(token0, timestamp);
+CREATE INDEX IF NOT EXISTS swaps_token1_time ON swaps(token1, timestamp);
+CREATE INDEX IF NOT EXISTS swaps_time ON swaps(timestamp);
+"""
+
+SYNC_POOLS_QUERY = """
+query SyncPools($minTvl: BigDecimal!, $lastId: ID!, $first: Int!) {
+  pools(
+    where: {totalValueLockedUSD_gt: $minTvl, id_gt: $lastId}
+    orderBy: id
+    orderDirection: asc
+    first: $first
+  ) {
+    id
+    token0 { id symbol name decimals }
+    token1 { id symbol name decimals }
+    feeTier
+    liquidity
+    token0Price
+    token1Price
+    totalValueLockedToken0
+    totalValueLockedToken1
+    totalValueLockedUSD
+    volumeUSD
+  }
+}
+"""
+
+# graph-node does not allow column filters next to `or`, so the pool filter goes into both branches
+SYNC_SWAPS_QUERY = """
+query SyncSwaps($pools: [String!]!, $timestamp: BigInt!, $lastId: ID!, $first: Int!) {
+  swaps(
+    where: {
+      or: [
+        { pool_in: $pools, timestamp_gt: $timestamp }
+        { pool_in: $pools, timestamp: $timestamp, id_gt: $lastId }
+      ]
+    }
+    orderBy: timestamp
+    orderDirection: asc
+    first: $first
+  ) {
+    id
+    timestamp
+    pool { id }
+    token0 { id symbol name decimals }
+    token1 { id symbol name decimals }
+    amount0
+    amount1
+    amountUSD
+    sender
+    origin
+  }
+}
+"""
+
+
+class LocalStore:
+    """ SQLite tables for tokens, pools and swaps, read in the shape GraphTools returns """
+
+    def __init__(self, path: str = LOCAL_STORE_PATH, max_lag: float = LOCAL_STORE_MAX_LAG):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_lag = max_lag
+        # one connection per thread, WAL lets the readers run while the sync writes
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get_state(self, name: str) -> Tuple[Optional[str], Optional[float]]:
+        row = self.connection().execute("SELECT value, updated FROM sync_state WHERE name = ?", (name,)).fetchone()
+        return (row["value"], row["updated"]) if row else (None, None)
+
+    def set_state(self, connection: sqlite3.Connection, name: str, value: str) -> None:
+        connection.execute("INSERT OR REPLACE INTO sync_state (name, value, updated) VALUES (?, ?, ?)",
+                           (name, value, time.time()))
+
+    def synced_at(self) -> Optional[float]:
+        """ When the last complete sync (pools and swaps) finished"""
+
+        _, updated = self.get_state("synced")
+        return updated
+
+    def is_fresh(self) -> bool:
+        synced_at = self.synced_at()
+        return synced_at is not None and time.time() - synced_at <= self.max_lag
+
+    # ---- reads ----
+
+    def token_ids(self, symbol: str) -> List[str]:
+        """ Tokens whose symbol contains symbol, like symbol_contains_nocase"""
+
+        rows = self.connection().execute("SELECT id FROM tokens WHERE symbol LIKE ? ESCAPE '\\'",
+                                         (f"%{escape_like(symbol)}%",)).fetchall()
+        return [row["id"] for row in rows]
+
+    def get_pool_liquidity(self, token0: str, token1: str) -> Optional[Dict[str, Any]]:
+        """ The deepest pool for the pair, None when the store is stale or does not have it"""
+
+        if not self.is_fresh():
+            return None
+        token0_ids, token1_ids = self.token_ids(token0), self.token_ids(token1)
+        if not token0_ids or not token1_ids:
+            return None
+
+        row = self.connection().execute(f"""
+            SELECT p.*, t0.symbol AS symbol0, t0.decimals AS decimals0, t1.symbol AS symbol1, t1.decimals AS decimals1
+            FROM pools p JOIN tokens t0 ON t0.id = p.token0 JOIN tokens t1 ON t1.id = p.token1
+            WHERE p.token0 IN ({placeholders(token0_ids)}) AND p.token1 IN ({placeholders(token1_ids)})
+            ORDER BY p.tvl_usd_value DESC LIMIT 1""", token0_ids + token1_ids).fetchone()
+        if row is None:
+            return None
+
+        return {"pools": [{
+            "id": row["id"],
+            "token0": {"id": row["token0"], "symbol": row["symbol0"], "decimals": row["decimals0"]},
+            "token1": {"id": row["token1"], "symbol": row["symbol1"], "decimals": row["decimals1"]},
+            "totalValueLockedToken0": row["tvl_token0"],
+            "totalValueLockedToken1": row["tvl_token1"],
+            "totalValueLockedUSD": row["tvl_usd"],
+            "volumeUSD": row["volume_usd"],
+            "feeTier": row["fee_tier"]
+        }], "as_of": as_of(self.synced_at())}
+
+    def get_recent_swaps(self, token_symbol: str, limit: int = 5) -> Optional[Dict[str, Any]]:
+        """ Latest swaps touching the token, None when the store is stale or does not know it"""
+
+        if not self.is_fresh():
+            return None
+        swaps = self.get_swaps_between(token_symbol, limit=limit)
+        if swaps is None:
+            return None
+        return {"swaps": swaps, "as_of": as_of(self.synced_at())}
+
+    def get_swaps_between(self, token_symbol: str, start: Optional[int] = None, end: Optional[int] = None,
+                          limit: int = 100) -> Optional[List[Dict[str, Any]]]:
+        """ Swaps touching the token in [start, end), newest first. This is what the subgraph cannot page through cheaply"""
+
+        token_ids = self.token_ids(token_symbol)
+        if not token_ids:
+            return None
+
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("s.timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("s.timestamp < ?")
+            params.append(end)
+        time_filter = "".join(f" AND {condition}" for condition in conditions)
+
+        # each half walks its (token, timestamp) index backwards and stops at limit, only 2 * limit rows get merged
+        half = f"SELECT * FROM swaps s WHERE s.{{side}} IN ({placeholders(token_ids)}){time_filter} ORDER BY s.timestamp DESC LIMIT ?"
+        rows = self.connection().execute(f"""
+            SELECT s.*, t0.symbol AS symbol0, t1.symbol AS symbol1 FROM (
+                SELECT * FROM ({half.format(side="token0")})
+                UNION
+                SELECT * FROM ({half.format(side="token1")})
+            ) s JOIN tokens t0 ON t0.id = s.token0 JOIN tokens t1 ON t1.id = s.token1
+            ORDER BY s.timestamp DESC, s.id DESC LIMIT ?""",
+            token_ids + params + [limit] + token_ids + params + [limit] + [limit]).fetchall()
+
+        return [{
+            "id": row["id"],
+            "timestamp": str(row["timestamp"]),
+            "amount0": row["amount0"],
+            "amount1": row["amount1"],
+            "amountUSD": row["amount_usd"],
+            "token0": {"symbol": row["symbol0"]},
+            "token1": {"symbol": row["symbol1"]}
+        } for row in rows]
+
+    def tracked_pools(self) -> List[str]:
+        return [row["id"] for row in self.connection().execute("SELECT id FROM pools ORDER BY id")]
+
+    # ---- writes, from the sync ----
+
+    def upsert_tokens(self, connection: sqlite3.Connection, tokens: List[Dict[str, Any]]) -> None:
+        connection.executemany("INSERT OR REPLACE INTO tokens (id, symbol, name, decimals) VALUES (?, ?, ?, ?)",
+                               [(token["id"], token["symbol"], token.get("name"), str(token.get("decimals")))
+                                for token in tokens])
+
+    def upsert_pools(self, pools: List[Dict[str, Any]]) -> None:
+        now = time.time()
+        with self.connection() as connection:
+            self.upsert_tokens(connection, [pool[side] for pool in pools for side in ("token0", "token1")])
+            connection.executemany("""
+                INSERT OR REPLACE INTO pools (id, token0, token1, fee_tier, liquidity, token0_price, token1_price,
+                                              tvl_token0, tvl_token1, tvl_usd, tvl_usd_value, volume_usd, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(pool["id"], pool["token0"]["id"], pool["token1"]["id"], pool.get("feeTier"), pool.get("liquidity"),
+                  pool.get("token0Price"), pool.get("token1Price"), pool.get("totalValueLockedToken0"),
+                  pool.get("totalValueLockedToken1"), pool.get("totalValueLockedUSD"),
+                  float(pool.get("totalValueLockedUSD") or 0), pool.get("volumeUSD"), now) for pool in pools])
+
+    def insert_swaps(self, swaps: List[Dict[str, Any]], cursor: Tuple[int, str]) -> None:
+        """ A page of swaps and the cursor after it, in one transaction so a crash never skips a page"""
+
+        with self.connection() as connection:
+            self.upsert_tokens(connection, [swap[side] for swap in swaps for side in ("token0", "token1")])
+            connection.executemany("""
+                INSERT OR IGNORE INTO swaps (id, timestamp, pool, token0, token1, amount0, amount1, amount_usd, sender, origin)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(swap["id"], int(swap["timestamp"]), swap["pool"]["id"], swap["token0"]["id"], swap["token1"]["id"],
+                  swap.get("amount0"), swap.get("amount1"), swap.get("amountUSD"), swap.get("sender"), swap.get("origin"))
+                 for swap in swaps])
+            self.set_state(connection, "swaps_cursor", f"{cursor[0]}:{cursor[1]}")
+
+    def swaps_cursor(self) -> Optional[Tuple[int, str]]:
+        value, _ = self.get_state("swaps_cursor")
+        if not value:
+            return None
+        timestamp, _, last_id = value.partition(":")
+        return int(timestamp), last_id
+
+    def mark_synced(self) -> None:
+        with self.connection() as connection:
+            self.set_state(connection, "synced", "ok")
+
+    def try_lease(self, owner: str, ttl: float) -> bool:
+        """ Only one process syncs at a time, the lease expires if its holder dies"""
+
+        now = time.time()
+        with self.connection() as connection:
+            # one statement, so two processes can not both see an expired lease and both take it.
+            # `updated` holds the expiry for the lease row
+            cursor = connection.execute(
+                "INSERT INTO sync_state (name, value, updated) VALUES ('lease', ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated = excluded.updated "
+                "WHERE sync_state.value = excluded.value OR sync_state.updated <= ?",
+                (owner, now + ttl, now))
+        return cursor.rowcount == 1
+
+
+def placeholders(values: List[Any]) -> str:
+    return ", ".join("?" for _ in values)
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SubgraphSync:
+    """ Pulls the pools above the TVL floor and every swap of theirs since the cursor into a LocalStore """
+
+    def __init__(self, store: LocalStore, client, interval: float = LOCAL_STORE_SYNC_INTERVAL,
+                 min_tvl_usd: str = LOCAL_STORE_MIN_TVL_USD, backfill: int = LOCAL_STORE_BACKFILL):
+        self.store = store
+        self.client = client
+        self.interval = interval
+        self.min_tvl_usd = min_tvl_usd
+        self.backfill = backfill
+        self.owner = uuid.uuid4().hex
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sync_pools(self) -> int:
+        last_id, synced = "", 0
+        while True:
+            page = self.client.execute_query(SYNC_POOLS_QUERY, {"minTvl": self.min_tvl_usd, "lastId": last_id,
+                                                                "first": PAGE_SIZE})["pools"]
+            if not page:
+                return synced
+            self.store.upsert_pools(page)
+            synced += len(page)
+            last_id = page[-1]["id"]
+            if len(page) < PAGE_SIZE:
+                return synced
+
+    def sync_swaps(self) -> int:
+        pools = self.store.tracked_pools()
+        if not pools:
+            return 0
+
+        cursor = self.store.swaps_cursor() or (int(time.time()) - self.backfill, "")
+        synced = 0
+        while True:
+            page = self.client.execute_query(SYNC_SWAPS_QUERY, {"pools": pools, "timestamp": str(cursor[0]),
+                                                                "lastId": cursor[1], "first": PAGE_SIZE})["swaps"]
+            if not page:
+                return synced
+            cursor = (int(page[-1]["timestamp"]), page[-1]["id"])
+            self.store.insert_swaps(page, cursor)
+            synced += len(page)
+            if len(page) < PAGE_SIZE:
+                return synced
+
+    def sync_once(self) -> Dict[str, int]:
+        with trace("local_store_sync"):
+            pools = self.sync_pools()
+            swaps = self.sync_swaps()
+            self.store.mark_synced()
+        metrics.inc("blockagent_local_store_synced_total", pools, table="pools")
+        metrics.inc("blockagent_local_store_synced_total", swaps, table="swaps")
+        logger.info(f"synced {pools} pools and {swaps} new swaps")
+        return {"pools": pools, "swaps": swaps}
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            if self.store.try_lease(self.owner, ttl=self.interval * 3):
+                try:
+                    self.sync_once()
+                except Exception:
+                    logger.exception("local store sync failed, answering from The Graph until it catches up")
+            synced_at = self.store.synced_at()
+            if synced_at is not None:
+                metrics.set_gauge("blockagent_local_store_lag_seconds", time.time() - synced_at)
+            self.stop_event.wait(self.interval)
+
+    def start(self) -> "SubgraphSync":
+        self.thread = threading.Thread(target=self.run, name="local-store-sync", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+_local_store = None
+_local_store_lock = threading.Lock()
+
+
+def get_local_store() -> Optional[LocalStore]:
+    """ The process wide store, None when LOCAL_STORE_PATH is not set"""
+
+    global _local_store
+    if not LOCAL_STORE_PATH:
+        return None
+    with _local_store_lock:
+        if _local_store is None:
+            _local_store = LocalStore(LOCAL_STORE_PATH)
+        return _local_store
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Sync the local Uniswap v3 store from the subgraph")
+    parser.add_argument("--path", default=LOCAL_STORE_PATH or ".cache/uniswap.sqlite", help="SQLite file")
+    parser.add_argument("--once", action="store_true", help="one sync pass and exit")
+    args = parser.parse_args(argv)
+
+    from src.blockchain.graph_utils import GraphQLClient, UNISWAP_V3_URL
+
+    sync = SubgraphSync(LocalStore(args.path), GraphQLClient(UNISWAP_V3_URL))
+    if args.once:
+        sync.sync_once()
+    else:
+        sync.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+from src.blockchain.transaction import symbol_addr_mapping
+from src.monitoring.tracing import get_logger
+
+
+logger = get_logger("portfolio")
+
+# everything is valued in USDC, tokens without a USDC pool go through their WETH pool
+QUOTE_SYMBOL = "USDC"
+BRIDGE_SYMBOL = "WETH"
+# native ETH is priced as WETH
+PRICE_ALIASES = {"ETH": "WETH"}
+
+# one balance read and one pool lookup per token, all at once
+portfolio_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="portfolio")
+
+
+def submit(function, *args):
+    # the rpc / graphql spans stay under the caller's trace
+    return portfolio_executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def find_pool(pool_data, symbol: str, other: str) -> Tuple[Optional[Dict[str, Any]], bool, Optional[str]]:
+    """ The deepest symbol / other pool in either token order, whether symbol is token0, and its as_of if cached"""
+
+    for token0, token1 in ((symbol, other), (other, symbol)):
+        result = pool_data.get_pool_liquidity(token0, token1)
+        pools = (result or {}).get("pools") or []
+        if pools:
+            return pools[0], token0 == symbol, result.get("as_of")
+    return None, False, None
+
+
+def pool_price(pool: Dict[str, Any], symbol_is_token0: bool, other_price: float) -> Optional[float]:
+    """ Price of one side of the pool from its TVL split: the USD value that is not the other token, per token held"""
+
+    locked = float(pool["totalValueLockedToken0" if symbol_is_token0 else "totalValueLockedToken1"])
+    other_locked = float(pool["totalValueLockedToken1" if symbol_is_token0 else "totalValueLockedToken0"])
+    value = float(pool["totalValueLockedUSD"]) - other_locked * other_price
+    if locked <= 0 or value <= 0:
+        return None
+    return value / locked
+
+
+def price_against(pool_data, symbol: str, other: str, other_price: float) -> Tuple[Optional[float], Optional[str]]:
+    """ USDC price of symbol through its pool with other, (None, None) when there is no usable pool"""
+
+    if symbol == QUOTE_SYMBOL:
+        return 1.0, None
+    try:
+        pool, symbol_is_token0, as_of = find_pool(pool_data, symbol, other)
+    except Exception as e:
+        logger.warning(f"no pool data for {symbol}/{other}: {e}")
+        return None, None
+    if pool is None:
+        return None, None
+    return pool_price(pool, symbol_is_token0, other_price), as_of
+
+
+def get_portfolio(web3_tools, pool_data) -> Dict[str, Any]:
+    """ Every known token's balance and its value in USDC, in one go.
+
+        pool_data is anything with get_pool_liquidity: GraphTools, or the prefetcher so hot pairs come from memory
+    """
+
+    if not web3_tools.address:
+        return {"error": "No wallet configured, a private key is needed to read balances"}
+
+    symbols = list(symbol_addr_mapping)
+    price_symbols = sorted({PRICE_ALIASES.get(symbol, symbol) for symbol in symbols})
+
+    balance_futures = {symbol: submit(web3_tools.get_token_balance, symbol) for symbol in symbols}
+    price_futures = {symbol: submit(price_against, pool_data, symbol, QUOTE_SYMBOL, 1.0) for symbol in price_symbols}
+
+    balances: Dict[str, float] = {}
+    errors: List[str] = []
+    for symbol, future in balance_futures.items():
+        try:
+            balance = future.result()
+        except Exception as e:
+            logger.warning(f"balance of {symbol} failed: {e}")
+            errors.append(f"{symbol}: {e}")
+            continue
+        if "error" in balance:
+            errors.append(f"{symbol}: {balance['error']}")
+            continue
+        balances[symbol] = balance["balance"]
+
+    prices: Dict[str, Optional[float]] = {}
+    as_ofs = []
+    for symbol, future in price_futures.items():
+        prices[symbol], as_of = future.result()
+        if as_of:
+            as_ofs.append(as_of)
+
+    # only tokens we hold and could not price against USDC are worth the second hop
+    bridge_price = prices.get(BRIDGE_SYMBOL)
+    missing = {PRICE_ALIASES.get(symbol, symbol) for symbol, balance in balances.items() if balance > 0} - {
+        symbol for symbol, price in prices.items() if price is not None}
+    if bridge_price is not None and missing:
+        bridged = {symbol: submit(price_against, pool_data, symbol, BRIDGE_SYMBOL, bridge_price) for symbol in missing}
+        for symbol, future in bridged.items():
+            prices[symbol], as_of = future.result()
+            if as_of:
+                as_ofs.append(as_of)
+
+    holdings = []
+    total = 0.0
+    unpriced = []
+    for symbol, balance in balances.items():
+        price = prices.get(PRICE_ALIASES.get(symbol, symbol))
+        value = balance * price if price is not None else None
+        if value is not None:
+            total += value
+        elif balance > 0:
+            unpriced.append(symbol)
+        holdings.append({"symbol": symbol, "balance": balance, "price_usdc": price, "value_usdc": value})
+    holdings.sort(key=lambda holding: holding["value_usdc"] or 0.0, reverse=True)
+
+    result = {
+        "address": web3_tools.address,
+        "holdings": holdings,
+        "total_value_usdc": total,
+    }
+    if unpriced:
+        result["unpriced"] = unpriced
+    if errors:
+        result["errors"] = errors
+    if as_ofs:
+        # the oldest cached pool data that went into the prices
+        result["prices_as_of"] = min(as_ofs)
+    return result
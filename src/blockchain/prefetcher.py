@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Tuple
+
+from src.blockchain.resilience import as_of, live_results
+from src.monitoring.tracing import get_logger, trace
+
+
+load_dotenv()
+
+logger = get_logger("prefetcher")
+
+# off by default: every process re-queries its hot keys on The Graph every refresh_interval seconds
+PREFETCH_ENABLED = os.getenv("BLOCKAGENT_PREFETCH", "0") == "1"
+
+# the pairs from the example queries in app.py, so they are warm before the first user asks
+SEED_KEYS = [
+    ("pool", "WETH", "USDC"),
+    ("pool", "WBTC", "WETH"),
+    ("swaps", "WETH", 5),
+    ("quote", "WETH", "USDC", 1.0),
+]
+
+
+class WarmEntry:
+    def __init__(self, value: Dict[str, Any], fetched_at: float):
+        self.value = value
+        self.fetched_at = fetched_at
+
+
+class HotDataPrefetcher:
+    """ Keeps the pool snapshots, recent swaps and quotes for the most asked about pairs warm.
+
+        It has the same get_pool_liquidity / get_recent_swaps / simulate_swap methods as GraphTools and
+        Web3UHelperClass, so the agents can call it instead of the tools. Every call counts towards the
+        key's popularity, a background thread refreshes the top_k keys every refresh_interval seconds
+        and reads are served from the warm store while the entry is younger than max_age.
+    """
+
+    def __init__(self, graph_tools, web3_tools=None, top_k: int = 8, refresh_interval: float = 30.0,
+                 max_age: float = 120.0, seed_keys: Optional[List[Tuple]] = None):
+        self.graph_tools = graph_tools
+        self.web3_tools = web3_tools
+        self.top_k = top_k
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+
+        self.counts = Counter()
+        self.store: Dict[Tuple, WarmEntry] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"warm_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0}
+
+        for key in (SEED_KEYS if seed_keys is None else seed_keys):
+            self.counts[key] += 1
+
+    def fetch(self, key: Tuple) -> Dict[str, Any]:
+        """ Go to the network for a key"""
+
+        kind = key[0]
+        if kind == "pool":
+            return self.graph_tools.get_pool_liquidity(key[1], key[2])
+        if kind == "swaps":
+            return self.graph_tools.get_recent_swaps(key[1], key[2])
+        if kind == "quote":
+            return self.web3_tools.quote_swap(key[1], key[2], key[3])
+        raise ValueError(f"Unknown prefetch key: {key}")
+
+    def read(self, key: Tuple) -> Dict[str, Any]:
+        """ Serve from the warm store if fresh enough, otherwise fetch and keep it"""
+
+        now = time.time()
+        with self.lock:
+            self.counts[key] += 1
+            entry = self.store.get(key)
+            if entry is not None and now - entry.fetched_at <= self.max_age:
+                self.stats["warm_hits"] += 1
+                # a value that was already old when we fetched it keeps its own as_of
+                return {"as_of": as_of(entry.fetched_at), **entry.value}
+            self.stats["misses"] += 1
+
+        value = self.fetch(key)
+        fetched_at = time.time()
+        with self.lock:
+            self.store[key] = WarmEntry(value, fetched_at)
+        return {"as_of": as_of(fetched_at), **value}
+
+    def get_pool_liquidity(self, token0: str, token1: str) -> Dict[str, Any]:
+        """ Pool snapshot for the pair, warm if it is one of the hot ones"""
+
+        return self.read(("pool", token0.upper(), token1.upper()))
+
+    def get_recent_swaps(self, token_symbol: str, limit: int = 5) -> Dict[str, Any]:
+        """ Recent swaps for the token, warm if it is one of the hot ones"""
+
+        # the swap log buffers are fresher than anything we could keep here
+        recent = self.graph_tools.read_swap_logs(token_symbol, limit)
+        if recent is not None:
+            return recent
+        return self.read(("swaps", token_symbol.upper(), int(limit)))
+
+    def simulate_swap(self, token_in: str, token_out: str, amount_in: float) -> Dict[str, Any]:
+        """ Simulate the swap with a warm quote when we have one"""
+
+        try:
+            quote = self.read(("quote", token_in.upper(), token_out.upper(), float(amount_in)))
+        except Exception as e:
+            # unknown tokens and quoter errors are reported by simulate_swap itself
+            logger.warning(f"could not get a quote for {token_in}/{token_out}: {e}")
+            quote = None
+        return self.web3_tools.simulate_swap(token_in, token_out, amount_in, quote=quote)
+
+    def hot_keys(self) -> List[Tuple]:
+        """ The top_k most requested keys"""
+
+        with self.lock:
+            return [key for key, _ in self.counts.most_common(self.top_k)]
+
+    def refresh(self) -> None:
+        """ Refresh the hot keys once, then decay the counts so old favourites drop out"""
+
+        for key in self.hot_keys():
+            if key[0] == "quote" and self.web3_tools is None:
+                continue
+            try:
+                # straight from the upstream, the resilience layer's kept answers are no fresher than ours
+                with live_results():
+                    value = self.fetch(key)
+            except Exception as e:
+                with self.lock:
+                    self.stats["refresh_errors"] += 1
+                logger.warning(f"prefetch of {key} failed: {e}")
+                continue
+
+            with self.lock:
+                self.store[key] = WarmEntry(value, time.time())
+                self.stats["refreshes"] += 1
+
+        with self.lock:
+            for key in list(self.counts):
+                self.counts[key] *= 0.5
+                if self.counts[key] < 0.05:
+                    del self.counts[key]
+            # do not keep entries for keys that are not asked for anymore
+            for key in list(self.store):
+                if key not in self.counts and time.time() - self.store[key].fetched_at > self.max_age:
+                    del self.store[key]
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            with trace("prefetch_refresh"):
+                self.refresh()
+            self.stop_event.wait(self.refresh_interval)
+
+    def start(self) -> None:
+        """ Start the background refresher"""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="hot-data-prefetcher", daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {**self.stats, "warm_entries": len(self.store), "hot_keys": [list(key) for key, _ in self.counts.most_common(self.top_k)]}
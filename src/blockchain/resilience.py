@@ -0,0 +1,276 @@
+""" Deadlines, circuit breakers and stale-while-revalidate for the calls that leave the process.
+
+A method decorated with @resilient(GRAPH) or @resilient(RPC) is answered like this:
+
+    - a result younger than RESILIENCE_FRESH_FOR seconds comes straight from memory
+    - one younger than RESILIENCE_STALE_FOR also comes from memory, and a refresh runs in the background
+    - anything else goes to the upstream, but the turn waits at most the upstream's deadline for it.
+      When the call fails, times out or the upstream's breaker is open, the last result we have is
+      served with its as_of however old it is, and Unavailable is raised only when there is none
+
+A breaker opens after BREAKER_FAILURES failures in a row and lets one probe call through every
+BREAKER_RESET seconds until the upstream answers again. A call that ran past its deadline still
+finishes in the background and its result is kept for the next turn.
+
+Results are kept per method, per wallet (the tool's address) and per argument, positional or keyword.
+@resilient(RPC, keep=False) only gets the deadline and the breaker, nothing it returns is ever kept.
+"""
+import os
+import json
+import time
+import functools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from typing import Dict, Any, Optional, Tuple, Callable
+
+from src.monitoring.tracing import get_logger, metrics, trace
+
+
+load_dotenv()
+
+logger = get_logger("resilience")
+
+# "0" calls the upstreams directly, like before
+RESILIENCE_ENABLED = os.getenv("RESILIENCE", "1") == "1"
+# seconds a turn waits for The Graph / the Ethereum node before it answers from memory or with an error
+GRAPH_DEADLINE = float(os.getenv("GRAPH_DEADLINE", "4"))
+RPC_DEADLINE = float(os.getenv("RPC_DEADLINE", "4"))
+RESILIENCE_FRESH_FOR = float(os.getenv("RESILIENCE_FRESH_FOR", "15"))
+RESILIENCE_STALE_FOR = float(os.getenv("RESILIENCE_STALE_FOR", "300"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+RESULT_CACHE_SIZE = 2048
+
+# the upstream calls run here so the caller can stop waiting at the deadline
+upstream_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="upstream")
+# set while a resilient call runs, the resilient methods it calls in turn go straight to the upstream
+inside_upstream_call = contextvars.ContextVar("inside_upstream_call", default=False)
+# set by the background refreshers, they want the upstream's answer and not ours
+prefer_live = contextvars.ContextVar("prefer_live", default=False)
+
+metrics.describe("blockagent_upstream_calls_total", "counter", "Calls to an upstream, by result")
+metrics.describe("blockagent_upstream_served_total", "counter", "Resilient reads, by where the answer came from")
+metrics.describe("blockagent_upstream_breaker_open", "gauge", "1 while an upstream's circuit breaker is open")
+
+
+def as_of(timestamp: float) -> str:
+    """ Freshness marker that ends up in the result the llm explains"""
+
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+@contextmanager
+def live_results():
+    """ Resilient calls in the block skip the results kept in memory, unless the upstream fails"""
+
+    token = prefer_live.set(True)
+    try:
+        yield
+    finally:
+        prefer_live.reset(token)
+
+
+class Unavailable(Exception):
+    """ An upstream could not answer in time and there is nothing kept to answer with """
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream} is unavailable right now ({reason}), please try again shortly")
+        self.upstream = upstream
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """ Closed until failures calls in a row fail, then open for reset_after seconds, then one probe """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_after: float = BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failed = 0
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_after:
+                # one probe, everyone else keeps getting rejected until it is back
+                self.state = "half_open"
+                return True
+            return False
+
+    def success(self) -> None:
+        with self.lock:
+            if self.state != "closed":
+                logger.info(f"{self.name} answered again, closing its breaker")
+            self.state = "closed"
+            self.failed = 0
+        metrics.set_gauge("blockagent_upstream_breaker_open", 0, upstream=self.name)
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failed += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failed >= self.failures):
+                logger.warning(f"{self.name} failed {self.failed} times in a row, opening its breaker")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            is_open = self.state == "open"
+        metrics.set_gauge("blockagent_upstream_breaker_open", 1 if is_open else 0, upstream=self.name)
+
+
+class Upstream:
+    """ One upstream service: its deadline, its breaker and the last good result per call """
+
+    def __init__(self, name: str, deadline: float, fresh_for: float = RESILIENCE_FRESH_FOR,
+                 stale_for: float = RESILIENCE_STALE_FOR, breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.deadline = deadline
+        self.fresh_for = fresh_for
+        self.stale_for = stale_for
+        self.breaker = breaker or CircuitBreaker(name)
+        self.results: "OrderedDict[Tuple, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def kept(self, key: Tuple) -> Optional[Tuple[Dict[str, Any], float]]:
+        with self.lock:
+            return self.results.get(key)
+
+    def keep(self, key: Tuple, value: Dict[str, Any]) -> None:
+        with self.lock:
+            self.results[key] = (value, time.time())
+            self.results.move_to_end(key)
+            while len(self.results) > RESULT_CACHE_SIZE:
+                self.results.popitem(last=False)
+
+    def fetch(self, key: Tuple, function: Callable, args: Tuple, kwargs: Dict[str, Any], outcome: Dict[str, bool]):
+        """ The upstream call itself, on an upstream_executor thread"""
+
+        inside_upstream_call.set(True)
+        try:
+            value = function(*args, **kwargs)
+        except Exception:
+            metrics.inc("blockagent_upstream_calls_total", upstream=self.name, result="error")
+            # a call that already timed out was counted as a failure then
+            if not outcome["timed_out"]:
+                self.breaker.failure()
+            raise
+        metrics.inc("blockagent_upstream_calls_total", upstream=self.name, result="ok")
+        self.breaker.success()
+        # "Unknown token" and friends are answers, but not ones worth keeping
+        if outcome["keep"] and isinstance(value, dict) and "error" not in value:
+            self.keep(key, value)
+        return value
+
+    def refresh(self, key: Tuple, function: Callable, args: Tuple, kwargs: Dict[str, Any]) -> None:
+        """ Fetch key again in the background, at most one refresh per key at a time"""
+
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        if not self.breaker.allow():
+            with self.lock:
+                self.refreshing.discard(key)
+            return
+
+        def run():
+            try:
+                with trace(f"{self.name}_refresh"):
+                    self.fetch(key, function, args, kwargs, {"timed_out": False, "keep": True})
+            except Exception as e:
+                logger.warning(f"background refresh from {self.name} failed: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        # a fresh context, the refresh is not part of the turn that triggered it
+        upstream_executor.submit(contextvars.Context().run, run)
+
+    def served(self, value: Dict[str, Any], fetched_at: float, source: str, reason: Optional[str] = None) -> Dict[str, Any]:
+        metrics.inc("blockagent_upstream_served_total", upstream=self.name, source=source)
+        # an as_of from further down (local store, swap logs) is older than ours and wins
+        result = {"as_of": as_of(fetched_at), **value}
+        if reason is not None:
+            result["degraded"] = f"{self.name} {reason}, this is the last answer we got"
+        return result
+
+    def call(self, key: Tuple, function: Callable, *args: Any, _keep: bool = True, **kwargs: Any) -> Dict[str, Any]:
+        kept = self.kept(key) if _keep else None
+        if kept is not None and not prefer_live.get():
+            value, fetched_at = kept
+            age = time.time() - fetched_at
+            if age <= self.fresh_for:
+                return self.served(value, fetched_at, "fresh")
+            if age <= self.stale_for:
+                self.refresh(key, function, args, kwargs)
+                return self.served(value, fetched_at, "stale")
+
+        if not self.breaker.allow():
+            metrics.inc("blockagent_upstream_calls_total", upstream=self.name, result="rejected")
+            return self.fallback(kept, "is failing")
+
+        outcome = {"timed_out": False, "keep": _keep}
+        future = upstream_executor.submit(contextvars.copy_context().run, self.fetch, key, function, args, kwargs, outcome)
+        try:
+            value = future.result(timeout=self.deadline)
+        except FuturesTimeout:
+            outcome["timed_out"] = True
+            metrics.inc("blockagent_upstream_calls_total", upstream=self.name, result="timeout")
+            self.breaker.failure()
+            logger.warning(f"{self.name} did not answer within {self.deadline}s")
+            return self.fallback(kept, f"did not answer within {self.deadline:g}s")
+        except Exception as e:
+            if kept is None:
+                raise
+            logger.warning(f"{self.name} failed, serving the last answer we got: {e}")
+            return self.fallback(kept, "returned an error")
+        metrics.inc("blockagent_upstream_served_total", upstream=self.name, source="live")
+        return value
+
+    def fallback(self, kept: Optional[Tuple[Dict[str, Any], float]], reason: str) -> Dict[str, Any]:
+        if kept is None:
+            raise Unavailable(self.name, reason)
+        return self.served(kept[0], kept[1], "degraded", reason)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            kept = len(self.results)
+        return {"breaker": self.breaker.state, "kept_results": kept}
+
+
+GRAPH = Upstream("graph", GRAPH_DEADLINE)
+RPC = Upstream("rpc", RPC_DEADLINE)
+
+
+def call_key(method, instance, args: Tuple, kwargs: Dict[str, Any]) -> Tuple:
+    """ The method, whose wallet it runs for, and every argument, so no answer is ever handed to another call"""
+
+    positional = [arg.upper() if isinstance(arg, str) else arg for arg in args]
+    # a quote dict or similar argument has to end up hashable too
+    arguments = json.dumps([positional, kwargs], sort_keys=True, default=str)
+    return method.__qualname__, getattr(instance, "address", None), arguments
+
+
+def resilient(upstream: Upstream, keep: bool = True):
+    """ Send a tool method's calls through upstream.
+
+        keep=False only applies the deadline and the breaker, for results that must never be served from memory.
+    """
+
+    def decorate(method):
+        @functools.wraps(method)
+        def call(self, *args, **kwargs):
+            if not RESILIENCE_ENABLED or inside_upstream_call.get():
+                return method(self, *args, **kwargs)
+            return upstream.call(call_key(method, self, args, kwargs), method, self, *args, _keep=keep, **kwargs)
+        return call
+
+    return decorate
@@ -0,0 +1,351 @@
+""" Recent swaps straight from the chain, for when the subgraph's indexing lag matters.
+
+A poller asks the node for the Uniswap v3 Swap events of the watched tokens' pools every
+SWAP_LOGS_POLL_INTERVAL seconds, one eth_getLogs over all of them, and keeps the newest
+SWAP_LOGS_BUFFER swaps of each pool in memory. A token is watched from the first time someone asks
+for its swaps; its pools come from the factory and the last SWAP_LOGS_BACKFILL_BLOCKS blocks are
+read once, a page of SWAP_LOGS_PAGE_BLOCKS at a time. GraphTools answers recent swaps from here while the last poll is younger than SWAP_LOGS_MAX_LAG.
+"""
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from decimal import Decimal
+from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Tuple
+
+from eth_abi import decode
+from web3 import Web3
+
+from src.blockchain.resilience import as_of
+from src.blockchain.transaction import symbol_addr_mapping, rpc_executor, WETH_ADDR
+from src.monitoring.tracing import get_logger, metrics, trace
+
+
+load_dotenv()
+
+logger = get_logger("swap_logs")
+
+# "0" leaves recent swaps to the subgraph / local store
+SWAP_LOGS_ENABLED = os.getenv("SWAP_LOGS", "1") == "1"
+SWAP_LOGS_POLL_INTERVAL = float(os.getenv("SWAP_LOGS_POLL_INTERVAL", "4"))
+# swaps kept per pool, the newest ones
+SWAP_LOGS_BUFFER = int(os.getenv("SWAP_LOGS_BUFFER", "200"))
+# how far back a newly watched token's pools are read, 300 blocks is about an hour
+SWAP_LOGS_BACKFILL_BLOCKS = int(os.getenv("SWAP_LOGS_BACKFILL_BLOCKS", "300"))
+# blocks per eth_getLogs, nodes cap the range and the number of logs one call may return
+SWAP_LOGS_PAGE_BLOCKS = int(os.getenv("SWAP_LOGS_PAGE_BLOCKS", "100"))
+# older than this and the buffer is not trusted, the question goes to the subgraph
+SWAP_LOGS_MAX_LAG = float(os.getenv("SWAP_LOGS_MAX_LAG", "30"))
+
+UNISWAP_V3_FACTORY_ADDR = "0x1F98431c8aD98523631AE4a59f267346ea31F984"
+FEE_TIERS = (100, 500, 3000, 10000)
+SWAP_TOPIC = Web3.keccak(text="Swap(address,address,int256,int256,uint160,uint128,int24)").hex()
+SWAP_DATA_TYPES = ["int256", "int256", "uint160", "uint128", "int24"]
+# the swaps that have a USD side, the others are valued through the latest WETH price
+STABLECOINS = ("USDC", "USDT", "DAI")
+# native ETH trades as WETH in the pools
+POOL_ALIASES = {"ETH": "WETH"}
+# the tokens every demo query asks about, watched from the start
+SEED_TOKENS = ("WETH",)
+ZERO_ADDR = "0x0000000000000000000000000000000000000000"
+# post merge blocks are 12 second slots, swaps older than the head block get their time from it
+BLOCK_TIME = 12
+
+FACTORY_ABI = [{
+    "inputs": [{"internalType": "address", "name": "tokenA", "type": "address"},
+               {"internalType": "address", "name": "tokenB", "type": "address"},
+               {"internalType": "uint24", "name": "fee", "type": "uint24"}],
+    "name": "getPool",
+    "outputs": [{"internalType": "address", "name": "", "type": "address"}],
+    "stateMutability": "view",
+    "type": "function"
+}]
+
+metrics.describe("blockagent_swap_logs_polls_total", "counter", "Swap log polls, by result")
+metrics.describe("blockagent_swap_logs_decoded_total", "counter", "Swap events decoded into the buffers")
+metrics.describe("blockagent_swap_logs_lag_seconds", "gauge", "Age of the newest block the swap buffers have seen")
+
+
+def pool_symbol(symbol: str) -> str:
+    return POOL_ALIASES.get(symbol.upper(), symbol.upper())
+
+
+def token_address(symbol: str) -> Optional[str]:
+    if symbol == "WETH":
+        return WETH_ADDR
+    address = symbol_addr_mapping.get(symbol)
+    return Web3.to_checksum_address(address) if address else None
+
+
+class PoolInfo:
+    """ A pool's tokens in on-chain order (token0 has the lower address) and their decimals """
+
+    __slots__ = ("address", "symbol0", "symbol1", "decimals0", "decimals1", "fee")
+
+    def __init__(self, address: str, symbol0: str, symbol1: str, decimals0: int, decimals1: int, fee: int):
+        self.address = address
+        self.symbol0 = symbol0
+        self.symbol1 = symbol1
+        self.decimals0 = decimals0
+        self.decimals1 = decimals1
+        self.fee = fee
+
+
+class SwapLogWatcher:
+    """ Per pool ring buffers of the latest Swap events, kept current by polling eth_getLogs """
+
+    def __init__(self, web3_tools, poll_interval: float = SWAP_LOGS_POLL_INTERVAL, buffer_size: int = SWAP_LOGS_BUFFER,
+                 backfill_blocks: int = SWAP_LOGS_BACKFILL_BLOCKS, max_lag: float = SWAP_LOGS_MAX_LAG,
+                 seed_tokens: Tuple[str, ...] = SEED_TOKENS, page_blocks: int = SWAP_LOGS_PAGE_BLOCKS):
+        self.web3_tools = web3_tools
+        self.w3 = web3_tools.w3
+        self.factory = self.w3.eth.contract(address=UNISWAP_V3_FACTORY_ADDR, abi=FACTORY_ABI)
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.backfill_blocks = backfill_blocks
+        self.max_lag = max_lag
+        self.page_blocks = max(page_blocks, 1)
+
+        self.pools: Dict[str, PoolInfo] = {}
+        self.buffers: Dict[str, deque] = {}
+        # token -> its pool addresses, once they are backfilled
+        self.watched: Dict[str, List[str]] = {}
+        self.pending = set(pool_symbol(symbol) for symbol in seed_tokens)
+        self.last_block = None
+        self.head_timestamp = None
+        self.polled_at = 0.0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"polls": 0, "poll_errors": 0, "backfills": 0, "backfill_errors": 0, "decoded": 0,
+                      "hits": 0, "misses": 0}
+
+    # ---- reads ----
+
+    def get_recent_swaps(self, token_symbol: str, limit: int = 5) -> Optional[Dict[str, Any]]:
+        """ Newest swaps touching the token from the buffers, None while they are cold or behind"""
+
+        symbol = pool_symbol(token_symbol)
+        if token_address(symbol) is None:
+            return None
+
+        with self.lock:
+            pools = self.watched.get(symbol)
+            fresh = time.time() - self.polled_at <= self.max_lag
+            if pools is None or not fresh:
+                self.stats["misses"] += 1
+                if pools is None and symbol not in self.pending:
+                    self.pending.add(symbol)
+                    self.wake.set()
+                return None
+            self.stats["hits"] += 1
+            swaps = [swap for pool in pools for swap in self.buffers[pool]]
+            head_timestamp = self.head_timestamp
+
+        swaps.sort(key=lambda swap: swap["position"], reverse=True)
+        return {"swaps": [{key: value for key, value in swap.items() if key != "position"} for swap in swaps[:int(limit)]],
+                "as_of": as_of(head_timestamp)}
+
+    # ---- polling ----
+
+    def resolve_pools(self, symbol: str) -> List[str]:
+        """ The token's pools with every other known token, in every fee tier, straight from the factory"""
+
+        address = token_address(symbol)
+        others = sorted({pool_symbol(other) for other in symbol_addr_mapping} - {symbol})
+        candidates = [(other, fee) for other in others if token_address(other) for fee in FEE_TIERS]
+        # the rpc spans stay under the poll's trace. A failed lookup fails the token, it is retried whole next poll
+        futures = [rpc_executor.submit(contextvars.copy_context().run, self.factory.functions.getPool(
+            address, token_address(other), fee).call) for other, fee in candidates]
+
+        pools = []
+        for (other, fee), future in zip(candidates, futures):
+            pool = future.result()
+            if pool == ZERO_ADDR:
+                continue
+            pool = Web3.to_checksum_address(pool)
+            if pool not in self.pools:
+                # the factory sorts the pair by address, token0 is the lower one
+                (symbol0, address0), (symbol1, address1) = sorted(
+                    [(symbol, address), (other, token_address(other))], key=lambda item: item[1].lower())
+                self.pools[pool] = PoolInfo(pool, symbol0, symbol1,
+                                            self.web3_tools.token_decimals(symbol0, address0),
+                                            self.web3_tools.token_decimals(symbol1, address1), fee)
+            pools.append(pool)
+        return pools
+
+    def fetch_logs(self, pools: List[str], from_block: int, to_block: int) -> List[Any]:
+        """ The pools' Swap events in the block range, page_blocks blocks per call"""
+
+        logs = []
+        if not pools:
+            return logs
+        for start in range(from_block, to_block + 1, self.page_blocks):
+            logs += self.w3.eth.get_logs({"address": pools, "topics": [SWAP_TOPIC], "fromBlock": start,
+                                          "toBlock": min(start + self.page_blocks - 1, to_block)})
+        return logs
+
+    def decode_logs(self, logs: List[Any], head: int, head_timestamp: int) -> Dict[str, List[Dict[str, Any]]]:
+        """ Swap events into subgraph shaped swaps, by pool, oldest first.
+
+            Swaps without a stablecoin side are valued at the newest WETH price, from this batch or the buffers.
+        """
+
+        decoded: Dict[str, List[Dict[str, Any]]] = {}
+        amounts = []
+        for log in sorted(logs, key=lambda log: (log["blockNumber"], log["logIndex"])):
+            pool = self.pools.get(Web3.to_checksum_address(log["address"]))
+            if pool is None:
+                continue
+            amount0_raw, amount1_raw, _, _, _ = decode(SWAP_DATA_TYPES, bytes(log["data"]))
+            amount0 = Decimal(amount0_raw).scaleb(-pool.decimals0)
+            amount1 = Decimal(amount1_raw).scaleb(-pool.decimals1)
+            swap = {
+                "id": f"{Web3.to_hex(log['transactionHash'])}#{log['logIndex']}",
+                "timestamp": str(head_timestamp - BLOCK_TIME * (head - log["blockNumber"])),
+                "blockNumber": log["blockNumber"],
+                "amount0": str(amount0),
+                "amount1": str(amount1),
+                "amountUSD": None,
+                "token0": {"symbol": pool.symbol0},
+                "token1": {"symbol": pool.symbol1},
+                "pool": {"id": pool.address, "feeTier": str(pool.fee)},
+                "position": (log["blockNumber"], log["logIndex"])
+            }
+            decoded.setdefault(pool.address, []).append(swap)
+            amounts.append((pool, amount0, amount1, swap))
+
+        weth_usd = self.weth_usd(decoded)
+        for pool, amount0, amount1, swap in amounts:
+            swap["amountUSD"] = self.amount_usd(pool, amount0, amount1, weth_usd)
+        return decoded
+
+    def weth_usd(self, decoded: Dict[str, List[Dict[str, Any]]]) -> Optional[Decimal]:
+        """ WETH price from the newest swap of a WETH / stablecoin pool"""
+
+        latest = None
+        with self.lock:
+            for address, swaps in [*self.buffers.items(), *decoded.items()]:
+                symbols = {self.pools[address].symbol0, self.pools[address].symbol1}
+                if swaps and "WETH" in symbols and symbols & set(STABLECOINS):
+                    if latest is None or swaps[-1]["position"] > latest["position"]:
+                        latest = swaps[-1]
+        if latest is None:
+            return None
+        weth, stable = (latest["amount0"], latest["amount1"]) if latest["token0"]["symbol"] == "WETH" \
+            else (latest["amount1"], latest["amount0"])
+        weth, stable = abs(Decimal(weth)), abs(Decimal(stable))
+        return stable / weth if weth else None
+
+    def amount_usd(self, pool: PoolInfo, amount0: Decimal, amount1: Decimal, weth_usd: Optional[Decimal]) -> Optional[str]:
+        if pool.symbol0 in STABLECOINS:
+            value = abs(amount0)
+        elif pool.symbol1 in STABLECOINS:
+            value = abs(amount1)
+        elif weth_usd is not None and "WETH" in (pool.symbol0, pool.symbol1):
+            value = abs(amount0 if pool.symbol0 == "WETH" else amount1) * weth_usd
+        else:
+            return None
+        return str(round(value, 6))
+
+    def poll_once(self) -> int:
+        """ New swaps of the watched pools since the last poll, then backfill the tokens asked about since.
+
+            The watched pools' swaps are in the buffers before any backfill starts, and a token that fails
+            to backfill stays pending for the next poll without holding up the others.
+        """
+
+        with self.lock:
+            if not self.watched and not self.pending:
+                return 0
+
+        head_block = self.w3.eth.get_block("latest")
+        head, head_timestamp = head_block["number"], head_block["timestamp"]
+
+        with self.lock:
+            live_pools = sorted({pool for pools in self.watched.values() for pool in pools})
+            pending = sorted(self.pending)
+            last_block = self.last_block
+
+        logs = []
+        if last_block is not None:
+            # a poller that fell far behind starts over from the backfill window instead of paging through it
+            logs = self.fetch_logs(live_pools, max(last_block + 1, head - self.backfill_blocks), head)
+        decoded = self.decode_logs(logs, head, head_timestamp)
+        with self.lock:
+            for pool, swaps in decoded.items():
+                self.buffers[pool].extend(swaps)
+            self.last_block = head
+            self.head_timestamp = head_timestamp
+            self.polled_at = time.time()
+            self.stats["polls"] += 1
+            self.stats["decoded"] += len(logs)
+        metrics.inc("blockagent_swap_logs_polls_total", result="ok")
+        metrics.inc("blockagent_swap_logs_decoded_total", len(logs))
+        metrics.set_gauge("blockagent_swap_logs_lag_seconds", max(time.time() - head_timestamp, 0.0))
+
+        backfilled = 0
+        for symbol in pending:
+            try:
+                backfilled += self.backfill(symbol, head, head_timestamp)
+            except Exception as e:
+                with self.lock:
+                    self.stats["backfill_errors"] += 1
+                metrics.inc("blockagent_swap_logs_polls_total", result="backfill_error")
+                logger.warning(f"could not backfill the swaps of {symbol}, retrying next poll: {e}")
+        return len(logs) + backfilled
+
+    def backfill(self, symbol: str, head: int, head_timestamp: int) -> int:
+        """ Find the token's pools and read the backfill window of the ones no other token brought in yet"""
+
+        pools = self.resolve_pools(symbol)
+        with self.lock:
+            new_pools = sorted(set(pools) - set(self.buffers))
+        logs = self.fetch_logs(new_pools, max(head - self.backfill_blocks, 0), head)
+        decoded = self.decode_logs(logs, head, head_timestamp)
+        with self.lock:
+            for pool in new_pools:
+                self.buffers.setdefault(pool, deque(maxlen=self.buffer_size))
+            for pool, swaps in decoded.items():
+                self.buffers[pool].extend(swaps)
+            self.watched[symbol] = pools
+            self.pending.discard(symbol)
+            self.stats["backfills"] += 1
+            self.stats["decoded"] += len(logs)
+        metrics.inc("blockagent_swap_logs_decoded_total", len(logs))
+        return len(logs)
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                with trace("swap_logs_poll"):
+                    self.poll_once()
+            except Exception as e:
+                with self.lock:
+                    self.stats["poll_errors"] += 1
+                metrics.inc("blockagent_swap_logs_polls_total", result="error")
+                logger.warning(f"swap log poll failed: {e}")
+            # a newly asked about token does not wait for the next tick
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+
+    def start(self) -> "SwapLogWatcher":
+        """ Start the background poller"""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="swap-log-poller", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.wake.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {**self.stats, "tokens": sorted(self.watched), "pools": len(self.buffers),
+                    "buffered_swaps": sum(len(buffer) for buffer in self.buffers.values()),
+                    "last_block": self.last_block, "lag": time.time() - self.polled_at if self.polled_at else None}
@@ -2,18 +2,41 @@
 import os
 import json
 import time
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from web3 import Web3
+from web3.exceptions import Web3Exception
 from dotenv import load_dotenv
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
+from src.monitoring.tracing import get_logger, rpc_tracing_middleware
+from src.monitoring.cassette import wrap_provider
+from src.blockchain.resilience import resilient, RPC
 
 
 load_dotenv()
 
+logger = get_logger("transaction")
+
 MODEL_NAME = "gpt-4o-mini"
 PRIVATE_KEY  = os.getenv('PRIVATE_KEY')
 WEB3_PROVIDER_URI = os.getenv('INFURA_KEY')
 
+# what the simulated swap accepts as minimum out, in basis points below the quote
+SWAP_SLIPPAGE_BPS = int(os.getenv("SWAP_SLIPPAGE_BPS", "50"))
+SWAP_DEADLINE_SECONDS = 600
+# wallets pad the estimate, a swap that runs out of gas still pays for it
+GAS_LIMIT_BUFFER = 1.2
+# a typical exactInputSingle, used when eth_estimateGas reverts (no balance or no allowance)
+TYPICAL_SWAP_GAS = 150_000
+# eth_feeHistory over the last blocks, the priority fee percentiles are slow / standard / fast
+FEE_HISTORY_BLOCKS = 5
+REWARD_PERCENTILES = [10, 50, 90]
+FEE_CACHE_BLOCKS = 8
+# the estimate, fee history and nonce requests go out side by side
+rpc_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix="rpc")
 
 
 QUOTER_ABI = json.loads("""
@@ -60,35 +83,25 @@ QUOTER_ABI = json.loads("""
 ]
 """)
 
-# This is the Uniswap ABI, since I am using a simulation, I am not using any smart contract to make a transaction
-# For now, this can be thought of as a placeholder. 
+# SwapRouter's exactInputSingle, the params go in as one struct. Only used to build the calldata that
+# eth_estimateGas runs, nothing is ever sent
 UNISWAP_ABI = json.loads('''[
     {
         "inputs": [
             {
-                "internalType": "uint256",
-                "name": "amountIn",
-                "type": "uint256"
-            },
-            {
-                "internalType": "uint24",
-                "name": "fee",
-                "type": "uint24"
-            },
-            {
-                "internalType": "address",
-                "name": "tokenIn",
-                "type": "address"
-            },
-            {
-                "internalType": "address",
-                "name": "tokenOut",
-                "type": "address"
-            },
-            {
-                "internalType": "uint160",
-                "name": "sqrtPriceLimitX96",
-                "type": "uint160"
+                "components": [
+                    {"internalType": "address", "name": "tokenIn", "type": "address"},
+                    {"internalType": "address", "name": "tokenOut", "type": "address"},
+                    {"internalType": "uint24", "name": "fee", "type": "uint24"},
+                    {"internalType": "address", "name": "recipient", "type": "address"},
+                    {"internalType": "uint256", "name": "deadline", "type": "uint256"},
+                    {"internalType": "uint256", "name": "amountIn", "type": "uint256"},
+                    {"internalType": "uint256", "name": "amountOutMinimum", "type": "uint256"},
+                    {"internalType": "uint160", "name": "sqrtPriceLimitX96", "type": "uint160"}
+                ],
+                "internalType": "struct ISwapRouter.ExactInputSingleParams",
+                "name": "params",
+                "type": "tuple"
             }
         ],
         "name": "exactInputSingle",
@@ -133,23 +146,40 @@ symbol_addr_mapping = {
 
 UNISWAP_CONTRACT_ADDR = "0xE592427A0AEce92De3Edee1F18E0157C05861564"
 QUOTER_CONTRACT_ADDR = "0xb27308f9F90D607463bb33eA1BeBb41C27CE5AB6"
+# the router only trades WETH, native ETH goes in as msg.value
+WETH_ADDR = "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2"
+# estimates without a private key run from / to this address, nothing gets signed
+SIMULATION_ADDR = "0x000000000000000000000000000000000000dEaD"
 
 
 class Web3UHelperClass:
     def __init__(self):
         
 
-        self.w3 = Web3(Web3.HTTPProvider(WEB3_PROVIDER_URI))
+        # the cassette provider records / replays the json-rpc traffic when CASSETTE_MODE is set
+        self.w3 = Web3(wrap_provider(Web3.HTTPProvider(WEB3_PROVIDER_URI)))
+        # every json-rpc request shows up as an rpc span
+        self.w3.middleware_onion.add(rpc_tracing_middleware, "tracing")
 
         if not self.w3.is_connected():
-            print("Infura key probably wrong, check in .env file")
+            logger.warning("Infura key probably wrong, check in .env file")
 
         if PRIVATE_KEY:
             self.account = self.w3.eth.account.from_key(PRIVATE_KEY)
             self.address = self.account.address
         else:
-            print("you have not set any private key, which is needed to send a transaction")
+            self.account = None
+            self.address = None
+            logger.warning("you have not set any private key, which is needed to send a transaction")
+
+        self.router = self.w3.eth.contract(address=UNISWAP_CONTRACT_ADDR, abi=UNISWAP_ABI)
+        self.chain_id = None
+        self.decimals: Dict[str, int] = {}
+        # fee history by block number, every swap simulated in the same block shares one request
+        self.fee_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.fee_lock = threading.Lock()
     
+    @resilient(RPC)
     def get_token_balance(self, token_symbol: str) -> Dict[str, Any]:
 
         """ Get token balance for an address"""
@@ -157,7 +187,7 @@ class Web3UHelperClass:
         # takes the private key, ideally should interact with metamask wallet
         token_address = symbol_addr_mapping.get(token_symbol.upper())
 
-        print(token_address, token_symbol)
+        logger.debug(f"{token_address} {token_symbol}")
         
         if not token_address:
             return {"error": f"Unknown token: {token_symbol}"}
@@ -177,7 +207,7 @@ class Web3UHelperClass:
             ## create checksum address, right now I have cc2 kind of address, it should be Cc2
             token_address = self.w3.to_checksum_address(token_address)
 
-            #token contract object, with two methods: balanceof and decimals
+            #token contract object, the decimals are cached in token_decimals
             token_contract = self.w3.eth.contract(address=token_address, abi=[
                 {
                     "constant": True,
@@ -185,19 +215,12 @@ class Web3UHelperClass:
                     "name": "balanceOf",
                     "outputs": [{"name": "balance", "type": "uint256"}],
                     "type": "function"
-                },
-                {
-                    "constant": True,
-                    "inputs": [],
-                    "name": "decimals",
-                    "outputs": [{"name": "", "type": "uint8"}],
-                    "type": "function"
                 }
             ])
 
             # get the balance and the decimlas, to get the final balance
             balance_raw = token_contract.functions.balanceOf(self.address).call()
-            decimals = token_contract.functions.decimals().call()
+            decimals = self.token_decimals(token_symbol, token_address)
             balance = balance_raw / (10 ** decimals)
             
             return {
@@ -207,10 +230,146 @@ class Web3UHelperClass:
             }
     
 
-    def simulate_swap(self, token_in: str, token_out: str, amount_in: float) -> Dict[str, Any]:
-        """Simulate a token swap without actually executing it on-chain"""
+    def token_decimals(self, token_symbol: str, token_address: str) -> int:
+        """ ERC20 decimals, they never change so each token is only asked once"""
+
+        if token_symbol.upper() == "ETH":
+            return 18
+        if token_address not in self.decimals:
+            token_contract = self.w3.eth.contract(address=token_address, abi=[
+                {
+                    "constant": True,
+                    "inputs": [],
+                    "name": "decimals",
+                    "outputs": [{"name": "", "type": "uint8"}],
+                    "type": "function"
+                }
+            ])
+            self.decimals[token_address] = token_contract.functions.decimals().call()
+        return self.decimals[token_address]
+
+    @resilient(RPC)
+    def quote_swap(self, token_in: str, token_out: str, amount_in: float) -> Dict[str, Any]:
+        """ Ask the quoter contract how many token_out we would get"""
+
+        in_token_address = symbol_addr_mapping.get(token_in.upper())
+        out_token_address = symbol_addr_mapping.get(token_out.upper())
+
+        if not in_token_address or not out_token_address:
+            raise ValueError(f"Unknown token: {token_in if not in_token_address else token_out}")
+
+        # to checksum
+        in_token_checksum = self.w3.to_checksum_address(in_token_address)
+        out_token_checksum = self.w3.to_checksum_address(out_token_address)
+        
+        decimals = self.token_decimals(token_in, in_token_checksum)
+        
+        # native eth blockchain unit
+        amount_in_wei = int(amount_in * (10 ** decimals))
+        
+        # the quoter contract helps us see the exact swap tokens we will get
+        quoter_contract = self.w3.eth.contract(address=QUOTER_CONTRACT_ADDR, abi=QUOTER_ABI)
+        
+        # taking the standard fee tier of 0.3%
+        fee_tier = 3000
+        
+        # Get quoted amount out for the desired token
+        amount_out = quoter_contract.functions.quoteExactInputSingle(
+            in_token_checksum,
+            out_token_checksum,
+            fee_tier,
+            amount_in_wei,
+            0                                   
+        ).call()
         
-        print("Inside simulate swap function")
+        out_decimals = self.token_decimals(token_out, out_token_checksum)
+
+        return {
+            "amount_out": amount_out / (10 ** out_decimals),
+            "fee_tier": fee_tier,
+            # the raw amounts go into the swap calldata
+            "amount_in_raw": amount_in_wei,
+            "amount_out_raw": amount_out
+        }
+
+    def fee_estimate(self) -> Dict[str, Any]:
+        """ Next block's base fee and the slow / standard / fast priority fees from eth_feeHistory, in wei"""
+
+        block = self.w3.eth.block_number
+        with self.fee_lock:
+            if block in self.fee_cache:
+                return self.fee_cache[block]
+
+        history = self.w3.eth.fee_history(FEE_HISTORY_BLOCKS, block, REWARD_PERCENTILES)
+        # the last base fee is the one the next block will charge
+        base_fee = history["baseFeePerGas"][-1]
+        priority_fees = []
+        for i in range(len(REWARD_PERCENTILES)):
+            rewards = sorted(reward[i] for reward in history.get("reward") or [] if len(reward) > i)
+            priority_fees.append(rewards[len(rewards) // 2] if rewards else 0)
+
+        estimate = {
+            "block": block,
+            "base_fee": base_fee,
+            "priority_fee": dict(zip(("slow", "standard", "fast"), priority_fees)),
+        }
+        with self.fee_lock:
+            self.fee_cache[block] = estimate
+            while len(self.fee_cache) > FEE_CACHE_BLOCKS:
+                self.fee_cache.popitem(last=False)
+        return estimate
+
+    def estimate_gas(self, transaction: Dict[str, Any]) -> Tuple[int, Optional[str]]:
+        """ eth_estimateGas for the swap, a revert falls back to a typical swap and says why"""
+
+        try:
+            return self.w3.eth.estimate_gas(transaction), None
+        except (Web3Exception, ValueError) as e:
+            # the usual reasons are a missing balance or token approval, the swap itself is fine
+            return TYPICAL_SWAP_GAS, str(e)
+
+    def get_chain_id(self) -> int:
+        if self.chain_id is None:
+            self.chain_id = self.w3.eth.chain_id
+        return self.chain_id
+
+    def get_nonce(self) -> Optional[int]:
+        return self.w3.eth.get_transaction_count(self.address, "pending") if self.address else None
+
+    def build_swap(self, token_in: str, token_out: str, quote: Dict[str, Any]) -> Dict[str, Any]:
+        """ The exactInputSingle transaction for a quote, with amountOutMinimum set from the slippage"""
+
+        in_token = WETH_ADDR if token_in.upper() in ("ETH", "WETH") else symbol_addr_mapping[token_in.upper()]
+        out_token = WETH_ADDR if token_out.upper() in ("ETH", "WETH") else symbol_addr_mapping[token_out.upper()]
+        sender = self.address or SIMULATION_ADDR
+        params = (
+            self.w3.to_checksum_address(in_token),
+            self.w3.to_checksum_address(out_token),
+            quote["fee_tier"],
+            sender,
+            int(time.time()) + SWAP_DEADLINE_SECONDS,
+            quote["amount_in_raw"],
+            quote["amount_out_raw"] * (10_000 - SWAP_SLIPPAGE_BPS) // 10_000,
+            0
+        )
+        return {
+            "from": sender,
+            "to": UNISWAP_CONTRACT_ADDR,
+            "data": self.router.encodeABI(fn_name="exactInputSingle", args=[params]),
+            "value": quote["amount_in_raw"] if token_in.upper() == "ETH" else 0
+        }
+
+    # the nonce, fees and signed hash are only true right now, so only the deadline and breaker apply
+    @resilient(RPC, keep=False)
+    def simulate_swap(self, token_in: str, token_out: str, amount_in: float, quote: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Simulate a token swap without actually executing it on-chain
+
+        The exactInputSingle call is built and estimated against the node, with the fee history and
+        nonce fetched alongside, and signed locally but never sent.
+        quote can be passed in when we already have a recent one (see src/blockchain/prefetcher.py)
+        """
+        
+        logger.debug("Inside simulate swap function")
         in_token_address = symbol_addr_mapping.get(token_in.upper())
         out_token_address = symbol_addr_mapping.get(token_out.upper())
         
@@ -218,80 +377,74 @@ class Web3UHelperClass:
             return {"error": f"Unknown token: {token_in if not in_token_address else token_out}"}
         
         try:
-            
-            # to checksum
-            in_token_checksum = self.w3.to_checksum_address(in_token_address)
-            out_token_checksum = self.w3.to_checksum_address(out_token_address)
-            
-            # Get token decimals, I've hardcoded this for now.
-            decimals = 18 
-
-            if token_in.upper() != "ETH":
-                token_contract = self.w3.eth.contract(address=in_token_checksum, abi=[
-                    {
-                        "constant": True,
-                        "inputs": [],
-                        "name": "decimals",
-                        "outputs": [{"name": "", "type": "uint8"}],
-                        "type": "function"
-                    }
-                ])
-                decimals = token_contract.functions.decimals().call()
-            
-            # native eth blockchain unit
-            amount_in_wei = int(amount_in * (10 ** decimals))
-            
-            # the quoter contract helps us see the exact swap tokens we will get
-            quoter_contract = self.w3.eth.contract(address=QUOTER_CONTRACT_ADDR, abi=QUOTER_ABI)
-            
-            # taking the standard fee tier of 0.3%
-            fee_tier = 3000
-            
-            # Get quoted amount out for the desired token
-            amount_out = quoter_contract.functions.quoteExactInputSingle(
-                in_token_checksum,
-                out_token_checksum,
-                fee_tier,
-                amount_in_wei,
-                0                                   
-            ).call()
-            
-            out_decimals = 18
-            if token_out.upper() != "ETH":
-                out_token_contract = self.w3.eth.contract(address=out_token_checksum, abi=[
-                    {
-                        "constant": True,
-                        "inputs": [],
-                        "name": "decimals",
-                        "outputs": [{"name": "", "type": "uint8"}],
-                        "type": "function"
-                    }
-                ])
-                out_decimals = out_token_contract.functions.decimals().call()
-            
-            amount_out_float = amount_out / (10 ** out_decimals)
-            
-            # this is a fake transaction hash.
-            tx_hash = self.w3.keccak(text=f"simulated_swap_between_{token_in}_and_{token_out}_for_{amount_in}_at_{time.time()}")
-            
-            return {
+            if quote is None:
+                quote = self.quote_swap(token_in, token_out, amount_in)
+
+            amount_out_float = quote["amount_out"]
+            fee_tier = quote["fee_tier"]
+            transaction = self.build_swap(token_in, token_out, quote)
+
+            # the requests do not depend on each other, the rpc spans stay under the caller's trace
+            gas_future = rpc_executor.submit(contextvars.copy_context().run, self.estimate_gas, transaction)
+            fees_future = rpc_executor.submit(contextvars.copy_context().run, self.fee_estimate)
+            nonce_future = rpc_executor.submit(contextvars.copy_context().run, self.get_nonce)
+            chain_id = self.get_chain_id()
+            gas_estimate, revert_reason = gas_future.result()
+            fees = fees_future.result()
+            nonce = nonce_future.result()
+
+            gas_limit = int(gas_estimate * GAS_LIMIT_BUFFER)
+            base_fee = fees["base_fee"]
+            priority_fee = fees["priority_fee"]["standard"]
+            # what wallets set: room for the base fee to double before the transaction is priced out
+            max_fee = 2 * base_fee + priority_fee
+            slippage = SWAP_SLIPPAGE_BPS / 10_000
+
+            result = {
                 "success": True,
-                "transaction_hash": tx_hash.hex(),
                 "token_in": token_in.upper(),
                 "token_out": token_out.upper(),
                 "amount_in": amount_in,
                 "amount_out": amount_out_float,
+                "minimum_amount_out": amount_out_float * (1 - slippage),
+                "slippage_tolerance": slippage * 100,
                 "price_per_token": amount_out_float / amount_in if amount_in > 0 else 0,
                 "fee_tier": fee_tier / 10000,
+                "pool_fee": amount_in * fee_tier / 1_000_000,
+                "gas_estimate": gas_estimate,
+                "gas_limit": gas_limit,
+                "gas_estimate_source": "eth_estimateGas" if revert_reason is None else "typical swap",
+                "base_fee_gwei": float(self.w3.from_wei(base_fee, "gwei")),
+                "priority_fee_gwei": {speed: float(self.w3.from_wei(fee, "gwei")) for speed, fee in fees["priority_fee"].items()},
+                "max_fee_gwei": float(self.w3.from_wei(max_fee, "gwei")),
+                "network_fee_eth": float(self.w3.from_wei(gas_estimate * (base_fee + priority_fee), "ether")),
+                "max_network_fee_eth": float(self.w3.from_wei(gas_limit * max_fee, "ether")),
+                "fee_block": fees["block"],
+                "nonce": nonce,
+                "chain_id": chain_id,
                 "status": "simulated"
             }
+            if revert_reason is not None:
+                result["estimate_reverted"] = revert_reason
+
+            calldata = {**transaction, "gas": gas_limit, "maxFeePerGas": max_fee,
+                        "maxPriorityFeePerGas": priority_fee, "chainId": chain_id, "type": 2}
+            if self.account is not None:
+                # signed, never broadcast: the hash is the one the swap would have if it were sent now
+                calldata["nonce"] = nonce
+                signed = self.account.sign_transaction({key: value for key, value in calldata.items() if key != "from"})
+                result["transaction_hash"] = signed.hash.hex()
+            result["calldata"] = calldata
+            if "as_of" in quote:
+                result["quote_as_of"] = quote["as_of"]
+            return result
         
         except Exception as e:
-            print(f"Simulation error: {e}")
+            logger.error(f"Simulation error: {e}")
             return {
                 "success": False,
                 "error": str(e),
                 "token_in": token_in.upper(),
                 "token_out": token_out.upper(),
                 "amount_in": amount_in
-            }
\ No newline at end of file
+            }
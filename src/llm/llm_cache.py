@@ -0,0 +1,188 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from dotenv import load_dotenv
+from typing import Dict, Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.outputs import Generation
+from langchain_core.load import dumps, loads
+
+from src.monitoring.tracing import get_logger, record_cache
+
+logger = get_logger("llm_cache")
+
+
+load_dotenv()
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+
+PUNCTUATION = re.compile(r"[?!.,;:]+(\s|$)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """ Lower case, drop trailing punctuation on words and collapse whitespace"""
+
+    text = PUNCTUATION.sub(r"\1", text.casefold())
+    return WHITESPACE.sub(" ", text).strip()
+
+
+def normalize_prompt(prompt: str) -> str:
+    """ Normalise the serialized chat prompt, so "Check my WETH balance" and "check my weth balance?" share a key.
+
+        For chat models langchain hands us the messages serialized as json, we normalise each message's
+        content and keep the role, anything else is normalised as plain text.
+    """
+
+    try:
+        messages = json.loads(prompt)
+    except json.JSONDecodeError:
+        return normalize_text(prompt)
+
+    if not isinstance(messages, list):
+        return normalize_text(prompt)
+
+    normalized = []
+    for message in messages:
+        kwargs = message.get("kwargs", {}) if isinstance(message, dict) else {}
+        role = kwargs.get("type", "")
+        content = kwargs.get("content", "")
+        if not isinstance(content, str):
+            content = json.dumps(content, sort_keys=True)
+        normalized.append(f"{role}: {normalize_text(content)}")
+    return "\n".join(normalized)
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    return hashlib.sha256(f"{llm_string}\x00{prompt}".encode()).hexdigest()
+
+
+class SQLiteLLMCache(BaseCache):
+    """ On disk LLM cache with an exact and a normalised lookup, bounded with LRU eviction.
+
+        The llm_string (model name, temperature, response format ...) is part of both keys,
+        so the classifier and the extraction prompts never read each other's answers.
+    """
+
+    def __init__(self, database_path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        if os.path.dirname(database_path):
+            os.makedirs(os.path.dirname(database_path), exist_ok=True)
+
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                normalized_key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_normalized ON llm_cache(normalized_key)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)")
+        self.connection.commit()
+
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        self.stats = {"exact_hits": 0, "normalized_hits": 0, "misses": 0, "evictions": 0}
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        """ Exact match first, then the normalised prompt"""
+
+        key = cache_key(prompt, llm_string)
+        with self.lock:
+            row = self.connection.execute("SELECT key, value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            hit_type = "exact_hits"
+
+            if row is None:
+                normalized_key = cache_key(normalize_prompt(prompt), llm_string)
+                row = self.connection.execute(
+                    "SELECT key, value FROM llm_cache WHERE normalized_key = ? ORDER BY last_access DESC LIMIT 1",
+                    (normalized_key,)).fetchone()
+                hit_type = "normalized_hits"
+
+            if row is None:
+                self.stats["misses"] += 1
+                record_cache("llm", False)
+                return None
+
+            self.stats[hit_type] += 1
+            record_cache("llm", True)
+            self.connection.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), row[0]))
+            self.connection.commit()
+
+        try:
+            return [loads(generation) for generation in json.loads(row[1])]
+        except Exception as e:
+            # written by an incompatible langchain version, treat as a miss
+            logger.warning(f"could not load cached llm response: {e}")
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Generation]) -> None:
+        """ Store the generations and evict the least recently used entries above the size limit"""
+
+        key = cache_key(prompt, llm_string)
+        normalized_key = cache_key(normalize_prompt(prompt), llm_string)
+        value = json.dumps([dumps(generation) for generation in return_val])
+
+        with self.lock:
+            exists = self.connection.execute("SELECT 1 FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, normalized_key, value, last_access) VALUES (?, ?, ?, ?)",
+                (key, normalized_key, value, time.time()))
+            if exists is None:
+                self.entries += 1
+
+            if self.entries > self.max_entries:
+                overflow = self.entries - self.max_entries
+                self.connection.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,))
+                self.entries -= overflow
+                self.stats["evictions"] += overflow
+            self.connection.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        """ Drop every cached response"""
+
+        with self.lock:
+            self.connection.execute("DELETE FROM llm_cache")
+            self.connection.commit()
+            self.entries = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ Hit/miss counters and the current size"""
+
+        with self.lock:
+            lookups = self.stats["exact_hits"] + self.stats["normalized_hits"] + self.stats["misses"]
+            hits = self.stats["exact_hits"] + self.stats["normalized_hits"]
+            return {
+                **self.stats,
+                "entries": self.entries,
+                "max_entries": self.max_entries,
+                "hit_rate": hits / lookups if lookups else 0.0
+            }
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[SQLiteLLMCache]:
+    """ The process wide cache shared by every ChatOpenAI handle, set LLM_CACHE_PATH to an empty string to disable it"""
+
+    global _llm_cache
+    if not LLM_CACHE_PATH:
+        return None
+
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = SQLiteLLMCache()
+        return _llm_cache
@@ -0,0 +1,119 @@
+import time
+import threading
+from typing import Any, Callable, Dict, List
+
+from src.llm.rate_limiter import current_priority
+from src.monitoring.tracing import metrics
+
+
+metrics.describe("blockagent_llm_batch_size", "histogram", "Calls sent together by a micro-batcher")
+metrics.describe("blockagent_llm_batch_wait_seconds", "histogram", "Time a call waited for its micro-batch to go out")
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class Pending:
+    """ One caller waiting in a micro-batcher """
+
+    __slots__ = ("item", "priority", "queued_at", "wake", "finished", "result", "error")
+
+    def __init__(self, item: Any):
+        self.item = item
+        self.priority = current_priority.get()
+        self.queued_at = time.monotonic()
+        self.wake = threading.Event()
+        self.finished = False
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """ Collects calls for up to window seconds and hands them to send_batch together.
+
+        There is no dispatcher thread: the first caller of a window waits it out and sends the batch
+        from its own thread, so the llm span lands in a real turn's trace. The batch goes at the most
+        urgent priority among its callers. The others sleep until their result is in; if more than
+        max_size arrive, the oldest one left over leads the next batch.
+    """
+
+    def __init__(self, name: str, send_batch: Callable[[List[Any]], List[Any]], window: float, max_size: int):
+        self.name = name
+        self.send_batch = send_batch
+        self.window = window
+        self.max_size = max(max_size, 1)
+        self.condition = threading.Condition()
+        self.queue: List[Pending] = []
+        self.leader = None
+        self.stats = {"batches": 0, "calls": 0, "largest_batch": 0, "total_wait": 0.0}
+
+    def submit(self, item: Any) -> Any:
+        """ Block until item went out in a batch, returns its result or raises the batch's error"""
+
+        pending = Pending(item)
+        with self.condition:
+            self.queue.append(pending)
+            if self.leader is None:
+                self.leader = pending
+            elif len(self.queue) >= self.max_size:
+                self.condition.notify_all()
+
+        if self.leader is not pending:
+            pending.wake.wait()
+        if not pending.finished:
+            # we lead the next batch, either from the start or handed over by the last leader
+            self.lead(pending)
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def lead(self, pending: Pending) -> None:
+        deadline = pending.queued_at + self.window
+        with self.condition:
+            while len(self.queue) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.queue[:self.max_size]
+            del self.queue[:self.max_size]
+            if self.queue:
+                self.leader = self.queue[0]
+                self.leader.wake.set()
+            else:
+                self.leader = None
+
+        sent_at = time.monotonic()
+        waited = [sent_at - waiting.queued_at for waiting in batch]
+        metrics.observe("blockagent_llm_batch_size", len(batch), buckets=BATCH_SIZE_BUCKETS, batcher=self.name)
+        for seconds in waited:
+            metrics.observe("blockagent_llm_batch_wait_seconds", seconds, batcher=self.name)
+        with self.condition:
+            self.stats["batches"] += 1
+            self.stats["calls"] += len(batch)
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+            self.stats["total_wait"] += sum(waited)
+
+        token = current_priority.set(min(waiting.priority for waiting in batch))
+        try:
+            results = self.send_batch([waiting.item for waiting in batch])
+            for waiting, result in zip(batch, results):
+                waiting.result = result
+        except Exception as e:
+            for waiting in batch:
+                waiting.error = e
+        finally:
+            current_priority.reset(token)
+            for waiting in batch:
+                waiting.finished = True
+                waiting.wake.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ Batches sent, average size and the latency the window added"""
+
+        with self.condition:
+            stats = dict(self.stats)
+        total_wait = stats.pop("total_wait")
+        stats["avg_batch_size"] = stats["calls"] / stats["batches"] if stats["batches"] else 0.0
+        stats["avg_wait"] = total_wait / stats["calls"] if stats["calls"] else 0.0
+        return stats
@@ -0,0 +1,57 @@
+import hashlib
+import textwrap
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, AIMessage
+
+
+LANGCHAIN_MESSAGES = {"system": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+
+
+def static_prompt(text: str) -> str:
+    """ Dedent and strip a triple quoted prompt, so the same instructions are the same bytes wherever they are written"""
+
+    return textwrap.dedent(text).strip()
+
+
+class PromptTemplate:
+    """ The static instructions and examples of one kind of llm call, always sent first and byte for byte the same.
+
+        What changes per turn goes after it, least volatile first: the conversation history, then the
+        data for this turn, then the query. OpenAI serves a repeated prompt prefix (1024 tokens and up)
+        from its cache, which is only possible when nothing per turn is mixed into the instructions.
+    """
+
+    def __init__(self, name: str, instructions: str):
+        self.name = name
+        self.instructions = static_prompt(instructions)
+        # shows up on the llm spans, calls with the same id share their prefix
+        self.prefix_id = hashlib.sha256(self.instructions.encode()).hexdigest()[:12]
+
+    def parts(self, query: Optional[str] = None, history: Optional[str] = None,
+              context: Optional[str] = None) -> List[Tuple[str, str]]:
+        """ (role, content) pairs in cache friendly order"""
+
+        parts = [("system", self.instructions)]
+        if history is not None:
+            parts.append(("user", "Conversation history:\n" + (history.strip() or "(none)")))
+        tail = []
+        if context is not None:
+            tail.append(context.strip())
+        if query is not None:
+            tail.append(f"User query: {query.strip()}")
+        if tail:
+            parts.append(("user", "\n\n".join(tail)))
+        return parts
+
+    def chat_messages(self, query: Optional[str] = None, history: Optional[str] = None,
+                      context: Optional[str] = None) -> List[BaseMessage]:
+        """ For ChatOpenAI"""
+
+        return [LANGCHAIN_MESSAGES[role](content=content) for role, content in self.parts(query, history, context)]
+
+    def openai_messages(self, query: Optional[str] = None, history: Optional[str] = None,
+                        context: Optional[str] = None) -> List[Dict[str, str]]:
+        """ For client.chat.completions.create"""
+
+        return [{"role": role, "content": content} for role, content in self.parts(query, history, context)]
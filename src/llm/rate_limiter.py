@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import time
+import heapq
+import random
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from src.monitoring.tracing import get_logger, metrics
+
+
+load_dotenv()
+
+logger = get_logger("rate_limiter")
+
+# "0" sends llm calls straight to OpenAI, like before
+RATE_LIMIT_ENABLED = os.getenv("LLM_RATE_LIMIT", "1") == "1"
+# starting budgets per model, replaced by the x-ratelimit-limit-* headers after the first response
+DEFAULT_RPM = int(os.getenv("OPENAI_RPM", "500"))
+DEFAULT_TPM = int(os.getenv("OPENAI_TPM", "30000"))
+# share of the account's budget this process may use, every worker process gets 1 / BLOCKAGENT_WORKERS
+BUDGET_SHARE = float(os.getenv("LLM_BUDGET_SHARE", "1"))
+# how many seconds of budget can go out in one burst, the rest is spread evenly over the minute
+BURST_SECONDS = float(os.getenv("LLM_BURST_SECONDS", "10"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# what a call with no max_tokens is expected to generate, settled against the real usage afterwards
+DEFAULT_COMPLETION_TOKENS = 256
+
+# lower runs first. a call is never more urgent than the work it belongs to, see llm_priority
+PRIORITY_CRITICAL = 0       # classification and the final response, the user waits on the first token
+PRIORITY_EXTRACTION = 1     # parameter extraction for a route that was already chosen
+PRIORITY_SPECULATIVE = 2    # extraction started before the route is known, may be thrown away
+PRIORITY_BACKGROUND = 3     # batch runs and anything else nobody is watching
+
+current_priority = contextvars.ContextVar("current_llm_priority", default=PRIORITY_CRITICAL)
+
+metrics.describe("blockagent_llm_scheduler_wait_seconds", "histogram", "Time llm calls waited for rate limit budget")
+metrics.describe("blockagent_llm_rate_limited_total", "counter", "429 responses from OpenAI")
+metrics.describe("blockagent_llm_budget_remaining", "gauge", "Requests / tokens left in the local budget")
+
+
+@contextmanager
+def llm_priority(priority: int):
+    """ Run the llm calls in this block at priority, or lower if the surrounding work already is"""
+
+    token = current_priority.set(max(current_priority.get(), priority))
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """ OpenAI's reset headers look like "6m0s", "1.5s" or "20ms" """
+
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def estimate_request_tokens(body: Dict[str, Any]) -> int:
+    """ Rough prompt + completion tokens for a chat completion request body, 4 characters a token"""
+
+    prompt_characters = 0
+    for message in body.get("messages", []):
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        prompt_characters += len(content) + 16
+    completion_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or DEFAULT_COMPLETION_TOKENS
+    return prompt_characters // 4 + completion_tokens
+
+
+class TokenBucket:
+    """ Refills at limit per minute, holds at most BURST_SECONDS worth """
+
+    def __init__(self, limit_per_minute: float):
+        self.level = 0.0
+        self.rate = 0.0
+        self.capacity = 0.0
+        self.updated = time.monotonic()
+        self.set_limit(limit_per_minute)
+        self.level = self.capacity
+
+    def set_limit(self, limit_per_minute: float) -> None:
+        self.refill()
+        self.limit = limit_per_minute
+        self.rate = limit_per_minute / 60.0
+        self.capacity = max(self.rate * BURST_SECONDS, 1.0)
+        self.level = min(self.level, self.capacity)
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        """ Seconds until amount is available. Requests bigger than the bucket go when it is full"""
+
+        self.refill()
+        needed = min(amount, self.capacity) - self.level
+        return max(needed, 0.0) / self.rate if self.rate else float("inf")
+
+    def take(self, amount: float) -> None:
+        self.refill()
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ModelBudget:
+    """ Request and token buckets for one model, kept in line with what OpenAI reports """
+
+    def __init__(self, rpm: float, tpm: float, share: float = 1.0):
+        self.share = share
+        self.requests = TokenBucket(rpm * share)
+        self.tokens = TokenBucket(tpm * share)
+        self.blocked_until = 0.0
+
+    def time_until(self, tokens: int) -> float:
+        blocked = max(self.blocked_until - time.monotonic(), 0.0)
+        return max(blocked, self.requests.time_until(1), self.tokens.time_until(tokens))
+
+    def take(self, tokens: int) -> None:
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def observe_headers(self, headers: httpx.Headers) -> None:
+        """ Adopt the account limits and never believe we have more left than OpenAI says"""
+
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit and limit.isdigit() and int(limit) * self.share != bucket.limit:
+                bucket.set_limit(int(limit) * self.share)
+            if remaining and remaining.isdigit():
+                bucket.refill()
+                bucket.level = min(bucket.level, float(remaining))
+
+    def block(self, seconds: float) -> None:
+        """ After a 429 nobody sends to this model until the backoff is over, and the buckets start empty"""
+
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.requests.level = min(self.requests.level, 0.0)
+        self.tokens.level = min(self.tokens.level, 0.0)
+
+
+class LLMScheduler:
+    """ Hands out OpenAI budget per model in priority order.
+
+        Callers wait in a heap per model; only the head of the heap may take budget, so a long
+        extraction prompt cannot be overtaken forever by short ones, and a critical call that
+        arrives later still goes before the background work that is waiting.
+    """
+
+    def __init__(self, rpm: float = DEFAULT_RPM, tpm: float = DEFAULT_TPM, max_retries: int = MAX_RETRIES,
+                 share: float = BUDGET_SHARE):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.share = share
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.budgets: Dict[str, ModelBudget] = {}
+        self.waiting: Dict[str, List[Tuple[int, int]]] = {}
+        self.counter = itertools.count()
+
+    def budget(self, model: str) -> ModelBudget:
+        if model not in self.budgets:
+            self.budgets[model] = ModelBudget(self.rpm, self.tpm, self.share)
+            self.waiting[model] = []
+        return self.budgets[model]
+
+    def acquire(self, model: str, tokens: int, priority: int) -> float:
+        """ Block until the call may go out, returns the seconds waited"""
+
+        start = time.monotonic()
+        with self.condition:
+            budget = self.budget(model)
+            queue = self.waiting[model]
+            ticket = (priority, next(self.counter))
+            heapq.heappush(queue, ticket)
+            try:
+                while True:
+                    if queue[0] == ticket:
+                        delay = budget.time_until(tokens)
+                        if delay <= 0:
+                            budget.take(tokens)
+                            break
+                        self.condition.wait(min(delay, 1.0))
+                    else:
+                        self.condition.wait(1.0)
+            finally:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self.condition.notify_all()
+
+        waited = time.monotonic() - start
+        metrics.observe("blockagent_llm_scheduler_wait_seconds", waited, model=model, priority=str(priority))
+        return waited
+
+    def settle(self, model: str, estimated: int, actual: int) -> None:
+        """ Correct the token bucket once the real usage is known"""
+
+        with self.condition:
+            budget = self.budget(model)
+            if actual < estimated:
+                budget.tokens.give_back(estimated - actual)
+            else:
+                budget.tokens.take(actual - estimated)
+            self.condition.notify_all()
+
+    def observe(self, model: str, headers: httpx.Headers) -> None:
+        with self.condition:
+            budget = self.budget(model)
+            budget.observe_headers(headers)
+            metrics.set_gauge("blockagent_llm_budget_remaining", budget.requests.level, model=model, kind="requests")
+            metrics.set_gauge("blockagent_llm_budget_remaining", budget.tokens.level, model=model, kind="tokens")
+            self.condition.notify_all()
+
+    def backoff(self, model: str, attempt: int, headers: httpx.Headers) -> float:
+        """ Jittered delay after a 429, shared by every caller of the model"""
+
+        retry_after = parse_duration(headers.get("retry-after")) or max(
+            parse_duration(headers.get("x-ratelimit-reset-requests")) or 0.0,
+            parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0)
+        if retry_after:
+            # spread the callers that were told the same reset time a little
+            delay = retry_after * random.uniform(1.0, 1.25)
+        else:
+            delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+        metrics.inc("blockagent_llm_rate_limited_total", model=model)
+        with self.condition:
+            self.budget(model).block(delay)
+            self.condition.notify_all()
+        logger.warning(f"rate limited on {model}, backing off {delay:.2f}s (attempt {attempt + 1})")
+        return delay
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """ httpx transport for the OpenAI clients, chat completions go through the scheduler.
+
+        Sitting under the clients means cache hits and cassette replays never touch the budget,
+        and a 429 is retried here before the client ever sees it.
+    """
+
+    def __init__(self, scheduler: LLMScheduler, transport: Optional[httpx.BaseTransport] = None):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method != "POST" or not request.url.path.endswith("/chat/completions"):
+            return self.transport.handle_request(request)
+
+        body = json.loads(request.read() or b"{}")
+        model = body.get("model", "unknown")
+        estimated = estimate_request_tokens(body)
+        priority = current_priority.get()
+
+        for attempt in range(self.scheduler.max_retries + 1):
+            self.scheduler.acquire(model, estimated, priority)
+            response = self.transport.handle_request(request)
+            self.scheduler.observe(model, response.headers)
+
+            if response.status_code == 429 and attempt < self.scheduler.max_retries:
+                response.close()
+                time.sleep(self.scheduler.backoff(model, attempt, response.headers))
+                continue
+            break
+
+        if response.status_code != 200 or body.get("stream"):
+            return response
+
+        # read the body here so the usage can settle the estimate, the client gets the same bytes
+        raw = b"".join(response.stream)
+        response.close()
+        buffered = httpx.Response(response.status_code, headers=response.headers, stream=httpx.ByteStream(raw),
+                                  request=request, extensions=response.extensions)
+        buffered.read()
+        try:
+            usage = json.loads(buffered.content).get("usage") or {}
+            self.scheduler.settle(model, estimated, usage.get("total_tokens", estimated))
+        except ValueError:
+            pass
+        return buffered
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_llm_http_client() -> Optional[httpx.Client]:
+    """ Shared httpx client for every OpenAI / ChatOpenAI handle, None when rate limiting is off"""
+
+    global _http_client
+    if not RATE_LIMIT_ENABLED:
+        return None
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(transport=RateLimitedTransport(LLMScheduler()),
+                                        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+        return _http_client
@@ -0,0 +1,184 @@
+import io
+import csv
+import json
+import math
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+from src.monitoring.tracing import get_logger, metrics
+
+logger = get_logger("result_compactor")
+
+metrics.describe("blockagent_prompt_tokens_saved_total", "counter",
+                 "Prompt tokens saved by compacting results, by query type")
+
+
+# Nobody reads entity ids or token decimals in the explanation, the symbols are enough, nor the simulated swap calldata.
+# The transaction hash is not in here, the transaction agent is asked to display it.
+DROPPED_FIELDS = {"id", "decimals", "calldata"}
+
+TIMESTAMP_FIELDS = {"timestamp"}
+
+# numbers the subgraph and the tools send as strings: amounts, USD values, prices, fees, balances. Other strings
+# are left alone even when float() would take them, a token symbol like "INF" or "NAN" stays a symbol
+NUMERIC_FIELD_WORDS = ("amount", "usd", "price", "value", "balance", "fee", "liquidity", "volume", "tvl", "gas")
+
+
+def is_numeric_field(key: str) -> bool:
+    return any(word in key.lower() for word in NUMERIC_FIELD_WORDS)
+
+
+def round_number(value: float) -> str:
+    """ 2 decimals for anything >= 1, 6 significant digits for small amounts like token prices"""
+
+    if not math.isfinite(value):
+        return str(value)
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    if abs(value) >= 1:
+        return f"{value:.2f}"
+    return f"{value:.6g}"
+
+
+def compact_value(key: str, value: Any) -> Any:
+    """ Round numbers (the subgraph sends them as strings) and make timestamps readable"""
+
+    if isinstance(value, bool) or value is None:
+        return value
+
+    if key in TIMESTAMP_FIELDS:
+        try:
+            return datetime.fromtimestamp(int(value), tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        except (TypeError, ValueError, OverflowError):
+            return value
+
+    if isinstance(value, (int, float)):
+        return round_number(float(value))
+
+    if isinstance(value, str) and is_numeric_field(key):
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return round_number(number) if math.isfinite(number) else value
+
+    return value
+
+
+def flatten(record: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    """ Flatten nested objects, {"token0": {"symbol": "WETH"}} becomes {"token0_symbol": "WETH"}"""
+
+    flat = {}
+    for key, value in record.items():
+        if key in DROPPED_FIELDS:
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix=f"{name}_"))
+        else:
+            flat[name] = compact_value(key, value)
+    return flat
+
+
+def render_rows(name: str, rows: List[Any]) -> str:
+    """ Render a list of records as a header line plus one csv row per record"""
+
+    if not rows:
+        return f"{name}: none"
+
+    if not all(isinstance(row, dict) for row in rows):
+        return f"{name}: " + ", ".join(str(compact_value(name, row)) for row in rows)
+
+    flat_rows = [flatten(row) for row in rows]
+    header = []
+    for row in flat_rows:
+        header.extend(key for key in row if key not in header)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(header)
+    for row in flat_rows:
+        writer.writerow(["" if row.get(key) is None else row.get(key) for key in header])
+
+    return f"{name} ({len(rows)} rows):\n{buffer.getvalue().rstrip()}"
+
+
+def render_result(result: Any) -> str:
+    """ The compact text form of a subgraph or transaction result"""
+
+    if not isinstance(result, dict):
+        if isinstance(result, list):
+            return render_rows("results", result)
+        return str(result)
+
+    lines = []
+    scalars = {}
+    for key, value in result.items():
+        if key in DROPPED_FIELDS:
+            continue
+        if isinstance(value, list):
+            lines.append(render_rows(key, value))
+        elif isinstance(value, dict):
+            scalars.update(flatten(value, prefix=f"{key}_"))
+        else:
+            scalars[key] = compact_value(key, value)
+
+    scalar_lines = [f"{key}: {value}" for key, value in scalars.items()]
+    return "\n".join(scalar_lines + lines)
+
+
+class ResultCompactor:
+    """ Compacts results before they go into the response prompt and keeps count of the tokens it saved """
+
+    def __init__(self):
+        self.encoding = None
+        self.encoding_loaded = False
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+
+    def count_tokens(self, text: str) -> int:
+        """ Count tokens with tiktoken, ~4 characters per token if the encoding is not available (offline)"""
+
+        if not self.encoding_loaded:
+            try:
+                import tiktoken
+                self.encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                logger.warning(f"tiktoken not available, estimating token counts: {e}")
+            self.encoding_loaded = True
+
+        if self.encoding is None:
+            return len(text) // 4
+        return len(self.encoding.encode(text))
+
+    def compact(self, result: Any, query_type: Optional[str] = None) -> str:
+        """ Compact the result and record the saving under its query type"""
+
+        compacted = render_result(result)
+
+        original_tokens = self.count_tokens(json.dumps(result, indent=2, default=str))
+        compact_tokens = self.count_tokens(compacted)
+
+        with self.lock:
+            stats = self.stats.setdefault(query_type or "unknown",
+                                          {"calls": 0, "original_tokens": 0, "compact_tokens": 0})
+            stats["calls"] += 1
+            stats["original_tokens"] += original_tokens
+            stats["compact_tokens"] += compact_tokens
+        metrics.inc("blockagent_prompt_tokens_saved_total", original_tokens - compact_tokens,
+                    query_type=query_type or "unknown")
+
+        return compacted
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """ Tokens saved per query type"""
+
+        with self.lock:
+            return {query_type: {**stats,
+                                 "tokens_saved": stats["original_tokens"] - stats["compact_tokens"],
+                                 "avg_tokens_saved": (stats["original_tokens"] - stats["compact_tokens"]) / stats["calls"]}
+                    for query_type, stats in self.stats.items()}
+
+
+result_compactor = ResultCompactor()
@@ -1,6 +1,8 @@
 from pydantic import BaseModel, Field
 from typing import Dict, List, Any, Optional
 
+from src.memory.snapshot import encode_snapshot, decode_snapshot
+
 
 # I've created this class instead of using the memory saver, because I do not want persistent memory for this use case. 
 # This was easier to implement for a smaller demo. However, I'd use a better memory manager class for an actual app, 
@@ -26,9 +28,15 @@ class MessagesMemory(BaseModel):
 
         messages = self.messages[-n:]
         return "\n".join([f"{msg.role}: {msg.content}" for msg in messages])
+
+    def preview_message_history(self, pending: List[Message], n: int = 10) -> str:
+        """ Get the message history as it will look once the pending messages are added, without adding them"""
+
+        messages = (self.messages + pending)[-n:]
+        return "\n".join([f"{msg.role}: {msg.content}" for msg in messages])
     
     def update_entity(self, key: str, value: Any) -> None:
-        """ Update an extracted entity : tokens, addresses, etc"""
+        """ Update an extracted entity : tokens, addresses, etc. Values must be json values, they go into snapshots"""
 
         self.extracted_entities[key] = value
     
@@ -37,6 +45,20 @@ class MessagesMemory(BaseModel):
         
         return self.extracted_entities.get(key)
     
+    def snapshot(self, compress: Optional[bool] = None) -> bytes:
+        """ Compact binary copy of the messages and entities, see src/memory/snapshot.py"""
+
+        return encode_snapshot(self.messages, self.extracted_entities, compress)
+
+    @classmethod
+    def restore(cls, data: bytes) -> "MessagesMemory":
+        """ A memory from a snapshot"""
+
+        messages, entities = decode_snapshot(data)
+        # validating plain dicts in one go is faster than building the Message objects here
+        return cls.model_validate({"messages": [{"role": role, "content": content} for role, content in messages],
+                                   "extracted_entities": entities})
+
     def reset(self) -> None:
         """ Clear all memory"""
         self.messages.clear()
@@ -0,0 +1,282 @@
+import os
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import Dict, Iterable, Optional, Tuple
+
+from src.memory.memory_utils import MessagesMemory
+from src.memory.snapshot import SnapshotError
+from src.monitoring.tracing import get_logger, metrics
+
+
+load_dotenv()
+
+logger = get_logger("session_store")
+
+# where session snapshots go: a path ending in .sqlite / .db is a SQLite file, anything else a directory.
+# Empty (the default) keeps conversations in process memory only
+SESSION_STORE = os.getenv("SESSION_STORE", "")
+# write-behind: snapshots are batched and written at most this often, a crash loses at most this much
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0"))
+SESSION_FLUSH_BATCH = 256
+# live memories kept per process with a store, the least recently used ones are read back from it when needed
+SESSION_MAX_LIVE = int(os.getenv("SESSION_MAX_LIVE", "1024"))
+# a session idle this long is dropped from process memory, with a store it is read back if it returns
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+
+metrics.describe("blockagent_session_store_writes_total", "counter", "Session snapshots written or deleted by the store")
+metrics.describe("blockagent_session_store_flush_seconds", "histogram", "Time to write one batch of session snapshots")
+metrics.describe("blockagent_session_evictions_total", "counter", "Live session memories dropped from process memory, by reason")
+
+
+class DirectorySessionStore:
+    """ One file per session, written to a temp file and renamed so a reader never sees half a snapshot """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def file_for(self, session_id: str) -> str:
+        # session ids come from the browser, never use them as file names directly
+        return os.path.join(self.path, hashlib.sha256(session_id.encode()).hexdigest()[:32] + ".bin")
+
+    def get(self, session_id: str) -> Optional[bytes]:
+        try:
+            with open(self.file_for(session_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_many(self, items: Iterable[Tuple[str, Optional[bytes]]]) -> None:
+        """ None deletes the session"""
+
+        for session_id, data in items:
+            target = self.file_for(session_id)
+            if data is None:
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+                continue
+            temporary = f"{target}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(data)
+            os.replace(temporary, target)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteSessionStore:
+    """ All sessions in one SQLite table, a batch is one transaction """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)")
+        self.connection.commit()
+
+    def get(self, session_id: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def write_many(self, items: Iterable[Tuple[str, Optional[bytes]]]) -> None:
+        """ None deletes the session"""
+
+        now = time.time()
+        items = list(items)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sessions (session_id, data, updated) VALUES (?, ?, ?)",
+                [(session_id, data, now) for session_id, data in items if data is not None])
+            self.connection.executemany(
+                "DELETE FROM sessions WHERE session_id = ?",
+                [(session_id,) for session_id, data in items if data is None])
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class WriteBehindStore:
+    """ Puts land in a pending map right away and go to the backing store in batches from a thread.
+
+        Only the latest snapshot of a session is kept, so a busy session costs one write per flush
+        however many turns it had. Reads see pending writes first.
+    """
+
+    def __init__(self, store, flush_interval: float = SESSION_FLUSH_INTERVAL, max_batch: int = SESSION_FLUSH_BATCH):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        # serialises flushes, so an older batch can never land after a newer one
+        self.flush_lock = threading.Lock()
+        self.pending: Dict[str, Optional[bytes]] = {}
+        # the batch being written, still served to readers until it is in the store
+        self.flushing: Dict[str, Optional[bytes]] = {}
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="session-write-behind", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def get(self, session_id: str) -> Optional[bytes]:
+        with self.lock:
+            if session_id in self.pending:
+                return self.pending[session_id]
+            if session_id in self.flushing:
+                return self.flushing[session_id]
+        return self.store.get(session_id)
+
+    def put(self, session_id: str, data: bytes) -> None:
+        with self.lock:
+            self.pending[session_id] = data
+            if len(self.pending) >= self.max_batch:
+                self.wake.set()
+
+    def delete(self, session_id: str) -> None:
+        with self.lock:
+            self.pending[session_id] = None
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.flushing = batch
+            if not batch:
+                return
+            start = time.perf_counter()
+            try:
+                self.store.write_many(batch.items())
+            except Exception:
+                logger.exception(f"writing {len(batch)} session snapshots failed, keeping them for the next flush")
+                with self.lock:
+                    # anything written since is newer than what failed
+                    self.pending = {**batch, **self.pending}
+                    self.flushing = {}
+                return
+            with self.lock:
+                self.flushing = {}
+            metrics.observe("blockagent_session_store_flush_seconds", time.perf_counter() - start)
+            metrics.inc("blockagent_session_store_writes_total", len(batch))
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self) -> None:
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join(timeout=5)
+        self.flush()
+        self.store.close()
+
+
+def open_session_store(location: str = SESSION_STORE) -> Optional[WriteBehindStore]:
+    """ The configured store behind a write-behind buffer, None when SESSION_STORE is not set"""
+
+    if not location:
+        return None
+    if location.endswith((".sqlite", ".db")):
+        store = SQLiteSessionStore(location)
+    else:
+        store = DirectorySessionStore(location)
+    logger.info(f"session snapshots go to {location}")
+    return WriteBehindStore(store)
+
+
+class SessionMemories:
+    """ The live MessagesMemory of each session, read through from and saved to the store if there is one.
+
+        Sessions idle for idle_ttl seconds are dropped from memory. With a store, so are the least recently
+        used ones past max_live, their snapshots are in the store and read back on their next turn.
+    """
+
+    def __init__(self, store: Optional[WriteBehindStore] = None, max_live: int = SESSION_MAX_LIVE,
+                 idle_ttl: float = SESSION_IDLE_TTL):
+        self.store = store
+        self.max_live = max_live
+        self.idle_ttl = idle_ttl
+        # session id -> (memory, last used), least recently used first
+        self.memories: "OrderedDict[str, Tuple[MessagesMemory, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str) -> MessagesMemory:
+        with self.lock:
+            entry = self.memories.get(session_id)
+            if entry is not None:
+                self.memories[session_id] = (entry[0], time.monotonic())
+                self.memories.move_to_end(session_id)
+                return entry[0]
+
+        data = self.store.get(session_id) if self.store else None
+        memory = MessagesMemory()
+        if data:
+            try:
+                memory = MessagesMemory.restore(data)
+            except SnapshotError:
+                logger.exception("unreadable snapshot for a session, starting it over")
+        with self.lock:
+            entry = self.memories.setdefault(session_id, (memory, time.monotonic()))
+            self.evict()
+            return entry[0]
+
+    def evict(self) -> None:
+        """ Drop idle memories, and past max_live the least recently used ones if the store has them. Holds the lock"""
+
+        now = time.monotonic()
+        while self.memories:
+            session_id, (_, last_used) = next(iter(self.memories.items()))
+            if now - last_used > self.idle_ttl:
+                reason = "idle"
+            elif self.store is not None and len(self.memories) > self.max_live:
+                reason = "lru"
+            else:
+                break
+            del self.memories[session_id]
+            metrics.inc("blockagent_session_evictions_total", reason=reason)
+
+    def save(self, session_id: str, memory: MessagesMemory) -> None:
+        if self.store:
+            try:
+                self.store.put(session_id, memory.snapshot())
+            except SnapshotError:
+                logger.exception("session memory cannot be snapshotted, the store keeps its previous turn")
+
+    def drop(self, session_id: str) -> None:
+        with self.lock:
+            self.memories.pop(session_id, None)
+        if self.store:
+            self.store.delete(session_id)
+
+    def snapshots(self) -> Dict[str, bytes]:
+        with self.lock:
+            return {session_id: memory.snapshot() for session_id, (memory, _) in self.memories.items()}
+
+    def load(self, snapshots: Dict[str, bytes]) -> None:
+        with self.lock:
+            for session_id, data in snapshots.items():
+                self.memories[session_id] = (MessagesMemory.restore(data), time.monotonic())
+            self.evict()
+
+    def __len__(self) -> int:
+        return len(self.memories)
+
+    def close(self) -> None:
+        if self.store:
+            self.store.close()
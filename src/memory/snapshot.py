@@ -0,0 +1,105 @@
+import json
+import zlib
+import struct
+from typing import Any, Dict, Optional, Tuple
+
+
+# b"BAM" + format version + flags, then the body. Bump the version when the body layout changes,
+# restore keeps reading the old versions
+MAGIC = b"BAM"
+SNAPSHOT_VERSION = 1
+FLAG_ZLIB = 1
+
+HEADER = struct.Struct("<3sBB")
+LENGTH = struct.Struct("<I")
+
+# bodies smaller than this are not worth the zlib call
+COMPRESS_MIN_BYTES = 1024
+
+# the roles the agents write, anything else is stored by name
+ROLE_CODES = {"user": 0, "assistant": 1, "system": 2}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+OTHER_ROLE = 255
+
+
+class SnapshotError(ValueError):
+    """ The bytes are not a memory snapshot this version can read, or the memory cannot be written as one """
+
+
+def encode_snapshot(messages, extracted_entities: Dict[str, Any], compress: Optional[bool] = None) -> bytes:
+    """ Messages as (role code, length prefixed utf-8) records, the entities as one json blob.
+
+        compress=None compresses bodies of COMPRESS_MIN_BYTES and up, True / False force it. Entities must be
+        json values, anything else raises SnapshotError rather than coming back as a different type
+    """
+
+    parts = [LENGTH.pack(len(messages))]
+    for message in messages:
+        code = ROLE_CODES.get(message.role, OTHER_ROLE)
+        parts.append(bytes((code,)))
+        if code == OTHER_ROLE:
+            role = message.role.encode()
+            parts.append(LENGTH.pack(len(role)))
+            parts.append(role)
+        content = message.content.encode()
+        parts.append(LENGTH.pack(len(content)))
+        parts.append(content)
+
+    try:
+        entities = json.dumps(extracted_entities, separators=(",", ":"), allow_nan=False).encode() if extracted_entities else b""
+    except (TypeError, ValueError) as e:
+        raise SnapshotError(f"Entities are not json values: {e}") from e
+    parts.append(LENGTH.pack(len(entities)))
+    parts.append(entities)
+    body = b"".join(parts)
+
+    flags = 0
+    if compress or (compress is None and len(body) >= COMPRESS_MIN_BYTES):
+        body = zlib.compress(body, 1)
+        flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, SNAPSHOT_VERSION, flags) + body
+
+
+def decode_snapshot(data: bytes) -> Tuple[list, Dict[str, Any]]:
+    """ Back to ([(role, content)], entities)"""
+
+    if len(data) < HEADER.size:
+        raise SnapshotError("Snapshot is truncated")
+    magic, version, flags = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("Not a memory snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {version}")
+
+    body = data[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise SnapshotError(f"Corrupt snapshot: {e}") from e
+    view = memoryview(body)
+
+    try:
+        (count,), offset = LENGTH.unpack_from(view), LENGTH.size
+        messages = []
+        for _ in range(count):
+            code = view[offset]
+            offset += 1
+            if code == OTHER_ROLE:
+                (length,) = LENGTH.unpack_from(view, offset)
+                offset += LENGTH.size
+                role = bytes(view[offset:offset + length]).decode()
+                offset += length
+            else:
+                role = ROLE_NAMES[code]
+            (length,) = LENGTH.unpack_from(view, offset)
+            offset += LENGTH.size
+            messages.append((role, bytes(view[offset:offset + length]).decode()))
+            offset += length
+
+        (length,) = LENGTH.unpack_from(view, offset)
+        offset += LENGTH.size
+        entities = json.loads(bytes(view[offset:offset + length])) if length else {}
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise SnapshotError(f"Corrupt snapshot: {e}") from e
+    return messages, entities
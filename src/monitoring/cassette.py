@@ -0,0 +1,220 @@
+import os
+import gzip
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import defaultdict, deque
+from dotenv import load_dotenv
+from typing import Dict, Any, List, Optional, Callable
+
+from web3.providers.base import BaseProvider
+
+from src.monitoring.tracing import get_logger
+
+
+load_dotenv()
+
+logger = get_logger("cassette")
+
+# "record" writes every outbound call to CASSETTE_PATH, "replay" serves them back from it, anything else is off
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", ".cache/cassette.jsonl.gz")
+# 0 replays instantly, 1 sleeps for the recorded latency, 2 twice as slow ...
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "0"))
+# "1" serves a request that is not on the cassette the next unused interaction of the same kind, with a warning.
+# Handy when prompts drift a little between runs, but the answer may belong to another request
+CASSETTE_LOOSE_MATCH = os.getenv("CASSETTE_LOOSE_MATCH", "0") == "1"
+
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(Exception):
+    """ Replay was asked for an interaction that is not on the cassette """
+
+
+class ReplayedError(Exception):
+    """ The recorded call failed, replaying the failure """
+
+
+def request_key(kind: str, request: Any) -> str:
+    canonical = json.dumps(request, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(f"{kind}\x00{canonical}".encode()).hexdigest()[:32]
+
+
+class Cassette:
+    """ Records outbound llm / subgraph / rpc interactions with their timing, or replays them.
+
+        The file is gzip'd json lines, a header line and then one line per interaction. Replays match
+        on the call kind and the request, identical requests are served in the order they were recorded.
+        A request that is not on the cassette raises CassetteMiss. Prompts are not always byte for byte
+        reproducible (the simulated transaction hash, as_of markers), with loose_match such a request
+        gets the next unused interaction of the same kind instead.
+    """
+
+    def __init__(self, mode: str = CASSETTE_MODE, path: str = CASSETTE_PATH, latency_scale: float = CASSETTE_LATENCY_SCALE,
+                 loose_match: bool = CASSETTE_LOOSE_MATCH):
+        self.mode = mode if mode in ("record", "replay") else "off"
+        self.path = path
+        self.latency_scale = latency_scale
+        self.loose_match = loose_match
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.recorded = 0
+        self.interactions: List[Dict[str, Any]] = []
+        self.by_key: Dict[str, deque] = defaultdict(deque)
+        self.by_kind: Dict[str, deque] = defaultdict(deque)
+        self.used = set()
+        self.file = None
+
+        if self.mode == "record":
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = gzip.open(path, "wt", encoding="utf-8")
+            self.file.write(json.dumps({"version": CASSETTE_VERSION, "created": self.started}) + "\n")
+            atexit.register(self.close)
+            logger.info(f"recording outbound calls to {path}")
+        elif self.mode == "replay":
+            self.load(path)
+            logger.info(f"replaying outbound calls from {path}")
+
+    def load(self, path: str) -> None:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != CASSETTE_VERSION:
+                raise ValueError(f"Unsupported cassette version {header.get('version')}")
+            for line in f:
+                interaction = json.loads(line)
+                index = len(self.interactions)
+                self.interactions.append(interaction)
+                self.by_key[interaction["key"]].append(index)
+                self.by_kind[interaction["kind"]].append(index)
+
+    def call(self, kind: str, request: Any, function: Callable[[], Any],
+             encode: Callable[[Any], Any] = lambda value: value,
+             decode: Callable[[Any], Any] = lambda value: value) -> Any:
+        """ Run function, recording or replaying it depending on the mode"""
+
+        if self.mode == "off":
+            return function()
+
+        key = request_key(kind, request)
+        if self.mode == "replay":
+            return self.replay(kind, key, decode)
+
+        offset = time.time() - self.started
+        start = time.perf_counter()
+        try:
+            result = function()
+        except Exception as e:
+            self.record({"kind": kind, "key": key, "request": request, "offset": offset,
+                         "duration": time.perf_counter() - start, "error": f"{type(e).__name__}: {e}"})
+            raise
+
+        self.record({"kind": kind, "key": key, "request": request, "offset": offset,
+                     "duration": time.perf_counter() - start, "response": encode(result)})
+        return result
+
+    def record(self, interaction: Dict[str, Any]) -> None:
+        line = json.dumps(interaction, default=str, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.recorded += 1
+            # keep most of it on disk if the process dies, without flushing (and hurting compression) on every call
+            if self.recorded % 50 == 0:
+                self.file.flush()
+
+    def next_unused(self, queue: deque) -> Optional[int]:
+        while queue and queue[0] in self.used:
+            queue.popleft()
+        return queue.popleft() if queue else None
+
+    def replay(self, kind: str, key: str, decode: Callable[[Any], Any]) -> Any:
+        with self.lock:
+            recorded = key in self.by_key
+            index = self.next_unused(self.by_key[key]) if recorded else None
+            if index is None:
+                if not self.loose_match:
+                    what = "was replayed as often as it was recorded" if recorded else "is not on the cassette"
+                    raise CassetteMiss(f"{kind} request {key} {what} ({self.path}), record it again "
+                                       f"or set CASSETTE_LOOSE_MATCH=1")
+                index = self.next_unused(self.by_kind[kind])
+                if index is None:
+                    raise CassetteMiss(f"No recorded {kind} interaction left for this request")
+                logger.warning(f"{kind} request {key} not on the cassette, serving the next {kind} one in recorded order")
+            self.used.add(index)
+            interaction = self.interactions[index]
+
+        if self.latency_scale > 0:
+            time.sleep(interaction["duration"] * self.latency_scale)
+
+        if "error" in interaction:
+            raise ReplayedError(interaction["error"])
+        return decode(interaction["response"])
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette() -> Cassette:
+    """ The process wide cassette, configured from CASSETTE_MODE / CASSETTE_PATH"""
+
+    global _cassette
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette()
+        return _cassette
+
+
+def invoke_chat_model(llm, messages: List[Any]) -> Any:
+    """ ChatOpenAI.invoke through the cassette"""
+
+    from langchain_core.messages import message_to_dict, messages_from_dict
+
+    request = {"model": llm.model_name, "messages": [[message.type, message.content] for message in messages]}
+    return get_cassette().call("chat_model", request, lambda: llm.invoke(messages),
+                               encode=message_to_dict, decode=lambda value: messages_from_dict([value])[0])
+
+
+def create_chat_completion(client, **kwargs: Any) -> Any:
+    """ client.chat.completions.create through the cassette"""
+
+    from openai.types.chat import ChatCompletion
+
+    return get_cassette().call("chat_completion", kwargs, lambda: client.chat.completions.create(**kwargs),
+                               encode=lambda response: response.model_dump(), decode=ChatCompletion.model_validate)
+
+
+class CassetteProvider(BaseProvider):
+    """ web3 provider that sends every json-rpc request through the cassette """
+
+    def __init__(self, provider: BaseProvider, cassette: Cassette):
+        super().__init__()
+        self.provider = provider
+        self.cassette = cassette
+
+    def make_request(self, method, params) -> Dict[str, Any]:
+        request = {"method": method, "params": params}
+        return self.cassette.call("rpc", request, lambda: self.provider.make_request(method, params))
+
+    def is_connected(self, show_traceback: bool = False) -> bool:
+        if self.cassette.mode == "replay":
+            return True
+        return self.provider.is_connected(show_traceback)
+
+
+def wrap_provider(provider: BaseProvider) -> BaseProvider:
+    """ Put the cassette in front of a web3 provider when recording or replaying"""
+
+    cassette = get_cassette()
+    if cassette.mode == "off":
+        return provider
+    return CassetteProvider(provider, cassette)
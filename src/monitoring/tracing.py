@@ -0,0 +1,339 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "json" for one json object per line, "text" for local debugging
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """ One json object per log line, with the trace id of the turn it belongs to"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        trace_id = current_trace_id.get()
+        if trace_id:
+            payload["trace_id"] = trace_id
+        if hasattr(record, "span"):
+            payload["span"] = record.span
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
+
+_logging_configured = False
+_logging_lock = threading.Lock()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """ Logger under the blockagent namespace, the handler is set up once on first use"""
+
+    global _logging_configured
+    with _logging_lock:
+        if not _logging_configured:
+            handler = logging.StreamHandler()
+            if LOG_FORMAT == "json":
+                handler.setFormatter(JsonFormatter())
+            else:
+                handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+            root = logging.getLogger("blockagent")
+            root.addHandler(handler)
+            root.setLevel(LOG_LEVEL)
+            root.propagate = False
+            _logging_configured = True
+
+    return logging.getLogger(f"blockagent.{name}")
+
+
+logger = get_logger("trace")
+
+
+def escape_label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Dict[str, Any]] = None) -> str:
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in items) + "}"
+
+
+class MetricsRegistry:
+    """ Counters, gauges and histograms rendered in the Prometheus text format """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions: Dict[str, Tuple[str, str]] = {}
+        self.values: Dict[str, Dict[Tuple, float]] = {}
+        self.histograms: Dict[str, Dict[Tuple, Dict[str, Any]]] = {}
+        self.buckets: Dict[str, Tuple[float, ...]] = {}
+        # the latest snapshot of every other process that reports here (the worker processes), by source
+        self.sources: Dict[str, Dict[str, Any]] = {}
+
+    def describe(self, metric: str, metric_type: str, help_text: str) -> None:
+        with self.lock:
+            self.descriptions.setdefault(metric, (metric_type, help_text))
+
+    def inc(self, metric: str, value: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.descriptions.setdefault(metric, ("counter", metric))
+            series = self.values.setdefault(metric, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, metric: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.descriptions.setdefault(metric, ("gauge", metric))
+            self.values.setdefault(metric, {})[key] = value
+
+    def observe(self, metric: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.descriptions.setdefault(metric, ("histogram", metric))
+            bucket_bounds = self.buckets.setdefault(metric, buckets)
+            series = self.histograms.setdefault(metric, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {"buckets": [0] * len(bucket_bounds), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(bucket_bounds):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """ A picklable copy of every series, for the process that serves /metrics to merge in"""
+
+        with self.lock:
+            return {
+                "descriptions": dict(self.descriptions),
+                "values": {name: dict(series) for name, series in self.values.items()},
+                "histograms": {name: {labels: {**histogram, "buckets": list(histogram["buckets"])}
+                                      for labels, histogram in series.items()}
+                               for name, series in self.histograms.items()},
+                "buckets": dict(self.buckets)
+            }
+
+    def merge(self, source: str, snapshot: Dict[str, Any]) -> None:
+        """ Replace what source reported last, its series are rendered with a worker="source" label"""
+
+        with self.lock:
+            self.sources[source] = snapshot
+            for name, description in snapshot["descriptions"].items():
+                self.descriptions.setdefault(name, description)
+
+    def render(self) -> str:
+        """ Everything in the Prometheus exposition format, this process's series and the merged ones"""
+
+        lines = []
+        with self.lock:
+            registries = [(None, self.values, self.histograms, self.buckets)]
+            registries += [({"worker": source}, snapshot["values"], snapshot["histograms"], snapshot["buckets"])
+                           for source, snapshot in sorted(self.sources.items())]
+            for name, (metric_type, help_text) in sorted(self.descriptions.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+                for extra, values, histograms, buckets in registries:
+                    for labels, value in values.get(name, {}).items():
+                        lines.append(f"{name}{format_labels(labels, extra)} {value}")
+
+                    for labels, histogram in histograms.get(name, {}).items():
+                        for bound, count in zip(buckets[name], histogram["buckets"]):
+                            lines.append(f"{name}_bucket{format_labels(labels, {**(extra or {}), 'le': bound})} {count}")
+                        lines.append(f"{name}_bucket{format_labels(labels, {**(extra or {}), 'le': '+Inf'})} {histogram['count']}")
+                        lines.append(f"{name}_sum{format_labels(labels, extra)} {histogram['sum']}")
+                        lines.append(f"{name}_count{format_labels(labels, extra)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("blockagent_span_duration_seconds", "histogram", "Wall time of workflow nodes and outbound calls")
+metrics.describe("blockagent_span_errors_total", "counter", "Spans that ended with an exception")
+metrics.describe("blockagent_llm_tokens_total", "counter", "Tokens used by llm calls, cache hits excluded")
+metrics.describe("blockagent_llm_prompt_cache_tokens_total", "counter", "Prompt tokens OpenAI served from its prefix cache (hit) or not (miss)")
+metrics.describe("blockagent_cache_lookups_total", "counter", "Cache lookups by cache and result")
+
+
+class Span:
+    """ One timed unit of work, a workflow node or an outbound llm / graphql / rpc call """
+
+    def __init__(self, name: str, kind: str, trace_id: Optional[str], parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def record_usage(self, response: Any) -> None:
+        """ Pull token usage out of a langchain AIMessage or an openai ChatCompletion"""
+
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            prompt_tokens = usage.get("input_tokens", 0)
+            completion_tokens = usage.get("output_tokens", 0)
+            cached_tokens = (usage.get("input_token_details") or {}).get("cache_read", 0)
+        elif getattr(response, "usage", None) is not None:
+            prompt_tokens = response.usage.prompt_tokens or 0
+            completion_tokens = response.usage.completion_tokens or 0
+            details = getattr(response.usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        else:
+            return
+
+        self.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_prompt_tokens=cached_tokens)
+
+        # a response served from our llm cache did not cost anything this time
+        if self.attributes.get("cache_hit"):
+            return
+        model = str(self.attributes.get("model", "unknown"))
+        metrics.inc("blockagent_llm_tokens_total", prompt_tokens, model=model, direction="prompt")
+        metrics.inc("blockagent_llm_tokens_total", completion_tokens, model=model, direction="completion")
+        # how much of each kind of prompt OpenAI served from its prefix cache, see src/llm/prompts.py
+        prompt = str(self.attributes.get("prompt", "other"))
+        metrics.inc("blockagent_llm_prompt_cache_tokens_total", cached_tokens, model=model, prompt=prompt, result="hit")
+        metrics.inc("blockagent_llm_prompt_cache_tokens_total", prompt_tokens - cached_tokens, model=model, prompt=prompt, result="miss")
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "error": self.error,
+            **self.attributes
+        }
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes: Any):
+    """ Time a block as a span of the current trace"""
+
+    parent = current_span.get()
+    new_span = Span(name, kind, current_trace_id.get(), parent.span_id if parent else None, attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.duration = time.time() - new_span.start
+
+        metrics.observe("blockagent_span_duration_seconds", new_span.duration, kind=kind, name=name)
+        if new_span.error:
+            metrics.inc("blockagent_span_errors_total", kind=kind, name=name)
+        logger.info(f"{kind} {name}", extra={"span": new_span.as_dict()})
+
+
+@contextmanager
+def trace(name: str = "turn", **attributes: Any):
+    """ Start a new trace id, every span opened inside (also from copied contexts) is linked to it"""
+
+    token = current_trace_id.set(uuid.uuid4().hex)
+    try:
+        with span(name, kind="turn", **attributes) as root:
+            yield root
+    finally:
+        current_trace_id.reset(token)
+
+
+def traced_node(name: str, node):
+    """ Wrap a langgraph node so each run is a span"""
+
+    def run(state):
+        with span(name, kind="node"):
+            return node(state)
+
+    run.__name__ = name
+    return run
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """ Count a cache lookup and mark the current span with the result"""
+
+    metrics.inc("blockagent_cache_lookups_total", cache=cache, result="hit" if hit else "miss")
+    active = current_span.get()
+    if active is not None:
+        active.set(cache_hit=hit)
+
+
+GRAPHQL_OPERATION = re.compile(r"(?:query|mutation)\s+(\w+)")
+
+
+def graphql_operation_name(query_string: str) -> str:
+    match = GRAPHQL_OPERATION.search(query_string)
+    return match.group(1) if match else "anonymous"
+
+
+def rpc_tracing_middleware(make_request, w3):
+    """ web3 middleware, every json-rpc request becomes an rpc span"""
+
+    def middleware(method, params):
+        with span(method, kind="rpc") as rpc_span:
+            response = make_request(method, params)
+            if isinstance(response, dict) and "error" in response:
+                rpc_span.set(rpc_error=response["error"])
+            return response
+
+    return middleware
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the scraper hits this every few seconds, keep it out of the logs
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """ Serve /metrics for Prometheus from a background thread"""
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"serving metrics on {host}:{port}/metrics")
+    return server
@@ -0,0 +1,189 @@
+import os
+import re
+import time
+import itertools
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from typing import Dict, Any, Optional, Tuple
+
+from src.monitoring.tracing import get_logger, metrics
+
+
+load_dotenv()
+
+logger = get_logger("admission")
+
+# "0" lets every turn straight into the workflow, like before
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1") == "1"
+# turns running at once per stage, classification first and then the route it picked. 0 is no cap
+DEFAULT_LIMITS = {"classify": 32, "data_retrieval": 16, "transaction": 8, "conversation": 16}
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS", "")
+# turns allowed to wait for a slot per stage, the next one is turned away right away
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", "32"))
+# a turn that waited this long for a slot is turned away, it would be too slow to be useful
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+# answers a turned away query may get instead of "busy". Only pool and swap data asked without any history
+# before it, anything else depends on the session: transactions are the user's own and a follow up
+# like "and for WBTC?" means something else in every conversation
+CACHEABLE_ROUTES = ("data_retrieval",)
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_MAX_AGE = float(os.getenv("ADMISSION_CACHE_MAX_AGE", "300"))
+
+BUSY_RESPONSE = ("BlockAgent is handling a lot of requests right now and could not get to yours in time. "
+                 "Please try again in a few seconds.")
+
+metrics.describe("blockagent_admission_inflight", "gauge", "Turns running in a stage")
+metrics.describe("blockagent_admission_queue_depth", "gauge", "Turns waiting for a slot in a stage")
+metrics.describe("blockagent_admission_wait_seconds", "histogram", "Time admitted turns waited for their slot")
+metrics.describe("blockagent_admission_rejected_total", "counter", "Turns turned away, by stage and reason")
+metrics.describe("blockagent_admission_fallbacks_total", "counter", "Turned away turns answered from the cache or with busy")
+
+
+class Overloaded(Exception):
+    """ A turn could not get a slot for a stage """
+
+    def __init__(self, route: str, reason: str):
+        super().__init__(f"{route} is overloaded ({reason})")
+        self.route = route
+        self.reason = reason
+
+
+def parse_limits(value: str) -> Dict[str, int]:
+    """ "classify=16,transaction=4" on top of DEFAULT_LIMITS"""
+
+    limits = dict(DEFAULT_LIMITS)
+    for part in filter(None, (part.strip() for part in value.split(","))):
+        route, _, limit = part.partition("=")
+        limits[route.strip()] = int(limit)
+    return limits
+
+
+class RouteLimiter:
+    """ At most limit turns at once, up to max_queue more waiting in arrival order for at most max_wait seconds """
+
+    def __init__(self, route: str, limit: int, max_queue: int = ADMISSION_QUEUE, max_wait: float = ADMISSION_MAX_WAIT):
+        self.route = route
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = deque()
+        self.tickets = itertools.count()
+
+    def report(self) -> None:
+        metrics.set_gauge("blockagent_admission_inflight", self.active, route=self.route)
+        metrics.set_gauge("blockagent_admission_queue_depth", len(self.waiting), route=self.route)
+
+    def acquire(self) -> float:
+        """ Wait for a slot, returns the seconds waited or raises Overloaded"""
+
+        start = time.monotonic()
+        with self.condition:
+            if self.limit <= 0 or (self.active < self.limit and not self.waiting):
+                self.active += 1
+                self.report()
+                return 0.0
+            if len(self.waiting) >= self.max_queue:
+                metrics.inc("blockagent_admission_rejected_total", route=self.route, reason="queue_full")
+                raise Overloaded(self.route, "queue_full")
+
+            ticket = next(self.tickets)
+            self.waiting.append(ticket)
+            self.report()
+            try:
+                while self.waiting[0] != ticket or self.active >= self.limit:
+                    remaining = start + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc("blockagent_admission_rejected_total", route=self.route, reason="timeout")
+                        raise Overloaded(self.route, "timeout")
+                    self.condition.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting.remove(ticket)
+                self.report()
+                self.condition.notify_all()
+
+        waited = time.monotonic() - start
+        metrics.observe("blockagent_admission_wait_seconds", waited, route=self.route)
+        return waited
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.report()
+            self.condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.condition:
+            return {"limit": self.limit, "active": self.active, "waiting": len(self.waiting)}
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query.strip().lower()).rstrip("?!. ")
+
+
+class AdmissionController:
+    """ One RouteLimiter per stage of a turn, plus recent answers to fall back on when a turn is turned away """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, max_queue: int = ADMISSION_QUEUE,
+                 max_wait: float = ADMISSION_MAX_WAIT, enabled: bool = ADMISSION_CONTROL):
+        self.enabled = enabled
+        limits = parse_limits(ADMISSION_LIMITS) if limits is None else limits
+        self.limiters = {route: RouteLimiter(route, limit, max_queue, max_wait) for route, limit in limits.items()}
+        self.answers: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, route: str):
+        """ Hold a slot of route for the block, raises Overloaded when there is none in time"""
+
+        limiter = self.limiters.get(route) if self.enabled else None
+        if limiter is None:
+            yield
+            return
+        limiter.acquire()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def admitted(self, route: str, node):
+        """ Wrap a workflow node so it runs inside a slot of route"""
+
+        def run(state):
+            with self.admit(route):
+                return node(state)
+
+        return run
+
+    def remember(self, query: str, route: Optional[str], response: Optional[str], first_turn: bool) -> None:
+        """ Keep the answer of a session's first turn, later turns may have leaned on the history"""
+
+        if not self.enabled or route not in CACHEABLE_ROUTES or not response or not first_turn:
+            return
+        with self.lock:
+            key = normalize_query(query)
+            self.answers[key] = (response, time.time())
+            self.answers.move_to_end(key)
+            while len(self.answers) > ANSWER_CACHE_SIZE:
+                self.answers.popitem(last=False)
+
+    def fallback(self, query: str, error: Overloaded, first_turn: bool) -> Tuple[str, str]:
+        """ (response, status) for a turned away query: a recent answer to the same first question, or busy"""
+
+        cached = None
+        if first_turn:
+            with self.lock:
+                cached = self.answers.get(normalize_query(query))
+        if cached is not None and time.time() - cached[1] <= ANSWER_CACHE_MAX_AGE:
+            metrics.inc("blockagent_admission_fallbacks_total", route=error.route, response="cached")
+            age = int(time.time() - cached[1])
+            return f"{cached[0]}\n\n(We are very busy right now, this is the answer from {age}s ago.)", "cached"
+        metrics.inc("blockagent_admission_fallbacks_total", route=error.route, response="busy")
+        return BUSY_RESPONSE, "busy"
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {route: limiter.get_stats() for route, limiter in self.limiters.items()}
@@ -0,0 +1,247 @@
+""" Batch mode, runs a JSONL file of queries through BlockAgentFlow.process.
+
+    python -m src.serving.batch queries.jsonl results.jsonl --concurrency 16
+
+Every input line is {"query": ..., "id": optional, "session_id": optional}. Lines that share a
+session_id are turns of one conversation and run in file order on the same memory, everything
+else runs concurrently, up to --concurrency queries in flight. Results are appended to the output
+as they finish, one line per query. A session stops at its first failed turn, the turns after it
+build on its answer. Rerunning the same command skips the queries that already succeeded, rebuilding
+their sessions' memory from the output, and runs the rest.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from typing import Dict, Any, List, Optional
+
+from src.memory.memory_utils import MessagesMemory, Message
+from src.llm.rate_limiter import llm_priority, PRIORITY_BACKGROUND
+from src.monitoring.tracing import get_logger, metrics
+
+
+logger = get_logger("batch")
+
+DEFAULT_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+metrics.describe("blockagent_batch_queries_total", "counter", "Batch queries finished, by result")
+
+
+def read_queries(path: str) -> "OrderedDict[str, List[Dict[str, Any]]]":
+    """ Group the input lines into sessions, in file order. Queries without a session_id are a session of their own"""
+
+    sessions = OrderedDict()
+    seen_ids = set()
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get("query"):
+                raise ValueError(f"{path}:{line_number} has no query")
+
+            query_id = str(item.get("id", line_number))
+            if query_id in seen_ids:
+                raise ValueError(f"{path}:{line_number} repeats the id {query_id}")
+            seen_ids.add(query_id)
+
+            session_id = item.get("session_id")
+            session_key = f"session:{session_id}" if session_id is not None else f"query:{query_id}"
+            sessions.setdefault(session_key, []).append({"id": query_id, "session_id": session_id, "query": item["query"]})
+    return sessions
+
+
+def read_finished(path: str) -> Dict[str, Dict[str, Any]]:
+    """ Successful results already in the output, by query id. A half written last line (killed mid write) is cut off"""
+
+    finished = {}
+    if not os.path.exists(path):
+        return finished
+
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for raw in f:
+            try:
+                row = json.loads(raw)
+            except ValueError:
+                break
+            valid_bytes += len(raw)
+            if row.get("error") is None:
+                finished[row["id"]] = row
+
+    if valid_bytes != os.path.getsize(path):
+        logger.warning(f"dropping a partial line at the end of {path}")
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return finished
+
+
+def memory_delta(memory: MessagesMemory, start: int) -> Dict[str, Any]:
+    """ What the turn added to the memory, enough to rebuild it on resume"""
+
+    return {"messages": [message.model_dump() for message in memory.messages[start:]],
+            "entities": dict(memory.extracted_entities)}
+
+
+def apply_delta(memory: MessagesMemory, delta: Dict[str, Any]) -> None:
+    memory.messages.extend(Message(**message) for message in delta.get("messages", []))
+    memory.extracted_entities.update(delta.get("entities", {}))
+
+
+class ResultWriter:
+    """ Appends one json line per finished query, flushed right away so an interrupted run loses nothing """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, row: Dict[str, Any]) -> None:
+        line = json.dumps(row, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class BatchRunner:
+    """ Runs sessions of queries through a workflow with at most `concurrency` queries in flight """
+
+    def __init__(self, workflow, concurrency: int = DEFAULT_CONCURRENCY, progress_every: int = 100):
+        self.workflow = workflow
+        self.concurrency = concurrency
+        self.progress_every = progress_every
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = {"succeeded": 0, "failed": 0, "skipped": 0}
+        self.latencies: List[float] = []
+        self.started = None
+
+    def run_query(self, item: Dict[str, Any], turn: int, memory: MessagesMemory) -> Dict[str, Any]:
+        start_index = len(memory.messages)
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            # interactive users of the same OpenAI account go first
+            with llm_priority(PRIORITY_BACKGROUND):
+                result = self.workflow.process(item["query"], memory)
+            route, response, error = result.get("query_type"), result.get("agent_response"), None
+            if result.get("status") in ("busy", "cached"):
+                # turned away by admission control, left unfinished so a resume runs it again
+                error = f"turned away ({result['status']})"
+        except Exception as e:
+            logger.exception(f"query {item['id']} failed")
+            route, response, error = None, None, f"{type(e).__name__}: {e}"
+        latency = time.perf_counter() - start
+
+        return {
+            "id": item["id"],
+            "session_id": item["session_id"],
+            "turn": turn,
+            "query": item["query"],
+            "query_type": route,
+            "response": response,
+            "error": error,
+            "started_at": started_at,
+            "latency_ms": round(latency * 1000, 3),
+            "memory": memory_delta(memory, start_index)
+        }
+
+    def run_session(self, items: List[Dict[str, Any]], finished: Dict[str, Dict[str, Any]], writer: ResultWriter) -> None:
+        """ The turns of one session in order, up to the first one that fails. Finished turns are replayed into
+            memory from their recorded delta, not rerun"""
+
+        memory = MessagesMemory()
+        for turn, item in enumerate(items):
+            if item["id"] in finished:
+                apply_delta(memory, finished[item["id"]].get("memory", {}))
+                with self.lock:
+                    self.stats["skipped"] += 1
+                continue
+            if self.stop.is_set():
+                return
+            row = self.run_query(item, turn, memory)
+            writer.write(row)
+            self.record(row)
+            if row["error"]:
+                logger.warning(f"query {item['id']} failed, leaving the rest of its session for the next run")
+                return
+
+    def record(self, row: Dict[str, Any]) -> None:
+        result = "failed" if row["error"] else "succeeded"
+        metrics.inc("blockagent_batch_queries_total", result=result)
+        with self.lock:
+            self.stats[result] += 1
+            self.latencies.append(row["latency_ms"])
+            done = self.stats["succeeded"] + self.stats["failed"]
+        if self.progress_every and done % self.progress_every == 0:
+            elapsed = time.perf_counter() - self.started
+            logger.info(f"{done} queries done, {done / elapsed:.2f} queries/s")
+
+    def run(self, input_path: str, output_path: str) -> Dict[str, Any]:
+        sessions = read_queries(input_path)
+        finished = read_finished(output_path)
+        writer = ResultWriter(output_path)
+        logger.info(f"{sum(len(items) for items in sessions.values())} queries in {len(sessions)} sessions, "
+                    f"{len(finished)} already done")
+
+        self.started = time.perf_counter()
+        # a session holds its worker between turns, so the pool size is the number of queries in flight
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        try:
+            futures = [executor.submit(self.run_session, items, finished, writer) for items in sessions.values()]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                future.result()
+        except KeyboardInterrupt:
+            logger.warning("interrupted, finishing the queries in flight, rerun the same command to resume")
+            self.stop.set()
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            writer.close()
+
+        return self.summary()
+
+    def summary(self) -> Dict[str, Any]:
+        wall_time = time.perf_counter() - self.started
+        ran = self.stats["succeeded"] + self.stats["failed"]
+        latencies = sorted(self.latencies)
+        return {
+            **self.stats,
+            "wall_time": round(wall_time, 3),
+            "queries_per_second": round(ran / wall_time, 3) if wall_time else 0.0,
+            "p50_ms": latencies[len(latencies) // 2] if latencies else None,
+            "p95_ms": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] if latencies else None,
+        }
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Run a JSONL file of queries through BlockAgent")
+    parser.add_argument("input", help="JSONL with a query and optional id / session_id per line")
+    parser.add_argument("output", help="JSONL results, appended to and used to resume")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="queries in flight")
+    parser.add_argument("--progress-every", type=int, default=100, help="log progress every N queries")
+    args = parser.parse_args(argv)
+
+    from src.agents.workflow import BlockAgentFlow
+
+    workflow = BlockAgentFlow()
+    # --concurrency already bounds the load, and a batch would rather wait than be turned away
+    workflow.admission.enabled = False
+    runner = BatchRunner(workflow, args.concurrency, args.progress_every)
+    summary = runner.run(args.input, args.output)
+    logger.info(f"batch finished: {json.dumps(summary)}")
+    return summary
+
+
+if __name__ == "__main__":
+    summary = main()
+    sys.exit(1 if summary["failed"] else 0)
@@ -0,0 +1,434 @@
+""" Multi-process serving: the Gradio process dispatches turns to a pool of BlockAgentFlow workers.
+
+Turns are routed by session id, so a session's MessagesMemory only ever lives in one worker.
+Each worker runs several turns at once on threads (they mostly wait on OpenAI), the processes
+spread the CPU side (json, pydantic, result compaction) over the cores. A monitor thread pings
+the workers, restarts the ones that died or hang, and recycles workers after WORKER_MAX_TURNS
+turns or WORKER_MAX_RSS_MB of memory, handing their sessions over to the replacement.
+"""
+import os
+import time
+import zlib
+import signal
+import resource
+import itertools
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional
+
+from src.monitoring.tracing import get_logger, metrics
+
+
+logger = get_logger("workers")
+
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "8"))
+WORKER_MAX_TURNS = int(os.getenv("WORKER_MAX_TURNS", "2000"))
+WORKER_MAX_RSS_MB = int(os.getenv("WORKER_MAX_RSS_MB", "1500"))
+HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", "5"))
+HEALTH_TIMEOUT = float(os.getenv("WORKER_HEALTH_TIMEOUT", "15"))
+# importing langchain / web3 and building the workflow takes a few seconds
+STARTUP_TIMEOUT = float(os.getenv("WORKER_STARTUP_TIMEOUT", "60"))
+TURN_TIMEOUT = float(os.getenv("WORKER_TURN_TIMEOUT", "120"))
+# how many workers run the background pollers (hot data prefetcher, swap logs), the others leave them off
+# so The Graph and the RPC node are not polled once per worker
+WORKER_POLLERS = int(os.getenv("WORKER_POLLERS", "1"))
+
+metrics.describe("blockagent_worker_restarts_total", "counter", "Worker processes replaced, by reason")
+metrics.describe("blockagent_worker_inflight", "gauge", "Turns dispatched to a worker and not answered yet")
+metrics.describe("blockagent_worker_rss_mb", "gauge", "Peak resident memory of a worker process")
+
+
+class WorkerCrashed(Exception):
+    """ The worker process running the turn died before answering """
+
+
+def worker_main(conn, threads: int, index: int = 0, workers: int = 1) -> None:
+    """ Runs in the worker process: one BlockAgentFlow, the memories of the sessions routed here"""
+
+    # before src reads its configuration: the OpenAI budget is the account's, split over the workers
+    os.environ["LLM_BUDGET_SHARE"] = str(1 / workers)
+    if index >= WORKER_POLLERS:
+        os.environ["BLOCKAGENT_PREFETCH"] = "0"
+        os.environ["SWAP_LOGS"] = "0"
+
+    from src.agents.workflow import BlockAgentFlow
+    from src.memory.session_store import SessionMemories, open_session_store
+
+    # ctrl-c reaches the whole process group, the front process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    workflow = BlockAgentFlow()
+    # with SESSION_STORE set, sessions survive a crash of this worker and can move to any other one
+    sessions = SessionMemories(open_session_store())
+    conn.send(("ready", os.getpid()))
+    session_locks = defaultdict(threading.Lock)
+    locks_lock = threading.Lock()
+    send_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="turn")
+    turns = itertools.count(1)
+    stats = {"turns": 0}
+
+    def reply(message) -> None:
+        with send_lock:
+            conn.send(message)
+
+    def session_lock(session_id: str) -> threading.Lock:
+        with locks_lock:
+            return session_locks[session_id]
+
+    def run_turn(request_id: int, session_id: str, query: str) -> None:
+        # turns of one session run one after the other, different sessions in parallel
+        with session_lock(session_id):
+            memory = sessions.get(session_id)
+            try:
+                result = workflow.process(query, memory)
+                reply(("result", request_id, {"agent_response": result["agent_response"],
+                                              "query_type": result["query_type"],
+                                              "status": result["status"]}))
+            except Exception as e:
+                logger.exception(f"turn {request_id} failed")
+                reply(("error", request_id, f"{type(e).__name__}: {e}"))
+            sessions.save(session_id, memory)
+        stats["turns"] = next(turns)
+
+    def reset_session(session_id: str) -> None:
+        with session_lock(session_id):
+            sessions.drop(session_id)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        kind = message[0]
+        if kind == "turn":
+            executor.submit(run_turn, *message[1:])
+        elif kind == "reset":
+            executor.submit(reset_session, message[1])
+        elif kind == "ping":
+            # the worker's metrics ride along, the front process serves them with its own
+            reply(("pong", message[1], {"turns": stats["turns"], "sessions": len(sessions),
+                                        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024},
+                   metrics.snapshot()))
+        elif kind == "restore":
+            sessions.load(message[1])
+        elif kind == "handover":
+            executor.shutdown(wait=True)
+            reply(("memories", sessions.snapshots()))
+            break
+        elif kind == "stop":
+            break
+
+    executor.shutdown(wait=False, cancel_futures=True)
+    sessions.close()
+    conn.close()
+
+
+class WorkerSlot:
+    """ One position in the pool, the process behind it changes when it is restarted or recycled """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.generation = 0
+        self.send_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.pending: Dict[int, Future] = {}
+        self.turns = 0
+        self.draining = False
+        self.last_pong = time.monotonic()
+        self.stats: Dict[str, Any] = {}
+        self.handover: Optional[Future] = None
+        # the thread restarting or recycling the worker, the monitor leaves the slot alone meanwhile
+        self.replacement: Optional[threading.Thread] = None
+
+    def send(self, message) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class InProcessBackend:
+    """ The single process mode, BlockAgentFlow in the Gradio process with a memory per session """
+
+    def __init__(self):
+        self.workflow = None
+        self.sessions = None
+
+    def start(self) -> None:
+        from src.agents.workflow import BlockAgentFlow
+        from src.memory.session_store import SessionMemories, open_session_store
+
+        self.workflow = BlockAgentFlow()
+        self.sessions = SessionMemories(open_session_store())
+
+    def process(self, session_id: str, query: str) -> Dict[str, Any]:
+        memory = self.sessions.get(session_id)
+        try:
+            return self.workflow.process(query, memory)
+        finally:
+            self.sessions.save(session_id, memory)
+
+    def reset(self, session_id: str) -> None:
+        self.sessions.drop(session_id)
+
+    def stop(self) -> None:
+        self.sessions.close()
+
+
+class WorkerPool:
+    """ Dispatches turns to worker processes by session id, keeps the workers healthy """
+
+    def __init__(self, workers: int, threads_per_worker: int = WORKER_THREADS, max_turns: int = WORKER_MAX_TURNS,
+                 max_rss_mb: int = WORKER_MAX_RSS_MB, health_interval: float = HEALTH_INTERVAL,
+                 health_timeout: float = HEALTH_TIMEOUT):
+        if workers < 1:
+            raise ValueError("The pool needs at least one worker")
+
+        # spawn, not fork: the parent has live threads (prefetcher, metrics server) and sockets
+        self.context = multiprocessing.get_context("spawn")
+        self.slots = [WorkerSlot(index) for index in range(workers)]
+        self.threads_per_worker = threads_per_worker
+        self.max_turns = max_turns
+        self.max_rss_mb = max_rss_mb
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.request_ids = itertools.count()
+        self.stopped = threading.Event()
+        self.monitor = None
+
+    def start(self) -> None:
+        # start them all first, they build their workflows in parallel
+        launched = [self.launch(slot) for slot in self.slots]
+        for slot, (process, conn) in zip(self.slots, launched):
+            self.wait_ready(slot, process, conn)
+            self.install(slot, process, conn)
+        self.monitor = threading.Thread(target=self.watch, name="worker-monitor", daemon=True)
+        self.monitor.start()
+        logger.info(f"started {len(self.slots)} workers")
+
+    def launch(self, slot: WorkerSlot):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=worker_main, args=(child_conn, self.threads_per_worker,
+                                                                       slot.index, len(self.slots)),
+                                       name=f"blockagent-worker-{slot.index}", daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def wait_ready(self, slot: WorkerSlot, process, conn) -> None:
+        try:
+            ready = conn.poll(STARTUP_TIMEOUT) and conn.recv()[0] == "ready"
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            process.kill()
+            raise WorkerCrashed(f"worker {slot.index} did not start within {STARTUP_TIMEOUT}s")
+
+    def install(self, slot: WorkerSlot, process, conn, memories: Optional[Dict[str, Any]] = None) -> None:
+        """ Put a started worker behind the slot, callers hold slot.condition or nothing runs yet"""
+
+        slot.generation += 1
+        slot.process, slot.conn = process, conn
+        slot.turns = 0
+        slot.last_pong = time.monotonic()
+        # the old worker's rss would recycle the new one on the next check
+        slot.stats = {}
+        if memories:
+            slot.send(("restore", memories))
+        threading.Thread(target=self.read, args=(slot, conn, slot.generation),
+                         name=f"worker-reader-{slot.index}", daemon=True).start()
+
+    def slot_for(self, session_id: str) -> WorkerSlot:
+        # crc32 rather than hash(), which is salted per process
+        return self.slots[zlib.crc32(session_id.encode()) % len(self.slots)]
+
+    def submit(self, session_id: str, query: str) -> Future:
+        slot = self.slot_for(session_id)
+        future = Future()
+        request_id = next(self.request_ids)
+
+        with slot.condition:
+            # a recycling worker finishes what it has, new turns wait for its replacement
+            while slot.draining:
+                slot.condition.wait()
+            slot.pending[request_id] = future
+            slot.turns += 1
+            metrics.set_gauge("blockagent_worker_inflight", len(slot.pending), worker=str(slot.index))
+            try:
+                slot.send(("turn", request_id, session_id, query))
+            except OSError as e:
+                slot.pending.pop(request_id, None)
+                raise WorkerCrashed(f"worker {slot.index} is down, the monitor will restart it") from e
+        return future
+
+    def process(self, session_id: str, query: str, timeout: float = TURN_TIMEOUT) -> Dict[str, Any]:
+        """ Same shape as BlockAgentFlow.process, minus the memory, which stays in the worker"""
+
+        return self.submit(session_id, query).result(timeout=timeout)
+
+    def reset(self, session_id: str) -> None:
+        slot = self.slot_for(session_id)
+        with slot.condition:
+            while slot.draining:
+                slot.condition.wait()
+            slot.send(("reset", session_id))
+
+    def read(self, slot: WorkerSlot, conn, generation: int) -> None:
+        """ Answers from one worker process, until its pipe closes"""
+
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind in ("result", "error"):
+                with slot.condition:
+                    future = slot.pending.pop(message[1], None)
+                    metrics.set_gauge("blockagent_worker_inflight", len(slot.pending), worker=str(slot.index))
+                    slot.condition.notify_all()
+                if future is None:
+                    continue
+                if kind == "result":
+                    future.set_result(message[2])
+                else:
+                    future.set_exception(RuntimeError(message[2]))
+            elif kind == "pong" and slot.generation == generation:
+                slot.last_pong = time.monotonic()
+                slot.stats = message[2]
+                metrics.set_gauge("blockagent_worker_rss_mb", message[2]["rss_mb"], worker=str(slot.index))
+                metrics.merge(str(slot.index), message[3])
+            elif kind == "memories" and slot.handover is not None:
+                slot.handover.set_result(message[1])
+
+        # a pipe that closes outside of a recycle means the process died under its turns
+        with slot.condition:
+            if slot.generation == generation and not slot.draining:
+                self.fail_pending(slot, f"worker {slot.index} exited")
+
+    def fail_pending(self, slot: WorkerSlot, reason: str) -> None:
+        pending, slot.pending = slot.pending, {}
+        for future in pending.values():
+            future.set_exception(WorkerCrashed(reason))
+        slot.condition.notify_all()
+
+    def watch(self) -> None:
+        """ Health checks and recycling, every health_interval seconds"""
+
+        ping_ids = itertools.count()
+        while not self.stopped.wait(self.health_interval):
+            for slot in self.slots:
+                try:
+                    self.check(slot, next(ping_ids))
+                except Exception:
+                    logger.exception(f"health check of worker {slot.index} failed")
+
+    def check(self, slot: WorkerSlot, ping_id: int) -> None:
+        if slot.replacement is not None and slot.replacement.is_alive():
+            return
+        if not slot.process.is_alive():
+            self.replace(slot, self.restart, "died")
+        elif time.monotonic() - slot.last_pong > self.health_timeout:
+            self.replace(slot, self.restart, "unresponsive")
+        elif slot.turns >= self.max_turns or slot.stats.get("rss_mb", 0) >= self.max_rss_mb:
+            self.replace(slot, self.recycle)
+        else:
+            slot.send(("ping", ping_id))
+
+    def replace(self, slot: WorkerSlot, method, *args) -> None:
+        """ Restarts and recycles run on their own thread, a worker that is slow to start holds up no other slot"""
+
+        def run() -> None:
+            try:
+                method(slot, *args)
+            except Exception:
+                logger.exception(f"replacing worker {slot.index} failed, the next check tries again")
+
+        slot.replacement = threading.Thread(target=run, name=f"worker-replace-{slot.index}", daemon=True)
+        slot.replacement.start()
+
+    def restart(self, slot: WorkerSlot, reason: str) -> None:
+        """ Replace a broken worker, its turns fail and its sessions start over"""
+
+        logger.error(f"worker {slot.index} {reason}, restarting it, its {slot.stats.get('sessions', 0)} sessions "
+                     f"continue from the session store if there is one")
+        metrics.inc("blockagent_worker_restarts_total", reason=reason)
+        with slot.condition:
+            # new turns wait for the replacement instead of going to the dead pipe
+            slot.draining = True
+            self.fail_pending(slot, f"worker {slot.index} {reason}")
+
+        # the slot is only locked to swap the new worker in, its start takes seconds
+        try:
+            if slot.process.is_alive():
+                slot.process.kill()
+            slot.process.join(timeout=5)
+            process, conn = self.launch(slot)
+            self.wait_ready(slot, process, conn)
+            with slot.condition:
+                self.install(slot, process, conn)
+        finally:
+            with slot.condition:
+                slot.draining = False
+                slot.condition.notify_all()
+
+    def recycle(self, slot: WorkerSlot, timeout: float = TURN_TIMEOUT) -> None:
+        """ Replace a healthy worker without losing its sessions"""
+
+        # the replacement warms up while the old worker keeps serving, the slot only pauses for the handover
+        process, conn = self.launch(slot)
+        self.wait_ready(slot, process, conn)
+
+        with slot.condition:
+            slot.draining = True
+            deadline = time.monotonic() + timeout
+            while slot.pending and time.monotonic() < deadline:
+                slot.condition.wait(deadline - time.monotonic())
+
+        memories = {}
+        slot.handover = Future()
+        try:
+            slot.send(("handover",))
+            memories = slot.handover.result(timeout=timeout)
+        except (FutureTimeoutError, OSError):
+            logger.error(f"worker {slot.index} did not hand its sessions over, they start over")
+        finally:
+            slot.handover = None
+
+        with slot.condition:
+            slot.process.join(timeout=5)
+            if slot.process.is_alive():
+                slot.process.kill()
+            self.fail_pending(slot, f"worker {slot.index} recycled")
+            self.install(slot, process, conn, memories)
+            slot.draining = False
+            slot.condition.notify_all()
+
+        metrics.inc("blockagent_worker_restarts_total", reason="recycled")
+        logger.info(f"recycled worker {slot.index}, {len(memories)} sessions handed over")
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.join(timeout=STARTUP_TIMEOUT)
+        for slot in self.slots:
+            if slot.replacement is not None:
+                slot.replacement.join(timeout=STARTUP_TIMEOUT + TURN_TIMEOUT)
+        for slot in self.slots:
+            try:
+                slot.send(("stop",))
+            except OSError:
+                pass
+        for slot in self.slots:
+            slot.process.join(timeout=5)
+            if slot.process.is_alive():
+                slot.process.kill()
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        return [{"worker": slot.index, "pid": slot.process.pid, "alive": slot.process.is_alive(),
+                 "inflight": len(slot.pending), "turns_since_start": slot.turns, **slot.stats}
+                for slot in self.slots]
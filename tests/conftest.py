@@ -0,0 +1,47 @@
+""" The tests run against the bench stand-ins for OpenAI, The Graph and the Ethereum node.
+
+src reads its configuration at import time, so the fakes are started and the environment is set
+before any test module imports it.
+"""
+import os
+import sys
+import atexit
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_services import FakeServices  # noqa: E402
+
+services = FakeServices(llm_latency=0.0, graph_latency=0.0, rpc_latency=0.0, jitter=0.0).__enter__()
+atexit.register(services.__exit__, None, None, None)
+
+os.environ.update(services.environment())
+os.environ.update({
+    "LOG_LEVEL": "WARNING",
+    # nothing on disk and no background pollers unless a test asks for them
+    "LLM_CACHE_PATH": "",
+    "ROUTING_LOG_PATH": "",
+    "INTENT_MODEL_PATH": "",
+    "SESSION_STORE": "",
+    "LOCAL_STORE_PATH": "",
+    "CASSETTE_MODE": "",
+    "BLOCKAGENT_PREFETCH": "0",
+    "BLOCKAGENT_SPECULATIVE": "0",
+    "SWAP_LOGS": "0",
+    "CLASSIFY_BATCH_WINDOW_MS": "0",
+})
+
+
+@pytest.fixture(scope="session")
+def fake_services() -> FakeServices:
+    return services
+
+
+@pytest.fixture(scope="session")
+def workflow():
+    """ One BlockAgentFlow for the whole run, it is expensive to build"""
+
+    from src.agents.workflow import BlockAgentFlow
+
+    return BlockAgentFlow()
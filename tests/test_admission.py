@@ -0,0 +1,90 @@
+import time
+import threading
+
+import pytest
+
+from src.memory.memory_utils import MessagesMemory
+from src.serving.admission import AdmissionController, Overloaded, RouteLimiter, parse_limits, BUSY_RESPONSE
+
+
+def test_limits_override_the_defaults():
+    limits = parse_limits("classify=4, transaction=0")
+
+    assert limits["classify"] == 4 and limits["transaction"] == 0
+    assert limits["conversation"] == 16
+
+
+def test_a_full_queue_turns_the_next_turn_away():
+    limiter = RouteLimiter("transaction", limit=1, max_queue=0, max_wait=1)
+    limiter.acquire()
+
+    with pytest.raises(Overloaded) as overloaded:
+        limiter.acquire()
+    assert overloaded.value.reason == "queue_full"
+
+
+def test_a_turn_that_waits_too_long_is_turned_away():
+    limiter = RouteLimiter("transaction", limit=1, max_queue=1, max_wait=0.05)
+    limiter.acquire()
+
+    with pytest.raises(Overloaded) as overloaded:
+        limiter.acquire()
+    assert overloaded.value.reason == "timeout"
+    assert limiter.get_stats() == {"limit": 1, "active": 1, "waiting": 0}
+
+
+def test_waiting_turns_get_their_slot_in_arrival_order():
+    limiter = RouteLimiter("transaction", limit=1, max_queue=4, max_wait=5)
+    limiter.acquire()
+    order = []
+
+    def turn(name: str) -> None:
+        limiter.acquire()
+        order.append(name)
+        limiter.release()
+
+    threads = []
+    for name in ("first", "second", "third"):
+        threads.append(threading.Thread(target=turn, args=(name,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    limiter.release()
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ["first", "second", "third"]
+
+
+def test_only_first_turn_data_answers_are_shared():
+    admission = AdmissionController(enabled=True)
+    admission.remember("What is the WETH/USDC liquidity?", "data_retrieval", "1M USD", first_turn=True)
+    admission.remember("and for WBTC?", "data_retrieval", "2M USD", first_turn=False)
+    admission.remember("check my WETH balance", "transaction", "1.5 WETH", first_turn=True)
+    overloaded = Overloaded("data_retrieval", "queue_full")
+
+    response, status = admission.fallback("what is the weth/usdc liquidity", overloaded, first_turn=True)
+    assert status == "cached" and response.startswith("1M USD")
+    # the same words later in a conversation may mean something else
+    assert admission.fallback("what is the weth/usdc liquidity", overloaded, first_turn=False) == (BUSY_RESPONSE, "busy")
+    assert admission.fallback("and for WBTC?", overloaded, first_turn=True)[1] == "busy"
+    assert admission.fallback("check my WETH balance", overloaded, first_turn=True)[1] == "busy"
+
+
+def test_turned_away_turns_get_an_answer_straight_away(workflow, monkeypatch):
+    limiter = workflow.admission.limiters["classify"]
+    monkeypatch.setattr(limiter, "limit", 1)
+    monkeypatch.setattr(limiter, "max_queue", 0)
+    query = "Get me the liquidity for WETH/USDC pool"
+    answer = workflow.process(query, MessagesMemory())["agent_response"]
+
+    limiter.acquire()
+    try:
+        cached = workflow.process(query, MessagesMemory())
+        memory = MessagesMemory()
+        memory.add_message("user", "hi")
+        busy = workflow.process(query, memory)
+    finally:
+        limiter.release()
+
+    assert cached["status"] == "cached" and cached["agent_response"].startswith(answer)
+    assert busy == {**busy, "status": "busy", "agent_response": BUSY_RESPONSE, "query_type": None}
@@ -0,0 +1,92 @@
+import json
+import threading
+
+from src.serving.batch import BatchRunner, read_queries
+
+
+class ScriptedWorkflow:
+    """ Answers every query with its own text, raises for the queries in failing """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+        self.seen_history = {}
+        self.lock = threading.Lock()
+
+    def process(self, query, memory):
+        with self.lock:
+            self.calls.append(query)
+        self.seen_history[query] = [message.content for message in memory.messages]
+        if query in self.failing:
+            raise RuntimeError("boom")
+        memory.add_message("user", query)
+        memory.add_message("assistant", f"answer to {query}")
+        return {"query_type": "conversation", "agent_response": f"answer to {query}", "status": "response_generated"}
+
+
+def write_queries(path, rows):
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+
+
+def read_rows(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_a_failed_turn_stops_its_session_and_resume_runs_only_the_rest(tmp_path):
+    queries, output = tmp_path / "queries.jsonl", tmp_path / "results.jsonl"
+    write_queries(queries, [{"id": "a1", "session_id": "a", "query": "one"},
+                            {"id": "a2", "session_id": "a", "query": "two"},
+                            {"id": "a3", "session_id": "a", "query": "three"},
+                            {"id": "b1", "query": "solo"}])
+
+    first = ScriptedWorkflow(failing={"two"})
+    summary = BatchRunner(first, concurrency=2, progress_every=0).run(str(queries), str(output))
+
+    assert summary["succeeded"] == 2 and summary["failed"] == 1
+    # "three" builds on "two", it waits for the next run
+    assert "three" not in first.calls
+
+    second = ScriptedWorkflow()
+    summary = BatchRunner(second, concurrency=2, progress_every=0).run(str(queries), str(output))
+
+    assert sorted(second.calls) == ["three", "two"]
+    assert summary["skipped"] == 2
+    # the memory of the skipped turn is rebuilt from its recorded delta
+    assert second.seen_history["two"] == ["one", "answer to one"]
+    assert second.seen_history["three"] == ["one", "answer to one", "two", "answer to two"]
+
+    succeeded = [row["id"] for row in read_rows(output) if row["error"] is None]
+    assert sorted(succeeded) == ["a1", "a2", "a3", "b1"]
+
+
+def test_a_finished_run_does_not_run_anything_again(tmp_path):
+    queries, output = tmp_path / "queries.jsonl", tmp_path / "results.jsonl"
+    write_queries(queries, [{"id": str(i), "session_id": "s", "query": f"q{i}"} for i in range(3)])
+
+    BatchRunner(ScriptedWorkflow(), progress_every=0).run(str(queries), str(output))
+    again = ScriptedWorkflow()
+    summary = BatchRunner(again, progress_every=0).run(str(queries), str(output))
+
+    assert again.calls == []
+    assert summary["skipped"] == 3
+    assert len(read_rows(output)) == 3
+
+
+def test_a_half_written_last_line_is_dropped(tmp_path):
+    queries, output = tmp_path / "queries.jsonl", tmp_path / "results.jsonl"
+    write_queries(queries, [{"id": "1", "query": "q1"}, {"id": "2", "query": "q2"}])
+    BatchRunner(ScriptedWorkflow(), progress_every=0).run(str(queries), str(output))
+    output.write_text(output.read_text() + '{"id": "3", "resp')
+
+    BatchRunner(ScriptedWorkflow(), progress_every=0).run(str(queries), str(output))
+
+    assert len(read_rows(output)) == 2
+
+
+def test_queries_are_grouped_into_sessions_in_file_order(tmp_path):
+    queries = tmp_path / "queries.jsonl"
+    write_queries(queries, [{"query": "x", "session_id": "s"}, {"query": "y"}, {"query": "z", "session_id": "s"}])
+
+    sessions = read_queries(str(queries))
+
+    assert [[item["query"] for item in items] for items in sessions.values()] == [["x", "z"], ["y"]]
@@ -0,0 +1,46 @@
+import threading
+
+from bench.run_benchmark import QUERY_MIX, percentile, run_session, summarize, turn_error
+from src.memory.memory_utils import MessagesMemory
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(n) for n in range(1, 101)]
+
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([0.2], 95) == 0.2
+    assert percentile([], 50) == 0.0
+
+
+def test_failed_turns_that_did_not_raise_are_errors():
+    # the agents catch their own exceptions, the failure is only in the answer
+    memory = MessagesMemory()
+    memory.add_message("assistant", "Error processing transaction: node down")
+
+    assert turn_error({"status": "error", "agent_response": "boom"}, MessagesMemory()) == "boom"
+    assert turn_error({"agent_response": ""}, memory) == "Error processing transaction: node down"
+    assert turn_error({"agent_response": "ok", "results": {"error": "pool not found"}}, MessagesMemory()) == "pool not found"
+    assert turn_error({"agent_response": "ok", "results": {"pools": []}}, MessagesMemory()) is None
+
+
+def test_summary_counts_errors_per_route():
+    results = [{"route": "transaction", "latency": 0.2, "error": "node down"},
+               {"route": "transaction", "latency": 0.1, "error": None},
+               {"route": "conversation", "latency": 0.3, "error": None}]
+
+    summary = summarize(results, wall_time=2.0, sessions=1)
+
+    assert summary["errors"] == 1
+    assert summary["turns_per_second"] == 1.5
+    assert summary["routes"]["transaction"] == {"count": 2, "errors": 1, "p50": 0.1, "p95": 0.2, "p99": 0.2}
+    assert summary["routes"]["all"]["count"] == 3
+
+
+def test_the_query_mix_runs_without_errors_against_the_fakes(workflow):
+    results = []
+
+    run_session(workflow, 0, len(QUERY_MIX), results, threading.Lock())
+
+    assert [result["error"] for result in results] == [None] * len(QUERY_MIX)
+    assert {result["route"] for result in results} >= {"data_retrieval", "transaction", "conversation"}
@@ -0,0 +1,64 @@
+import pytest
+
+from src.monitoring.cassette import Cassette, CassetteMiss, ReplayedError
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    """ A cassette with two identical calls, a different one and a failed one"""
+
+    path = str(tmp_path / "cassette.jsonl.gz")
+    answers = iter(["first", "second", "pools"])
+    cassette = Cassette("record", path)
+    cassette.call("graphql", {"query": "tokens"}, lambda: next(answers))
+    cassette.call("graphql", {"query": "tokens"}, lambda: next(answers))
+    cassette.call("graphql", {"query": "pools"}, lambda: next(answers))
+    with pytest.raises(RuntimeError):
+        cassette.call("rpc", {"method": "eth_call"}, failing)
+    cassette.close()
+    return path
+
+
+def failing():
+    raise RuntimeError("execution reverted")
+
+
+def not_called():
+    raise AssertionError("replay went to the network")
+
+
+def test_identical_requests_replay_in_recorded_order(recorded):
+    cassette = Cassette("replay", recorded)
+
+    assert cassette.call("graphql", {"query": "pools"}, not_called) == "pools"
+    assert cassette.call("graphql", {"query": "tokens"}, not_called) == "first"
+    assert cassette.call("graphql", {"query": "tokens"}, not_called) == "second"
+
+
+def test_a_recorded_failure_is_replayed(recorded):
+    with pytest.raises(ReplayedError, match="execution reverted"):
+        Cassette("replay", recorded).call("rpc", {"method": "eth_call"}, not_called)
+
+
+def test_a_request_that_is_not_on_the_cassette_fails(recorded):
+    cassette = Cassette("replay", recorded)
+
+    with pytest.raises(CassetteMiss, match="not on the cassette"):
+        cassette.call("graphql", {"query": "swaps"}, not_called)
+    cassette.call("graphql", {"query": "pools"}, not_called)
+    with pytest.raises(CassetteMiss, match="as often as it was recorded"):
+        cassette.call("graphql", {"query": "pools"}, not_called)
+
+
+def test_loose_matching_serves_the_next_unused_interaction_of_the_kind(recorded):
+    cassette = Cassette("replay", recorded, loose_match=True)
+
+    assert cassette.call("graphql", {"query": "tokens"}, not_called) == "first"
+    assert cassette.call("graphql", {"query": "swaps"}, not_called) == "second"
+    assert cassette.call("graphql", {"query": "swaps"}, not_called) == "pools"
+    with pytest.raises(CassetteMiss):
+        cassette.call("graphql", {"query": "swaps"}, not_called)
+
+
+def test_off_calls_through():
+    assert Cassette("").call("graphql", {"query": "tokens"}, lambda: "live") == "live"
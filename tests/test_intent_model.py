@@ -0,0 +1,170 @@
+import json
+import random
+
+import pytest
+
+from src.agents.intent_model import (IntentModel, LocalIntentClassifier, RoutingLog, HISTORY_CHARS, featurize, fit,
+                                     calibrate, evaluate, read_routing_log)
+
+TEMPLATES = {
+    "data_retrieval": ["what is the price of {token}", "show me the {token} pool liquidity",
+                       "how much {token} is in my wallet", "price of {token} today"],
+    "transaction": ["swap 1 eth for {token}", "buy some {token} with eth", "sell my {token} for usdc",
+                    "swap {token} to eth"],
+    "conversation": ["hello there", "thanks a lot", "who are you", "good morning"],
+}
+TOKENS = ["usdc", "dai", "uni", "link", "wbtc", "aave", "weth", "mkr"]
+
+
+def examples(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        query_type = rng.choice(list(TEMPLATES))
+        rows.append({"query": rng.choice(TEMPLATES[query_type]).format(token=rng.choice(TOKENS)),
+                     "history": "", "query_type": query_type, "confidence": 0.95})
+    return rows
+
+
+@pytest.fixture(scope="module")
+def model():
+    return fit(examples(300), epochs=100)
+
+
+class Fallback:
+    def __init__(self, query_type="data_retrieval"):
+        self.calls = 0
+        self.query_type = query_type
+
+    def __call__(self):
+        self.calls += 1
+        return {"query_type": self.query_type, "confidence": 0.99, "tier": "nano"}
+
+
+def test_features_are_l2_normalised_hash_indices():
+    indices, values = featurize("swap 1 eth", "earlier words", bits=10)
+
+    assert (indices < 1 << 10).all() and len(set(indices)) == len(indices)
+    assert abs(float((values ** 2).sum()) - 1) < 1e-5
+
+
+def test_a_trained_model_separates_the_query_types(model):
+    assert model.predict("what is the price of uni")[0] == "data_retrieval"
+    assert model.predict("swap 1 eth for dai")[0] == "transaction"
+    assert model.predict("hello there")[0] == "conversation"
+
+    evaluation = evaluate(model, examples(60, seed=1))
+    assert evaluation["examples"] == 60 and evaluation["accuracy"] > 0.95
+
+
+def test_a_saved_model_loads_the_same(model, tmp_path):
+    path = str(tmp_path / "model.npz")
+    IntentModel(model.weights, model.bias, model.labels, 2.0, model.bits, {"examples": 300}).save(path)
+    loaded = IntentModel.load(path)
+
+    assert loaded.labels == model.labels and loaded.info == {"examples": 300} and loaded.temperature == 2.0
+    assert loaded.predict("sell my link for usdc")[0] == model.predict("sell my link for usdc")[0]
+
+
+def test_calibration_never_sharpens_the_model(model):
+    # the training distribution itself, every answer right, the lowest nll would be at a temperature below 1
+    assert calibrate(model, examples(100, seed=2)) >= 1.0
+
+
+def test_calibration_needs_enough_examples(model):
+    with pytest.raises(ValueError):
+        calibrate(model, examples(10))
+
+
+def test_coverage_counts_the_words_seen_in_training(model):
+    assert model.coverage("price of uni") == 1.0
+    assert model.coverage("explain impermanent loss") == 0.0
+    assert model.coverage("price of pepe") == pytest.approx(2 / 3)
+    assert model.coverage("?!") == 0.0
+
+
+def test_a_confident_familiar_query_is_routed_locally(model):
+    fallback = Fallback()
+    classifier = LocalIntentClassifier(model, min_confidence=0.5, audit_rate=0.0, log=RoutingLog(""))
+
+    result = classifier.classify("swap 1 eth for uni", "", fallback)
+
+    assert result["query_type"] == "transaction" and result["tier"] == "local"
+    assert fallback.calls == 0
+    assert classifier.get_stats()["accepted"] == 1
+
+
+def test_an_unfamiliar_query_goes_to_the_llm_however_sure_the_model_is(model, tmp_path):
+    log = RoutingLog(str(tmp_path / "routing.jsonl"))
+    classifier = LocalIntentClassifier(model, min_confidence=0.0, audit_rate=0.0, log=log)
+    fallback = Fallback("conversation")
+
+    result = classifier.classify("explain impermanent loss", "", fallback)
+
+    assert result["tier"] == "nano" and fallback.calls == 1
+    stats = classifier.get_stats()
+    assert stats["unfamiliar"] == 1 and stats["audited"] == 0
+    row = json.loads(open(log.path).read())
+    assert row["query_type"] == "conversation" and "local" not in row
+
+
+def test_audited_answers_are_checked_against_the_llm(model):
+    classifier = LocalIntentClassifier(model, min_confidence=0.5, audit_rate=1.0, log=RoutingLog(""))
+
+    classifier.classify("swap 1 eth for uni", "", Fallback("transaction"))
+    classifier.classify("swap 1 eth for uni", "", Fallback("data_retrieval"))
+
+    stats = classifier.get_stats()
+    assert stats["accepted"] == 0 and stats["audited"] == 2 and stats["agreement"] == 0.5
+
+
+def test_without_a_model_every_query_goes_to_the_llm(tmp_path):
+    classifier = LocalIntentClassifier.from_path(str(tmp_path / "missing.npz"), log=RoutingLog(""))
+    fallback = Fallback()
+
+    classifier.classify("price of uni", "", fallback)
+
+    assert fallback.calls == 1 and classifier.get_stats()["loaded"] is False
+
+
+def test_the_routing_log_is_off_unless_a_path_is_set(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    RoutingLog("").append("price of uni", "", {"query_type": "data_retrieval", "confidence": 0.9})
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_the_routing_log_keeps_only_the_end_of_the_history(tmp_path):
+    log = RoutingLog(str(tmp_path / "routing.jsonl"))
+    history = "x" * 1000 + "how much eth?"
+
+    log.append("0.5", history, {"query_type": "transaction", "confidence": 0.9})
+    log.append("hm", "", {"query_type": "not_a_type", "confidence": 0.9})
+
+    rows = [json.loads(line) for line in open(log.path)]
+    assert len(rows) == 1
+    assert len(rows[0]["history"]) == HISTORY_CHARS and rows[0]["history"].endswith("how much eth?")
+
+
+def test_the_routing_log_rotates_at_its_cap(tmp_path):
+    path = str(tmp_path / "routing.jsonl")
+    log = RoutingLog(path, max_mb=200 / (1024 * 1024))
+
+    for i in range(10):
+        log.append(f"price of token{i}", "", {"query_type": "data_retrieval", "confidence": 0.9})
+    log.append("price of token9", "", {"query_type": "transaction", "confidence": 0.9})
+
+    assert (tmp_path / "routing.jsonl.1").exists()
+    assert not (tmp_path / "routing.jsonl.2").exists()
+    assert (tmp_path / "routing.jsonl").stat().st_size < 400
+    rows = read_routing_log(path)
+    # the older rotated log is gone, the latest label of a query wins
+    assert 2 <= len(rows) < 10
+    assert [row["query_type"] for row in rows if row["query"] == "price of token9"] == ["transaction"]
+
+
+def test_low_confidence_labels_are_not_training_data(tmp_path):
+    path = tmp_path / "routing.jsonl"
+    path.write_text(json.dumps({"query": "umm", "query_type": "conversation", "confidence": 0.3}) + "\nnot json\n")
+
+    assert read_routing_log(str(path)) == []
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+from langchain_core.load import dumps
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.outputs import Generation
+
+from src.llm.llm_cache import SQLiteLLMCache, normalize_prompt, normalize_text
+
+MINI = "gpt-4o-mini temperature=0"
+TURBO = "gpt-4-turbo temperature=0"
+
+
+def prompt(text: str) -> str:
+    return dumps([SystemMessage(content="Classify the query"), HumanMessage(content=text)])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SQLiteLLMCache(str(tmp_path / "llm.sqlite"), max_entries=3)
+
+
+def test_normalisation_ignores_case_trailing_punctuation_and_spacing():
+    assert normalize_text("Check my  WETH balance?") == "check my weth balance"
+    assert normalize_prompt(prompt("Check my WETH balance?")) == normalize_prompt(prompt("check my weth  balance"))
+    # a decimal point inside a number is not trailing punctuation
+    assert normalize_text("swap 1.5 WETH") == "swap 1.5 weth"
+
+
+def test_roles_stay_part_of_the_key():
+    assert normalize_prompt(dumps([HumanMessage(content="hi")])) != normalize_prompt(dumps([SystemMessage(content="hi")]))
+
+
+def test_exact_then_normalised_hits(cache):
+    cache.update(prompt("Check my WETH balance"), MINI, [Generation(text="transaction")])
+
+    assert cache.lookup(prompt("Check my WETH balance"), MINI)[0].text == "transaction"
+    assert cache.lookup(prompt("check my weth balance?"), MINI)[0].text == "transaction"
+    assert cache.lookup(prompt("Check my WBTC balance"), MINI) is None
+
+    stats = cache.get_stats()
+    assert (stats["exact_hits"], stats["normalized_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_models_never_read_each_others_answers(cache):
+    cache.update(prompt("hello"), MINI, [Generation(text="conversation")])
+
+    assert cache.lookup(prompt("hello"), TURBO) is None
+
+
+def test_the_least_recently_used_entries_are_evicted(cache):
+    for text in ("one", "two", "three"):
+        cache.update(prompt(text), MINI, [Generation(text=text)])
+    cache.lookup(prompt("one"), MINI)
+    cache.update(prompt("four"), MINI, [Generation(text="four")])
+
+    assert cache.lookup(prompt("two"), MINI) is None
+    assert cache.lookup(prompt("one"), MINI) is not None
+    assert cache.get_stats()["entries"] == 3
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / "llm.sqlite")
+    SQLiteLLMCache(path).update(prompt("hello"), MINI, [Generation(text="conversation")])
+
+    reopened = SQLiteLLMCache(path)
+
+    assert reopened.lookup(prompt("hello"), MINI)[0].text == "conversation"
+    assert reopened.get_stats()["entries"] == 1
+
+
+def test_an_unreadable_entry_is_a_miss(cache):
+    cache.update(prompt("hello"), MINI, [Generation(text="conversation")])
+    cache.connection.execute("UPDATE llm_cache SET value = ?", (json.dumps(["not a generation"]),))
+
+    assert cache.lookup(prompt("hello"), MINI) is None
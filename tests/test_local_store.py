@@ -0,0 +1,51 @@
+import threading
+
+from src.blockchain.graph_utils import GraphQLClient, UNISWAP_V3_URL
+from src.blockchain.local_store import LocalStore, SubgraphSync
+
+
+def test_a_lease_is_held_until_it_expires(tmp_path):
+    path = str(tmp_path / "uniswap.sqlite")
+    first, second = LocalStore(path), LocalStore(path)
+
+    assert first.try_lease("first", ttl=60)
+    assert first.try_lease("first", ttl=60)
+    assert not second.try_lease("second", ttl=60)
+
+    assert first.try_lease("first", ttl=-1)
+    assert second.try_lease("second", ttl=60)
+    assert not first.try_lease("first", ttl=60)
+
+
+def test_only_one_of_many_racing_processes_gets_an_expired_lease(tmp_path):
+    path = str(tmp_path / "uniswap.sqlite")
+    stores = [LocalStore(path) for _ in range(2)]
+    stores[0].try_lease("nobody", ttl=-1)
+
+    for round_number in range(20):
+        barrier = threading.Barrier(16)
+        winners = []
+
+        def contend(index: int) -> None:
+            barrier.wait()
+            if stores[index % 2].try_lease(f"owner-{round_number}-{index}", ttl=60):
+                winners.append(index)
+
+        threads = [threading.Thread(target=contend, args=(index,)) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(winners) == 1
+        stores[0].try_lease(f"owner-{round_number}-{winners[0]}", ttl=-1)
+
+
+def test_a_sync_answers_pool_questions_locally(tmp_path):
+    store = LocalStore(str(tmp_path / "uniswap.sqlite"))
+    assert store.get_pool_liquidity("WETH", "USDC") is None
+
+    counts = SubgraphSync(store, GraphQLClient(UNISWAP_V3_URL)).sync_once()
+
+    assert counts["pools"] > 0
+    assert store.get_pool_liquidity("WETH", "USDC")
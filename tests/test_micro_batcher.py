@@ -0,0 +1,92 @@
+import json
+import threading
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+import src.agents.query_classifier as query_classifier
+from src.agents.query_classifier import CascadeClassifier, CascadeTier
+from src.llm.micro_batcher import MicroBatcher
+from src.llm.rate_limiter import llm_priority, current_priority, PRIORITY_CRITICAL, PRIORITY_BACKGROUND
+
+
+def submit_all(batcher: MicroBatcher, items, priorities=None):
+    results = {}
+    threads = []
+    for index, item in enumerate(items):
+        def run(item=item, priority=(priorities or {}).get(item, PRIORITY_CRITICAL)):
+            with llm_priority(priority):
+                try:
+                    results[item] = batcher.submit(item)
+                except Exception as e:
+                    results[item] = e
+        threads.append(threading.Thread(target=run))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_calls_within_the_window_go_out_together():
+    batches = []
+    batcher = MicroBatcher("test", lambda batch: batches.append(list(batch)) or [item * 2 for item in batch],
+                           window=0.2, max_size=8)
+
+    results = submit_all(batcher, [1, 2, 3])
+
+    assert results == {1: 2, 2: 4, 3: 6}
+    assert [sorted(batch) for batch in batches] == [[1, 2, 3]]
+    assert batcher.get_stats()["avg_batch_size"] == 3
+
+
+def test_a_full_batch_goes_without_waiting_for_the_window():
+    batches = []
+    batcher = MicroBatcher("test", lambda batch: batches.append(list(batch)) or list(batch), window=5.0, max_size=2)
+
+    results = submit_all(batcher, [1, 2, 3, 4])
+
+    assert results == {1: 1, 2: 2, 3: 3, 4: 4}
+    assert sorted(len(batch) for batch in batches) == [2, 2]
+
+
+def test_a_failed_batch_fails_every_caller():
+    def failing(batch):
+        raise RuntimeError("openai is down")
+
+    results = submit_all(MicroBatcher("test", failing, window=0.1, max_size=8), [1, 2])
+
+    assert all(isinstance(result, RuntimeError) for result in results.values())
+
+
+def test_a_batch_goes_at_its_most_urgent_priority():
+    priorities = []
+    batcher = MicroBatcher("test", lambda batch: priorities.append(current_priority.get()) or list(batch),
+                           window=0.2, max_size=8)
+
+    submit_all(batcher, [1, 2], priorities={1: PRIORITY_BACKGROUND, 2: PRIORITY_CRITICAL})
+
+    assert priorities == [PRIORITY_CRITICAL]
+
+
+def test_a_batched_reply_is_split_and_missing_items_asked_again(monkeypatch):
+    calls = []
+
+    def invoke(llm, messages):
+        calls.append(messages)
+        if "Item 1" in messages[-1].content:
+            # item 2 is left out of the batched reply
+            return AIMessage(content=json.dumps({"classifications": [
+                {"item": 1, "query_type": "transaction", "confidence": 0.9}]}))
+        return AIMessage(content=json.dumps({"query_type": "conversation", "confidence": 0.8}))
+
+    monkeypatch.setattr(query_classifier, "invoke_chat_model", invoke)
+    classifier = CascadeClassifier([CascadeTier(model_name="small", min_confidence=0.0)])
+    batch = [[SystemMessage(content="classify"), HumanMessage(content=query)] for query in ("swap 1 WETH", "hello")]
+
+    replies = classifier.send_batch(0, batch)
+
+    assert json.loads(replies[0]) == {"query_type": "transaction", "confidence": 0.9}
+    assert json.loads(replies[1]) == {"query_type": "conversation", "confidence": 0.8}
+    assert calls[0][0].content.startswith("classify\n\n")
+    assert calls[1] == batch[1]
@@ -0,0 +1,72 @@
+import pytest
+
+from src.blockchain.portfolio import get_portfolio, pool_price
+
+
+def pool(token0: str, token1: str, locked0: float, locked1: float, usd: float):
+    return {"pools": [{"token0": {"symbol": token0}, "token1": {"symbol": token1}, "totalValueLockedToken0": str(locked0),
+                       "totalValueLockedToken1": str(locked1), "totalValueLockedUSD": str(usd)}]}
+
+
+class StubPools:
+    """ WETH/USDC stored as USDC/WETH, UNI only has a WETH pool, WBTC and the rest have none"""
+
+    def __init__(self):
+        self.pools = {("USDC", "WETH"): {**pool("USDC", "WETH", 3_000_000, 1000, 6_000_000), "as_of": "2026-10-19T10:00:00Z"},
+                      ("UNI", "WETH"): {**pool("UNI", "WETH", 10_000, 10, 60_000), "as_of": "2026-10-19T09:00:00Z"}}
+
+    def get_pool_liquidity(self, token0: str, token1: str):
+        return self.pools.get((token0, token1), {"pools": []})
+
+
+class StubWallet:
+    address = "0xf39Fd6e51aad88F6F4ce6aB8827279cffFb92266"
+    balances = {"ETH": 1.0, "WETH": 0.5, "USDC": 100.0, "UNI": 20.0, "WBTC": 0.1, "USDT": 0.0, "UST": 0.0}
+
+    def get_token_balance(self, symbol: str):
+        if symbol == "DAI":
+            return {"error": "node down"}
+        return {"symbol": symbol, "balance": self.balances[symbol], "address": self.address}
+
+
+def test_a_price_comes_from_the_pools_tvl_split():
+    weth_usdc = pool("WETH", "USDC", 1000, 3_000_000, 6_000_000)["pools"][0]
+
+    assert pool_price(weth_usdc, True, 1.0) == 3000.0
+    assert pool_price(weth_usdc, False, 3000.0) == 1.0
+    assert pool_price({**weth_usdc, "totalValueLockedToken0": "0"}, True, 1.0) is None
+
+
+def test_every_balance_is_valued_in_usdc():
+    portfolio = get_portfolio(StubWallet(), StubPools())
+    holdings = {holding["symbol"]: holding for holding in portfolio["holdings"]}
+
+    # ETH is priced as WETH, UNI through its WETH pool
+    assert holdings["ETH"]["value_usdc"] == pytest.approx(3000.0)
+    assert holdings["WETH"]["value_usdc"] == pytest.approx(1500.0)
+    assert holdings["USDC"]["value_usdc"] == 100.0
+    assert holdings["UNI"]["price_usdc"] == pytest.approx(3.0)
+    assert portfolio["total_value_usdc"] == pytest.approx(4660.0)
+    assert [holding["symbol"] for holding in portfolio["holdings"][:2]] == ["ETH", "WETH"]
+
+
+def test_what_could_not_be_read_or_priced_is_listed():
+    portfolio = get_portfolio(StubWallet(), StubPools())
+
+    assert portfolio["unpriced"] == ["WBTC"]
+    assert portfolio["errors"] == ["DAI: node down"]
+    assert portfolio["prices_as_of"] == "2026-10-19T09:00:00Z"
+
+
+def test_no_wallet_no_portfolio():
+    class NoWallet(StubWallet):
+        address = None
+
+    assert "error" in get_portfolio(NoWallet(), StubPools())
+
+
+def test_the_portfolio_against_the_fakes(workflow):
+    portfolio = get_portfolio(workflow.transaction_agent.web3_tools, workflow.transaction_agent.graph_tools)
+
+    assert portfolio["total_value_usdc"] > 0
+    assert "errors" not in portfolio
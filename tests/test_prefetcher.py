@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from src.blockchain.graph_utils import GraphQLClient, UNISWAP_V3_URL
+from src.blockchain.prefetcher import HotDataPrefetcher
+
+
+class CountingGraphTools:
+    def __init__(self):
+        self.calls = []
+
+    def get_pool_liquidity(self, token0: str, token1: str):
+        self.calls.append(("pool", token0, token1))
+        return {"pool": f"{token0}/{token1}", "call": len(self.calls)}
+
+    def get_recent_swaps(self, token_symbol: str, limit: int):
+        self.calls.append(("swaps", token_symbol, limit))
+        return {"swaps": [], "call": len(self.calls)}
+
+    def read_swap_logs(self, token_symbol: str, limit: int):
+        return None
+
+
+def test_a_warm_key_is_served_from_memory():
+    tools = CountingGraphTools()
+    prefetcher = HotDataPrefetcher(tools, seed_keys=[])
+
+    first = prefetcher.get_pool_liquidity("weth", "usdc")
+    second = prefetcher.get_pool_liquidity("WETH", "USDC")
+
+    assert tools.calls == [("pool", "WETH", "USDC")]
+    assert second["call"] == first["call"] and "as_of" in second
+    assert prefetcher.get_stats()["warm_hits"] == 1
+
+
+def test_refresh_fetches_only_the_top_keys():
+    tools = CountingGraphTools()
+    prefetcher = HotDataPrefetcher(tools, top_k=1, seed_keys=[])
+    for _ in range(3):
+        prefetcher.get_recent_swaps("WETH", 5)
+    prefetcher.get_pool_liquidity("WBTC", "WETH")
+    tools.calls.clear()
+
+    prefetcher.refresh()
+
+    assert tools.calls == [("swaps", "WETH", 5)]
+
+
+def test_an_old_entry_is_fetched_again():
+    tools = CountingGraphTools()
+    prefetcher = HotDataPrefetcher(tools, max_age=0.0, seed_keys=[])
+    prefetcher.get_pool_liquidity("WETH", "USDC")
+    prefetcher.get_pool_liquidity("WETH", "USDC")
+
+    assert len(tools.calls) == 2
+
+
+def test_concurrent_subgraph_queries_all_succeed():
+    # the refresher queries while the turns do, one gql client per thread
+    client = GraphQLClient(UNISWAP_V3_URL)
+    query = '{ tokens(where: {symbol: "WETH"}) { id symbol } }'
+
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(executor.map(lambda _: client.execute_query(query), range(40)))
+
+    assert all(result["tokens"] for result in results)
@@ -0,0 +1,63 @@
+import re
+
+import pytest
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from src.agents.workflow import CLASSIFY_PROMPT
+from src.agents.conversation_agent import CONVERSATION_PROMPT
+from src.agents import transaction_agent, subgraph_query_agent
+from src.llm.prompts import PromptTemplate
+
+TEMPLATES = [CLASSIFY_PROMPT, CONVERSATION_PROMPT, transaction_agent.EXTRACTION_PROMPT,
+             transaction_agent.MISSING_PARAMETERS_PROMPT, transaction_agent.RESPONSE_PROMPT,
+             subgraph_query_agent.EXTRACTION_PROMPT, subgraph_query_agent.RESPONSE_PROMPT]
+
+
+def test_the_instructions_come_first_then_history_then_data_and_query():
+    template = PromptTemplate("test", """
+        Answer the question.
+    """)
+
+    parts = template.parts(query=" swap 1 WETH ", history="user: hi", context="pools: none")
+
+    assert parts == [("system", "Answer the question."),
+                     ("user", "Conversation history:\nuser: hi"),
+                     ("user", "pools: none\n\nUser query: swap 1 WETH")]
+    assert template.parts(history="")[1] == ("user", "Conversation history:\n(none)")
+
+
+def test_both_message_formats_carry_the_same_parts():
+    template = PromptTemplate("test", "Answer the question.")
+
+    chat = template.chat_messages(query="hello", history="")
+    openai = template.openai_messages(query="hello", history="")
+
+    assert [type(message) for message in chat] == [SystemMessage, HumanMessage, HumanMessage]
+    assert [message.content for message in chat] == [message["content"] for message in openai]
+    assert [message["role"] for message in openai] == ["system", "user", "user"]
+
+
+def test_indentation_does_not_change_the_prefix():
+    assert PromptTemplate("a", "\n    Answer.\n").prefix_id == PromptTemplate("b", "Answer.").prefix_id
+
+
+@pytest.mark.parametrize("template", TEMPLATES, ids=lambda template: template.name)
+def test_the_agents_instructions_are_static(template):
+    # no per turn placeholders left in the part OpenAI caches
+    assert not re.search(r"\{(query|history|conversation_history|context|results?)\}", template.instructions)
+    first = template.chat_messages(query="swap 1 WETH", history="user: hi", context="pools: none")[0]
+    second = template.chat_messages(query="hello", history="", context="")[0]
+    assert first.content == second.content == template.instructions
+
+
+def test_every_llm_call_of_a_turn_starts_with_a_static_prefix(workflow, fake_services):
+    from src.memory.memory_utils import MessagesMemory
+
+    fake_services.openai.recent_prompts.clear()
+    memory = MessagesMemory()
+    for query in ("Get me the liquidity for WETH/USDC pool", "I want to swap 1 WETH for USDC", "Hello"):
+        workflow.process(query, memory)
+
+    prompts = list(fake_services.openai.recent_prompts)
+    prefixes = [f"<system>{template.instructions}" for template in TEMPLATES]
+    assert prompts and all(any(prompt.startswith(prefix) for prefix in prefixes) for prompt in prompts)
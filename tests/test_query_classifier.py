@@ -0,0 +1,88 @@
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+import src.agents.query_classifier as query_classifier
+from src.agents.query_classifier import CascadeClassifier, CascadeTier
+from src.memory.memory_utils import MessagesMemory
+
+
+TIERS = [CascadeTier(model_name="small", min_confidence=0.8), CascadeTier(model_name="large", min_confidence=0.0)]
+MESSAGES = [SystemMessage(content="classify"), HumanMessage(content="I want to swap 1 WETH for USDC")]
+
+
+def classification(query_type: str, confidence: float) -> str:
+    return json.dumps({"query_type": query_type, "confidence": confidence})
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    """ model name -> the reply its tier gets, the models each call went to are in replies["calls"]"""
+
+    scripted = {"calls": []}
+
+    def invoke(llm, messages):
+        scripted["calls"].append(llm.model_name)
+        return AIMessage(content=scripted[llm.model_name])
+
+    monkeypatch.setattr(query_classifier, "invoke_chat_model", invoke)
+    return scripted
+
+
+def test_a_sure_small_model_answers_alone(replies):
+    replies["small"] = classification("transaction", 0.95)
+
+    result = CascadeClassifier(TIERS).classify(MESSAGES)
+
+    assert result == {"query_type": "transaction", "confidence": 0.95, "tier": "small"}
+    assert replies["calls"] == ["small"]
+
+
+@pytest.mark.parametrize("small_reply", [classification("transaction", 0.5), "not json", classification("swap", 0.99)])
+def test_unsure_or_unusable_answers_escalate(replies, small_reply):
+    replies["small"] = small_reply
+    replies["large"] = classification("transaction", 0.9)
+
+    classifier = CascadeClassifier(TIERS)
+    result = classifier.classify(MESSAGES)
+
+    assert result["tier"] == "large"
+    assert replies["calls"] == ["small", "large"]
+    assert classifier.get_stats()["small"]["escalated"] == 1
+
+
+@pytest.mark.parametrize("last_reply", ["not json", "[1, 2]", '"transaction"', "{}"])
+def test_an_unusable_last_tier_is_unknown(replies, last_reply):
+    replies["small"] = replies["large"] = last_reply
+
+    result = CascadeClassifier(TIERS).classify(MESSAGES)
+
+    assert result == {"query_type": "unknown", "confidence": 0.0, "tier": "large"}
+
+
+def test_an_unknown_classification_asks_to_clarify(workflow, monkeypatch):
+    monkeypatch.setattr(workflow.classifier, "classify",
+                        lambda messages: {"query_type": "unknown", "confidence": 0.0, "tier": "large"})
+    memory = MessagesMemory()
+
+    result = workflow.process("asdf qwerty", memory)
+
+    assert result["status"] == "clarification_needed"
+    assert result["query_type"] == "unknown"
+    assert "clarify" in result["agent_response"]
+    assert [message.role for message in memory.messages] == ["user", "assistant"]
+
+
+def test_tier_outcomes_and_latency_are_exported(replies):
+    from src.monitoring.tracing import metrics
+
+    replies["small"] = classification("transaction", 0.5)
+    replies["large"] = classification("transaction", 0.9)
+    CascadeClassifier(TIERS).classify(MESSAGES)
+
+    rendered = metrics.render()
+    assert 'blockagent_classifier_tier_total{outcome="unsure",tier="small"}' in rendered
+    assert 'blockagent_classifier_tier_total{outcome="accepted",tier="large"}' in rendered
+    assert 'blockagent_classifier_escalations_total{tier="small"}' in rendered
+    assert 'blockagent_classifier_tier_seconds_count{tier="large"}' in rendered
@@ -0,0 +1,86 @@
+import time
+import threading
+
+import httpx
+
+from src.llm.rate_limiter import (LLMScheduler, ModelBudget, RateLimitedTransport, parse_duration,
+                                  estimate_request_tokens, llm_priority, current_priority,
+                                  PRIORITY_CRITICAL, PRIORITY_BACKGROUND)
+
+
+def test_a_worker_paces_to_its_share_of_the_budget():
+    budget = LLMScheduler(rpm=500, tpm=30000, share=0.25).budget("gpt-4o-mini")
+
+    assert budget.requests.limit == 125
+    assert budget.tokens.limit == 7500
+
+
+def test_limits_reported_by_openai_are_split_too():
+    budget = ModelBudget(500, 30000, share=0.5)
+    budget.observe_headers({"x-ratelimit-limit-requests": "1000", "x-ratelimit-limit-tokens": "200000"})
+
+    assert budget.requests.limit == 500
+    assert budget.tokens.limit == 100000
+
+
+def test_reset_headers_are_parsed():
+    assert parse_duration("6m0s") == 360.0
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("2") == 2.0
+    assert parse_duration("soon") is None
+    assert parse_duration(None) is None
+
+
+def test_request_tokens_are_estimated_from_the_messages():
+    body = {"messages": [{"role": "user", "content": "x" * 84}], "max_tokens": 10}
+
+    assert estimate_request_tokens(body) == 35
+
+
+def test_nested_priorities_never_raise_the_priority():
+    with llm_priority(PRIORITY_BACKGROUND):
+        with llm_priority(PRIORITY_CRITICAL):
+            assert current_priority.get() == PRIORITY_BACKGROUND
+    assert current_priority.get() == PRIORITY_CRITICAL
+
+
+def test_a_waiting_turn_goes_before_waiting_background_work():
+    scheduler = LLMScheduler(rpm=60, tpm=1_000_000, share=1.0)
+    budget = scheduler.budget("gpt-4o-mini")
+    budget.requests.level = 0.0
+    order = []
+
+    def call(priority: int) -> None:
+        scheduler.acquire("gpt-4o-mini", 1, priority)
+        order.append(priority)
+
+    background = threading.Thread(target=call, args=(PRIORITY_BACKGROUND,))
+    background.start()
+    time.sleep(0.1)
+    critical = threading.Thread(target=call, args=(PRIORITY_CRITICAL,))
+    critical.start()
+    background.join(10)
+    critical.join(10)
+
+    assert order == [PRIORITY_CRITICAL, PRIORITY_BACKGROUND]
+
+
+def test_a_429_is_retried_in_the_transport_and_usage_settles_the_estimate():
+    responses = [httpx.Response(429, headers={"retry-after": "0.01"}),
+                 httpx.Response(200, json={"usage": {"total_tokens": 7}},
+                                headers={"x-ratelimit-limit-tokens": "60000"})]
+    sent = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(request)
+        return responses[len(sent) - 1]
+
+    scheduler = LLMScheduler(rpm=600, tpm=30000, share=1.0)
+    client = httpx.Client(transport=RateLimitedTransport(scheduler, httpx.MockTransport(handler)))
+    response = client.post("https://api.openai.com/v1/chat/completions",
+                           json={"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}]})
+
+    assert response.status_code == 200 and response.json()["usage"]["total_tokens"] == 7
+    assert len(sent) == 2
+    assert scheduler.budget("gpt-4o-mini").tokens.limit == 60000
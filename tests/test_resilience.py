@@ -0,0 +1,180 @@
+import time
+import threading
+
+import pytest
+
+from src.blockchain.resilience import Upstream, CircuitBreaker, Unavailable, RPC, resilient, call_key, live_results
+
+
+def tool_class(upstream):
+    """ A tool whose upstream calls are counted, and made slow or failing on demand """
+
+    class Tools:
+        def __init__(self, address="0xwallet"):
+            self.address = address
+            self.upstream = upstream
+            self.calls = []
+            self.delay = 0.0
+            self.fail = False
+
+        def answer(self, name, *args):
+            self.calls.append((name, args))
+            time.sleep(self.delay)
+            if self.fail:
+                raise ConnectionError("node down")
+            return {"name": name, "args": list(args), "call": len(self.calls)}
+
+        @resilient(upstream)
+        def get_token_balance(self, token_symbol):
+            return self.answer("balance", token_symbol)
+
+        @resilient(upstream)
+        def quote_swap(self, token_in, token_out, amount_in):
+            return self.answer("quote", token_in, token_out, amount_in)
+
+        @resilient(upstream, keep=False)
+        def simulate_swap(self, token_in, token_out, amount_in, quote=None):
+            return self.answer("simulate", token_in, token_out, amount_in)
+
+    return Tools
+
+
+@pytest.fixture
+def tool_type():
+    return tool_class(Upstream("test", deadline=0.5, fresh_for=60, stale_for=300,
+                               breaker=CircuitBreaker("test", failures=2, reset_after=0.1)))
+
+
+@pytest.fixture
+def tools(tool_type):
+    return tool_type()
+
+
+def test_the_key_holds_the_wallet_and_every_argument(tool_type):
+    def quote_swap(self, token_in, token_out, amount_in):
+        pass
+
+    key = call_key(quote_swap, tool_type("0xa"), ("eth", "usdc", 1.0), {})
+
+    assert key == call_key(quote_swap, tool_type("0xa"), ("ETH", "USDC", 1.0), {})
+    assert key != call_key(quote_swap, tool_type("0xb"), ("ETH", "USDC", 1.0), {})
+    assert key != call_key(quote_swap, tool_type("0xa"), ("ETH", "USDC", 2.0), {})
+    assert key != call_key(quote_swap, tool_type("0xa"), ("ETH", "USDC"), {"amount_in": 1.0})
+    # dict arguments (a quote) are keyed too
+    assert call_key(quote_swap, tool_type(), ({"out": 1},), {}) != call_key(quote_swap, tool_type(), ({"out": 2},), {})
+
+
+def test_a_fresh_result_comes_from_memory(tools):
+    first = tools.get_token_balance("ETH")
+    second = tools.get_token_balance("eth")
+
+    assert len(tools.calls) == 1
+    assert second["call"] == first["call"] and "as_of" in second
+
+
+def test_different_wallets_and_amounts_are_not_shared(tool_type, tools):
+    tools.quote_swap("ETH", "USDC", 1.0)
+    tools.quote_swap("ETH", "USDC", 2.0)
+    other = tool_type("0xother")
+    other.quote_swap("ETH", "USDC", 1.0)
+
+    assert len(tools.calls) == 2 and len(other.calls) == 1
+
+
+def test_simulations_are_never_served_from_memory(tools):
+    tools.simulate_swap("ETH", "USDC", 1.0)
+    tools.simulate_swap("ETH", "USDC", 1.0)
+
+    assert len(tools.calls) == 2
+    assert tools.upstream.get_stats()["kept_results"] == 0
+
+    # and with the upstream down there is no earlier simulation to fall back on either
+    tools.fail = True
+    with pytest.raises(ConnectionError):
+        tools.simulate_swap("ETH", "USDC", 1.0)
+
+
+def test_the_real_swap_simulation_is_never_kept(workflow):
+    web3_tools = workflow.transaction_agent.web3_tools
+    web3_tools.simulate_swap("ETH", "USDC", 0.1)
+
+    assert not [key for key in RPC.results if key[0].endswith("simulate_swap")]
+
+
+def test_a_stale_result_is_served_while_it_refreshes(tools):
+    tools.get_token_balance("ETH")
+    key = next(iter(tools.upstream.results))
+    value, _ = tools.upstream.results[key]
+    tools.upstream.results[key] = (value, time.time() - 120)
+
+    stale = tools.get_token_balance("ETH")
+    deadline = time.time() + 2
+    while tools.upstream.results[key][0]["call"] == 1 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert stale["call"] == 1
+    assert len(tools.calls) == 2 and tools.upstream.results[key][0]["call"] == 2
+
+
+def test_live_results_skip_memory(tools):
+    tools.get_token_balance("ETH")
+    with live_results():
+        live = tools.get_token_balance("ETH")
+
+    assert live["call"] == 2
+
+
+def test_a_slow_upstream_gets_the_last_answer_past_its_deadline(tools):
+    tools.get_token_balance("ETH")
+    key = next(iter(tools.upstream.results))
+    value, _ = tools.upstream.results[key]
+    tools.upstream.results[key] = (value, time.time() - 600)
+    tools.delay = 1.0
+
+    start = time.time()
+    degraded = tools.get_token_balance("ETH")
+
+    assert time.time() - start < 0.9
+    assert degraded["call"] == 1 and "did not answer within 0.5s" in degraded["degraded"]
+
+
+def test_an_upstream_without_an_earlier_answer_is_unavailable(tools):
+    tools.delay = 1.0
+
+    with pytest.raises(Unavailable) as unavailable:
+        tools.get_token_balance("ETH")
+    assert unavailable.value.upstream == "test"
+
+
+def test_the_breaker_opens_then_lets_one_probe_through(tools):
+    tools.fail = True
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            tools.get_token_balance("ETH")
+    assert tools.upstream.breaker.state == "open"
+
+    with pytest.raises(Unavailable):
+        tools.get_token_balance("ETH")
+    assert len(tools.calls) == 2
+
+    time.sleep(0.15)
+    tools.fail = False
+    assert tools.get_token_balance("ETH")["call"] == 3
+    assert tools.upstream.breaker.state == "closed"
+
+
+def test_only_one_refresh_per_key_runs_at_a_time(tools):
+    tools.get_token_balance("ETH")
+    key = next(iter(tools.upstream.results))
+    value, _ = tools.upstream.results[key]
+    tools.upstream.results[key] = (value, time.time() - 120)
+    tools.delay = 0.2
+
+    threads = [threading.Thread(target=tools.get_token_balance, args=("ETH",)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(0.4)
+
+    assert len(tools.calls) == 2
@@ -0,0 +1,39 @@
+from src.llm.result_compactor import ResultCompactor, compact_value, render_result
+from src.monitoring.tracing import metrics
+
+
+def test_numeric_fields_are_rounded():
+    assert compact_value("amountUSD", "1234.56789") == "1234.57"
+    assert compact_value("token0Price", "0.000123456789") == "0.000123457"
+    assert compact_value("totalValueLockedUSD", "1000000.0") == "1000000"
+    assert compact_value("balance", 2.5) == "2.50"
+
+
+def test_symbols_that_float_would_parse_are_kept():
+    for symbol in ("NAN", "INF", "Infinity", "1INCH"):
+        assert compact_value("symbol", symbol) == symbol
+    # not a number even where one is expected
+    assert compact_value("amountUSD", "NaN") == "NaN"
+
+
+def test_other_strings_are_left_alone():
+    assert compact_value("address", "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2") == \
+        "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2"
+    assert compact_value("nonce", "17") == "17"
+
+
+def test_rows_are_flattened_without_ids():
+    text = render_result({"swaps": [{"id": "0xabc", "amountUSD": "10.123", "token0": {"symbol": "NAN"}}]})
+
+    assert text == "swaps (1 rows):\namountUSD,token0_symbol\n10.12,NAN"
+
+
+def test_tokens_saved_are_exported_per_query_type():
+    compactor = ResultCompactor()
+    result = {"pools": [{"id": f"0x{n:040x}", "volumeUSD": "123456.789012", "feeTier": "3000"} for n in range(20)]}
+
+    compactor.compact(result, "pool_liquidity_check")
+    saved = compactor.get_stats()["pool_liquidity_check"]["tokens_saved"]
+
+    assert saved > 0
+    assert metrics.values["blockagent_prompt_tokens_saved_total"][(("query_type", "pool_liquidity_check"),)] >= saved
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from src.memory.session_store import SessionMemories, open_session_store
+
+
+@pytest.fixture(params=["sessions.sqlite", "sessions"])
+def store(request, tmp_path):
+    store = open_session_store(str(tmp_path / request.param))
+    yield store
+    store.close()
+
+
+def test_a_session_continues_from_the_store(store):
+    memories = SessionMemories(store)
+    memory = memories.get("a")
+    memory.add_message("user", "hello")
+    memory.update_entity("token_in", "WETH")
+    memories.save("a", memory)
+    store.flush()
+
+    restored = SessionMemories(store).get("a")
+
+    assert restored == memory
+
+
+def test_an_unreadable_snapshot_starts_the_session_over(store):
+    store.put("a", b"not a snapshot")
+
+    assert SessionMemories(store).get("a").messages == []
+
+
+def test_a_memory_that_cannot_be_snapshotted_keeps_the_previous_turn(store):
+    memories = SessionMemories(store)
+    memory = memories.get("a")
+    memory.add_message("user", "hello")
+    memories.save("a", memory)
+    memory.update_entity("amount_in", object())
+    memories.save("a", memory)
+
+    assert SessionMemories(store).get("a").messages[0].content == "hello"
+
+
+def test_least_recently_used_memories_go_back_to_the_store(store):
+    memories = SessionMemories(store, max_live=2)
+    for session_id in ("a", "b"):
+        memory = memories.get(session_id)
+        memory.add_message("user", session_id)
+        memories.save(session_id, memory)
+    memories.get("a")
+    memories.get("c")
+
+    assert sorted(memories.memories) == ["a", "c"]
+    assert memories.get("b").messages[0].content == "b"
+
+
+def test_without_a_store_only_idle_memories_are_dropped():
+    memories = SessionMemories(None, max_live=1, idle_ttl=3600)
+    memories.get("a").add_message("user", "a")
+    memories.get("b")
+    assert len(memories) == 2
+
+    memories.idle_ttl = 0.05
+    time.sleep(0.1)
+    memories.get("c")
+    assert list(memories.memories) == ["c"]
@@ -0,0 +1,58 @@
+import zlib
+from decimal import Decimal
+
+import pytest
+
+from src.memory.memory_utils import MessagesMemory
+from src.memory.snapshot import SnapshotError, encode_snapshot, decode_snapshot, HEADER, MAGIC, SNAPSHOT_VERSION, FLAG_ZLIB
+
+
+def conversation() -> MessagesMemory:
+    memory = MessagesMemory()
+    memory.add_message("user", "swap 1 WETH for USDC ✓")
+    memory.add_message("assistant", "Which slippage?")
+    memory.add_message("tool", "quote: 3000 USDC")
+    memory.update_entity("token_in", "WETH")
+    memory.update_entity("amount_in", 1.5)
+    memory.update_entity("path", ["WETH", "USDC"])
+    return memory
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(compress):
+    memory = conversation()
+
+    restored = MessagesMemory.restore(memory.snapshot(compress=compress))
+
+    assert restored == memory
+
+
+def test_an_empty_memory_round_trips():
+    assert MessagesMemory.restore(MessagesMemory().snapshot()) == MessagesMemory()
+
+
+def test_a_corrupt_compressed_body_is_a_snapshot_error():
+    data = conversation().snapshot(compress=True)
+    corrupt = data[:HEADER.size] + bytes(byte ^ 0xFF for byte in data[HEADER.size:])
+
+    with pytest.raises(SnapshotError):
+        decode_snapshot(corrupt)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"XYZ\x01\x00",
+    HEADER.pack(MAGIC, SNAPSHOT_VERSION + 1, 0),
+    HEADER.pack(MAGIC, SNAPSHOT_VERSION, 0) + b"\x05\x00",
+    HEADER.pack(MAGIC, SNAPSHOT_VERSION, FLAG_ZLIB) + zlib.compress(b"\xff\xff\xff\x7f"),
+])
+def test_bytes_that_are_not_a_snapshot_are_rejected(data):
+    with pytest.raises(SnapshotError):
+        decode_snapshot(data)
+
+
+@pytest.mark.parametrize("value", [Decimal("1.5"), {"WETH"}, float("nan")])
+def test_entities_that_are_not_json_values_are_rejected(value):
+    # they used to be written with str() and came back as a different type
+    with pytest.raises(SnapshotError):
+        encode_snapshot([], {"amount_in": value})
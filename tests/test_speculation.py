@@ -0,0 +1,88 @@
+import threading
+
+from src.agents.speculation import Speculator, SpeculationPolicy
+from src.memory.memory_utils import MessagesMemory
+
+
+def policy(**overrides) -> SpeculationPolicy:
+    return SpeculationPolicy(**{"enabled": True, **overrides})
+
+
+def recording_branch(calls: list, gate: threading.Event = None):
+    def run(query: str, conversation_history: str, cancelled: threading.Event):
+        if gate is not None:
+            gate.wait(5)
+        calls.append((query, conversation_history, cancelled.is_set()))
+        return {"extraction": query}
+    return run
+
+
+def test_nothing_starts_when_speculation_is_off():
+    calls = []
+    speculator = Speculator({"transaction": recording_branch(calls)}, policy(enabled=False))
+
+    assert speculator.launch("swap 1 WETH", MessagesMemory()) is None
+    assert speculator.claim(None, "transaction") is None
+
+
+def test_the_winning_branch_is_claimed_and_the_others_cancelled():
+    data_calls, transaction_calls = [], []
+    gate = threading.Event()
+    speculator = Speculator({"data_retrieval": recording_branch(data_calls, gate),
+                             "transaction": recording_branch(transaction_calls)}, policy())
+
+    turn = speculator.launch("swap 1 WETH", MessagesMemory())
+    speculator.resolve(turn, "transaction")
+    gate.set()
+
+    assert speculator.claim(turn, "transaction") == {"extraction": "swap 1 WETH"}
+    assert turn.cancelled["data_retrieval"].is_set()
+    assert not turn.cancelled["transaction"].is_set()
+    assert speculator.claim(turn, "conversation") is None
+
+
+def test_the_branch_sees_the_history_the_agent_will_see():
+    calls = []
+    memory = MessagesMemory()
+    memory.add_message("assistant", "hi")
+    speculator = Speculator({"transaction": recording_branch(calls)}, policy())
+
+    speculator.claim(speculator.launch("swap 1 WETH", memory), "transaction")
+
+    assert calls[0][1] == "assistant: hi\nuser: swap 1 WETH\nuser: swap 1 WETH"
+
+
+def test_wasted_branches_use_up_the_budget():
+    gate = threading.Event()
+    speculator = Speculator({"data_retrieval": recording_branch([], gate),
+                             "transaction": recording_branch([], gate)}, policy(max_wasted_tokens_per_minute=1))
+
+    turn = speculator.launch("what is the WETH/USDC pool liquidity", MessagesMemory())
+    speculator.resolve(turn, None)
+    gate.set()
+
+    assert speculator.wasted_tokens_last_minute() > 0
+    assert speculator.launch("swap 1 WETH", MessagesMemory()) is None
+
+
+def test_a_failed_branch_leaves_the_extraction_to_the_agent():
+    def failing(query, conversation_history, cancelled):
+        raise RuntimeError("openai is down")
+
+    speculator = Speculator({"transaction": failing}, policy())
+
+    assert speculator.claim(speculator.launch("swap 1 WETH", MessagesMemory()), "transaction") is None
+
+
+def test_a_speculative_turn_answers_like_a_sequential_one(workflow):
+    from src.agents.workflow import BlockAgentFlow
+
+    speculative = BlockAgentFlow(speculation_policy=policy())
+    query = "What is the liquidity of the WETH/USDC pool?"
+
+    result = speculative.process(query, MessagesMemory())
+    expected = workflow.process(query, MessagesMemory())
+
+    assert (result["query_type"], result["status"]) == (expected["query_type"], expected["status"])
+    assert result["agent_response"] == expected["agent_response"]
+    assert result["query_type"] == "data_retrieval"
@@ -0,0 +1,86 @@
+import pytest
+
+from src.blockchain.swap_logs import SwapLogWatcher
+
+
+@pytest.fixture
+def watcher(workflow, monkeypatch):
+    watcher = SwapLogWatcher(workflow.transaction_agent.web3_tools, seed_tokens=("UNI",), backfill_blocks=250,
+                             page_blocks=100)
+    ranges = []
+    get_logs = watcher.w3.eth.get_logs
+
+    def recording_get_logs(log_filter):
+        ranges.append((log_filter["fromBlock"], log_filter["toBlock"]))
+        return get_logs(log_filter)
+
+    monkeypatch.setattr(watcher.w3.eth, "get_logs", recording_get_logs)
+    watcher.ranges = ranges
+    return watcher
+
+
+def test_a_backfill_is_read_a_page_at_a_time(watcher):
+    watcher.poll_once()
+
+    head = watcher.last_block
+    assert watcher.ranges == [(head - 250, head - 151), (head - 150, head - 51), (head - 50, head)]
+    assert watcher.get_stats()["tokens"] == ["UNI"]
+
+
+def test_recent_swaps_come_newest_first_with_their_block_time(watcher):
+    watcher.poll_once()
+
+    recent = watcher.get_recent_swaps("UNI", limit=3)
+
+    blocks = [swap["blockNumber"] for swap in recent["swaps"]]
+    assert len(blocks) == 3 and blocks == sorted(blocks, reverse=True)
+    assert {recent["swaps"][0]["token0"]["symbol"], recent["swaps"][0]["token1"]["symbol"]} == {"UNI", "WETH"}
+    assert "position" not in recent["swaps"][0]
+    assert recent["as_of"].endswith("UTC")
+
+
+def test_an_unwatched_token_is_a_miss_that_queues_its_backfill(watcher):
+    watcher.poll_once()
+
+    assert watcher.get_recent_swaps("eth") is None
+    assert watcher.get_recent_swaps("NOTATOKEN") is None
+    assert watcher.pending == {"WETH"} and watcher.wake.is_set()
+
+    watcher.poll_once()
+    assert watcher.get_recent_swaps("ETH") is not None
+
+
+def test_a_stale_buffer_is_not_trusted(watcher):
+    watcher.poll_once()
+    watcher.polled_at -= watcher.max_lag + 1
+
+    assert watcher.get_recent_swaps("UNI") is None
+
+
+def test_a_failing_backfill_keeps_the_live_swaps_and_is_retried(watcher, monkeypatch):
+    watcher.poll_once()
+    watcher.get_recent_swaps("WBTC")
+    # pretend the last poll was 20 blocks ago, so the live fetch has swaps to store
+    watcher.last_block -= 20
+    buffered = watcher.get_stats()["buffered_swaps"]
+    resolve_pools = watcher.resolve_pools
+
+    def failing_resolve(symbol):
+        if symbol == "WBTC":
+            raise ConnectionError("node down")
+        return resolve_pools(symbol)
+
+    monkeypatch.setattr(watcher, "resolve_pools", failing_resolve)
+    watcher.poll_once()
+
+    stats = watcher.get_stats()
+    assert stats["backfill_errors"] == 1 and stats["tokens"] == ["UNI"]
+    assert stats["buffered_swaps"] > buffered
+    assert watcher.pending == {"WBTC"}
+    assert watcher.get_recent_swaps("UNI") is not None
+
+    monkeypatch.setattr(watcher, "resolve_pools", resolve_pools)
+    watcher.poll_once()
+
+    assert watcher.get_stats()["tokens"] == ["UNI", "WBTC"]
+    assert watcher.get_recent_swaps("WBTC") is not None
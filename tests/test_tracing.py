@@ -0,0 +1,125 @@
+import json
+import logging
+import urllib.request
+
+import pytest
+from langchain_core.messages import AIMessage
+
+from src.monitoring.tracing import (MetricsRegistry, JsonFormatter, metrics, span, trace, record_cache,
+                                    graphql_operation_name, start_metrics_server)
+
+
+def test_spans_nest_under_the_trace_of_their_turn():
+    with trace("turn") as root:
+        with span("classify", kind="node") as node:
+            with span("gpt-4o-mini", kind="llm") as call:
+                pass
+
+    assert root.trace_id and node.trace_id == call.trace_id == root.trace_id
+    assert (node.parent_id, call.parent_id) == (root.span_id, node.span_id)
+    assert call.duration is not None
+
+
+def test_a_failing_span_records_its_error():
+    before = metrics.values.get("blockagent_span_errors_total", {}).get((("kind", "rpc"), ("name", "eth_call")), 0)
+
+    with pytest.raises(RuntimeError):
+        with span("eth_call", kind="rpc") as failed:
+            raise RuntimeError("node down")
+
+    assert failed.error == "RuntimeError: node down"
+    assert metrics.values["blockagent_span_errors_total"][(("kind", "rpc"), ("name", "eth_call"))] == before + 1
+
+
+def test_token_usage_is_counted_unless_the_answer_came_from_our_cache():
+    key = (("direction", "prompt"), ("model", "test-usage-model"))
+    response = AIMessage(content="ok", usage_metadata={"input_tokens": 100, "output_tokens": 5, "total_tokens": 105,
+                                                       "input_token_details": {"cache_read": 64}})
+
+    with span("call", kind="llm", model="test-usage-model", prompt="classifier") as call:
+        call.record_usage(response)
+    with span("call", kind="llm", model="test-usage-model") as cached:
+        record_cache("llm", True)
+        cached.record_usage(response)
+
+    assert call.attributes["cached_prompt_tokens"] == 64
+    assert cached.attributes["cache_hit"] is True
+    assert metrics.values["blockagent_llm_tokens_total"][key] == 100
+    assert metrics.values["blockagent_llm_prompt_cache_tokens_total"][
+        (("model", "test-usage-model"), ("prompt", "classifier"), ("result", "hit"))] == 64
+
+
+def test_log_lines_carry_the_trace_id():
+    record = logging.LogRecord("blockagent.test", logging.INFO, __file__, 1, "hello", None, None)
+    with trace("turn") as root:
+        line = json.loads(JsonFormatter().format(record))
+
+    assert line["trace_id"] == root.trace_id and line["message"] == "hello"
+
+
+def test_render_escapes_labels_and_accumulates_buckets():
+    registry = MetricsRegistry()
+    registry.inc("blockagent_errors_total", reason='bad "quote"\n')
+    for value in (0.1, 0.7, 3.0):
+        registry.observe("blockagent_seconds", value, buckets=(0.5, 1.0))
+    text = registry.render()
+
+    assert r'blockagent_errors_total{reason="bad \"quote\"\n"} 1.0' in text
+    assert 'blockagent_seconds_bucket{le="0.5"} 1' in text
+    assert 'blockagent_seconds_bucket{le="1.0"} 2' in text
+    assert 'blockagent_seconds_bucket{le="+Inf"} 3' in text
+
+
+def test_graphql_spans_are_named_after_the_operation():
+    assert graphql_operation_name("query GetPoolData($token0: String!) { pools { id } }") == "GetPoolData"
+    assert graphql_operation_name("{ tokens { id } }") == "anonymous"
+
+
+def test_the_metrics_endpoint_serves_the_registry():
+    server = start_metrics_server(0, host="127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            body = response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
+
+    assert "# TYPE blockagent_span_duration_seconds histogram" in body
+
+
+def test_merged_worker_series_get_a_worker_label():
+    front, worker = MetricsRegistry(), MetricsRegistry()
+    front.inc("blockagent_worker_restarts_total", reason="died")
+    worker.describe("blockagent_llm_calls_total", "counter", "Chat model calls")
+    worker.inc("blockagent_llm_calls_total", model="gpt-4o-mini")
+    worker.observe("blockagent_turn_seconds", 0.3, buckets=(0.5, 1.0), route="conversation")
+
+    front.merge("0", worker.snapshot())
+    text = front.render()
+
+    assert 'blockagent_worker_restarts_total{reason="died"} 1.0' in text
+    assert 'blockagent_llm_calls_total{model="gpt-4o-mini",worker="0"} 1.0' in text
+    assert 'blockagent_turn_seconds_bucket{route="conversation",worker="0",le="0.5"} 1' in text
+    assert 'blockagent_turn_seconds_count{route="conversation",worker="0"} 1' in text
+    assert text.count("# TYPE blockagent_llm_calls_total counter") == 1
+
+
+def test_a_new_snapshot_replaces_the_last_one_of_its_worker():
+    front, worker = MetricsRegistry(), MetricsRegistry()
+    worker.inc("blockagent_llm_calls_total")
+    front.merge("1", worker.snapshot())
+    worker.inc("blockagent_llm_calls_total")
+    front.merge("1", worker.snapshot())
+
+    assert 'blockagent_llm_calls_total{worker="1"} 2.0' in front.render()
+
+
+def test_snapshot_is_a_copy():
+    worker = MetricsRegistry()
+    worker.observe("blockagent_turn_seconds", 0.3)
+    snapshot = worker.snapshot()
+    worker.observe("blockagent_turn_seconds", 0.3)
+
+    assert snapshot["histograms"]["blockagent_turn_seconds"][()]["count"] == 1
@@ -0,0 +1,54 @@
+import pytest
+
+from src.blockchain.transaction import Web3UHelperClass
+
+
+@pytest.fixture(scope="module")
+def web3_tools():
+    return Web3UHelperClass()
+
+
+def test_a_swap_is_simulated_with_the_estimate_and_fees_of_the_node(web3_tools):
+    result = web3_tools.simulate_swap("WETH", "USDC", 1.0)
+
+    assert result["success"] and result["status"] == "simulated"
+    assert result["gas_estimate_source"] == "eth_estimateGas"
+    assert result["gas_limit"] > result["gas_estimate"]
+    assert result["minimum_amount_out"] == pytest.approx(result["amount_out"] * 0.995)
+    assert result["max_fee_gwei"] == pytest.approx(2 * result["base_fee_gwei"] + result["priority_fee_gwei"]["standard"])
+    assert result["transaction_hash"].startswith("0x")
+
+
+def test_the_calldata_is_the_exact_input_swap_of_the_quote(web3_tools):
+    quote = web3_tools.quote_swap("WETH", "USDC", 1.0)
+    result = web3_tools.simulate_swap("WETH", "USDC", 1.0, quote=quote)
+
+    function, arguments = web3_tools.router.decode_function_input(result["calldata"]["data"])
+    params = arguments["params"]
+
+    assert function.fn_name == "exactInputSingle"
+    assert params["amountIn"] == quote["amount_in_raw"]
+    assert params["amountOutMinimum"] == quote["amount_out_raw"] * 9950 // 10000
+    assert result["amount_out"] == quote["amount_out"]
+
+
+def test_a_warm_quote_is_used_as_is(web3_tools):
+    quote = {**web3_tools.quote_swap("WETH", "USDC", 1.0), "amount_out": 1234.0, "as_of": "2026-10-19T00:00:00Z"}
+
+    result = web3_tools.simulate_swap("WETH", "USDC", 1.0, quote=quote)
+
+    assert result["amount_out"] == 1234.0
+    assert result["quote_as_of"] == "2026-10-19T00:00:00Z"
+
+
+def test_fees_are_fetched_once_per_block(web3_tools):
+    assert web3_tools.fee_estimate() is web3_tools.fee_estimate()
+
+
+def test_unknown_tokens_are_reported(web3_tools):
+    assert web3_tools.simulate_swap("FOO", "USDC", 1.0) == {"error": "Unknown token: FOO"}
+
+
+def test_balances_use_the_token_decimals(web3_tools):
+    assert web3_tools.get_token_balance("USDC")["balance"] == 2.5
+    assert web3_tools.get_token_balance("ETH")["balance"] == 1.5
@@ -0,0 +1,98 @@
+import time
+import threading
+
+import pytest
+
+from src.monitoring.tracing import metrics
+from src.serving.workers import WorkerPool
+
+
+def wait_for(condition, timeout: float = 30.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def session_on(pool: WorkerPool, slot) -> str:
+    return next(session_id for session_id in (f"session-{n}" for n in range(1000))
+                if pool.slot_for(session_id) is slot)
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = WorkerPool(2, threads_per_worker=2, health_interval=0.2, health_timeout=30)
+    pool.start()
+    yield pool
+    pool.stop()
+
+
+def test_turns_run_in_the_workers(pool):
+    result = pool.process("session-a", "hello")
+
+    assert result["status"] == "response_generated"
+    assert result["agent_response"]
+
+
+def test_worker_metrics_are_served_by_the_front_process(pool):
+    slot = pool.slot_for("session-a")
+    pool.process("session-a", "hello")
+
+    assert wait_for(lambda: str(slot.index) in metrics.sources)
+    assert f'worker="{slot.index}"' in metrics.render()
+
+
+def test_a_restart_starts_the_new_worker_outside_the_slot_lock(pool, monkeypatch):
+    slot, other = pool.slots
+    generation = slot.generation
+    started = threading.Event()
+    release = threading.Event()
+    wait_ready = pool.wait_ready
+
+    def slow_wait_ready(*args):
+        started.set()
+        release.wait(30)
+        wait_ready(*args)
+
+    monkeypatch.setattr(pool, "wait_ready", slow_wait_ready)
+    slot.process.kill()
+    assert started.wait(30)
+
+    # the slot can be locked and the other worker keeps being checked while the replacement starts
+    assert slot.condition.acquire(timeout=1)
+    slot.condition.release()
+    last_pong = other.last_pong
+    assert wait_for(lambda: other.last_pong > last_pong, timeout=5)
+
+    release.set()
+    assert wait_for(lambda: slot.generation > generation)
+    assert pool.process(session_on(pool, slot), "hello")["agent_response"]
+
+
+def test_a_recycle_hands_the_sessions_over(pool):
+    slot = pool.slots[0]
+    session_id = session_on(pool, slot)
+    pool.process(session_id, "hello")
+    generation = slot.generation
+
+    slot.turns = pool.max_turns
+    assert wait_for(lambda: slot.generation > generation)
+    assert wait_for(lambda: slot.stats.get("sessions", 0) >= 1, timeout=5)
+    assert wait_for(lambda: slot.replacement is None or not slot.replacement.is_alive(), timeout=5)
+    assert pool.process(session_id, "hello again")["agent_response"]
+
+
+def test_a_replacement_does_not_inherit_the_old_workers_stats(pool):
+    slot = pool.slots[1]
+    generation = slot.generation
+
+    slot.stats = {**slot.stats, "rss_mb": pool.max_rss_mb}
+    assert wait_for(lambda: slot.generation > generation)
+    assert wait_for(lambda: slot.replacement is None or not slot.replacement.is_alive(), timeout=5)
+
+    # a few more health checks, the new worker answers its pings and is not recycled in turn
+    time.sleep(pool.health_interval * 5)
+    assert slot.generation == generation + 1
+    assert slot.stats.get("rss_mb", 0) < pool.max_rss_mb